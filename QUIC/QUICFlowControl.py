@@ -0,0 +1,205 @@
+"""
+    This module contains the credit based flow control used at both the
+    connection and the stream level. A SendCredit tracks how much the peer
+    allows us to send, a ReceiveWindow tracks how much we allow the peer
+    to send and grows the window with the observed bandwidth delay product.
+    A StreamLimit tracks how many streams of one type an endpoint may open.
+    The MemoryBudget bounds the bytes the streams of all connections hold.
+"""
+
+from threading import Lock
+
+# There is no transport parameter exchange in the handshake, so both
+# endpoints start from these limits for the connection and every stream.
+INITIAL_MAX_STREAM_DATA = 256 * 1024
+INITIAL_MAX_DATA = 384 * 1024
+MAX_STREAM_WINDOW = 16 * 1024 * 1024
+MAX_CONNECTION_WINDOW = 24 * 1024 * 1024
+INITIAL_MAX_STREAMS = 65536 # For each of bidirectional and unidirectional streams.
+# The connection window is kept larger than the stream windows so that a single
+# stream can't use up all of the connection credit.
+CONNECTION_WINDOW_MULTIPLIER = 1.5
+# A window update is sent once less than this fraction of the window is left.
+WINDOW_UPDATE_THRESHOLD = 0.5
+# The window is doubled if the previous update was sent less than this many RTTs ago.
+WINDOW_AUTOTUNE_RTTS = 2
+# Once this fraction of the memory budget is used, receive windows stop growing and are halved
+# every time they would be updated, down to MEMORY_PRESSURE_MIN_WINDOW.
+MEMORY_PRESSURE_THRESHOLD = 0.75
+MEMORY_PRESSURE_MIN_WINDOW = 32 * 1024
+
+
+class SendCredit:
+    """
+        The sending side of flow control. max_data is the limit given by the peer
+        and used is the amount of data sent so far, both in bytes.
+    """
+
+    __slots__ = ("max_data", "used", "blocked_at")
+
+    def __init__(self, max_data: int):
+        self.max_data = max_data
+        self.used = 0
+        self.blocked_at = -1 # The limit we last sent a blocked frame for.
+
+    def get_available(self) -> int:
+        return max(0, self.max_data - self.used)
+
+    def on_data_sent(self, num_bytes: int) -> None:
+        self.used += num_bytes
+
+    def on_max_data(self, max_data: int) -> None:
+        # Window updates can arrive out of order, the limit never shrinks.
+        self.max_data = max(self.max_data, max_data)
+
+    def should_send_blocked(self) -> bool:
+        # Blocked frames are only sent once for each limit.
+        if self.get_available() > 0 or self.blocked_at == self.max_data:
+            return False
+        self.blocked_at = self.max_data
+        return True
+
+
+class ReceiveWindow:
+    """
+        The receiving side of flow control. max_data is the limit we advertised to the peer,
+        received is the amount of data received and consumed is the amount of data the
+        application has read. The window starts at window bytes and is doubled, up to
+        max_window, when the application reads a window worth of data in less than
+        WINDOW_AUTOTUNE_RTTS round trips, i.e. when the window is limiting the throughput.
+    """
+
+    __slots__ = ("window", "max_window", "max_data", "received", "consumed", "last_update_time", "update_requested")
+
+    def __init__(self, window: int, max_window: int):
+        self.window = window
+        self.max_window = max_window
+        self.max_data = window
+        self.received = 0
+        self.consumed = 0
+        self.last_update_time = None
+        self.update_requested = False
+
+    def get_available(self) -> int:
+        return max(0, self.max_data - self.received)
+
+    def on_data_received(self, num_bytes: int) -> None:
+        self.received += num_bytes
+
+    def on_data_consumed(self, num_bytes: int) -> None:
+        self.consumed += num_bytes
+
+    def on_blocked(self) -> None:
+        # The peer is waiting on us, so send an update as soon as there is any new credit.
+        self.update_requested = True
+
+    def ensure_window(self, window: int) -> None:
+        self.window = min(self.max_window, max(self.window, int(window)))
+
+    def should_update(self) -> bool:
+        if self.consumed + self.window <= self.max_data:
+            return False
+        if self.update_requested:
+            return True
+        return self.max_data - self.consumed < self.window * WINDOW_UPDATE_THRESHOLD
+
+    def shrink(self) -> None:
+        # The limit already advertised can't be taken back, a smaller window only slows down how fast it moves.
+        self.window = min(self.window, max(MEMORY_PRESSURE_MIN_WINDOW, self.window // 2))
+
+    def update(self, now: float, rtt: float, grow: bool = True) -> int:
+        """
+            Moves the limit to a window beyond what has been consumed and returns the new limit.
+            The window is only autotuned if grow is True.
+        """
+        if grow and self.last_update_time is not None and now - self.last_update_time < rtt * WINDOW_AUTOTUNE_RTTS:
+            self.ensure_window(self.window * 2)
+        self.last_update_time = now
+        self.update_requested = False
+        self.max_data = self.consumed + self.window
+        return self.max_data
+
+
+class StreamLimit:
+    """
+        Tracks the streams of one type (bidirectional or unidirectional) opened by one endpoint.
+        Streams are identified by their index, max_streams is how many streams the endpoint
+        may open and opened is one more than the largest index opened so far. Opening a stream
+        implicitly opens all the streams of the same type with smaller indexes. Every stream
+        below closed_below has been closed, closed holds the streams closed out of order above it.
+    """
+
+    def __init__(self, max_streams: int):
+        self.window = max_streams
+        self.max_streams = max_streams
+        self.opened = 0
+        self.closed_below = 0
+        self.closed: set[int] = set()
+
+    def get_available(self) -> int:
+        return max(0, self.max_streams - self.opened)
+
+    def on_opened(self, index: int) -> None:
+        self.opened = max(self.opened, index + 1)
+
+    def on_closed(self, index: int) -> None:
+        self.closed.add(index)
+        while self.closed_below in self.closed:
+            self.closed.remove(self.closed_below)
+            self.closed_below += 1
+
+    def is_closed(self, index: int) -> bool:
+        return index < self.closed_below or index in self.closed
+
+    def get_closed_count(self) -> int:
+        return self.closed_below + len(self.closed)
+
+    def on_max_streams(self, max_streams: int) -> None:
+        self.max_streams = max(self.max_streams, max_streams)
+
+    def should_update(self) -> bool:
+        # More streams are allowed once half of the window has been closed.
+        return self.get_closed_count() + self.window - self.max_streams >= self.window * WINDOW_UPDATE_THRESHOLD
+
+    def update(self) -> int:
+        self.max_streams = self.get_closed_count() + self.window
+        return self.max_streams
+
+
+class MemoryBudget:
+    """
+        Bounds the bytes held in the stream buffers of every connection in the process: data
+        waiting to be sent or acknowledged, and data received but not read. Connections charge
+        the bytes they hold to the budget. Past MEMORY_PRESSURE_THRESHOLD of the limit they shrink
+        the receive windows they advertise, and once the limit is reached they refuse new streams
+        and connections, and sends on streams with a send buffer raise BlockingIOError.
+        A limit of None means there is no limit.
+    """
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.used = 0
+        self._lock = Lock()
+
+    def set_limit(self, limit: int or None) -> None:
+        self.limit = limit
+
+    def charge(self, num_bytes: int) -> None:
+        # A negative number of bytes gives them back.
+        with self._lock:
+            self.used += num_bytes
+
+    def get_available(self) -> int or None:
+        if self.limit is None:
+            return None
+        return max(0, self.limit - self.used)
+
+    def is_under_pressure(self) -> bool:
+        return self.limit is not None and self.used >= self.limit * MEMORY_PRESSURE_THRESHOLD
+
+    def is_exhausted(self) -> bool:
+        return self.limit is not None and self.used >= self.limit
+
+
+# The budget every connection in the process charges, unlimited until set_limit is called.
+MEMORY_BUDGET = MemoryBudget()
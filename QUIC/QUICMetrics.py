@@ -0,0 +1,308 @@
+"""
+    This module contains the process wide metrics of every connection: counters,
+    gauges and latency histograms kept in a MetricsRegistry, and the MetricsExporter
+    which serves them in the Prometheus text format over HTTP or a Unix socket,
+    or writes them to a file.
+"""
+
+import os
+from math import frexp, ldexp
+from threading import Thread, Lock, Event, local
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+
+# Histogram buckets are HDR style: every power of two is split into HISTOGRAM_SUB_BUCKETS
+# buckets of equal width, so a bucket is never more than 1/16th (6.25%) wider than its values.
+HISTOGRAM_SUB_BUCKETS = 16
+HISTOGRAM_MIN_EXPONENT = -20 # Values below 2^-21 (about 0.5 microseconds) go in the first bucket.
+HISTOGRAM_MAX_EXPONENT = 12  # Values above 2^12 (about an hour) go in the last bucket.
+HISTOGRAM_BUCKETS = (HISTOGRAM_MAX_EXPONENT - HISTOGRAM_MIN_EXPONENT + 1) * HISTOGRAM_SUB_BUCKETS
+METRICS_FILE_INTERVAL = 10.0 # seconds between rewrites of a metrics file.
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """
+        A metric is updated without taking a lock: every thread updates its own shard,
+        and the shards are merged when the metric is read. The lock is only taken the
+        first time a thread updates the metric and when the metric is read.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._local = local()
+        self._shards: list = []
+        self._lock = Lock()
+
+    def new_shard(self):
+        raise NotImplementedError
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self.new_shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def get_shards(self) -> list:
+        with self._lock:
+            return list(self._shards)
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def new_shard(self) -> list:
+        return [0]
+
+    def inc(self, amount: int = 1) -> None:
+        self.shard()[0] += amount
+
+    def get(self):
+        return sum([shard[0] for shard in self.get_shards()])
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {self.get()}"]
+
+
+class Gauge(Counter):
+    """
+        A value that goes up and down, e.g. the number of open connections.
+        It is changed with inc and dec, as a gauge kept in shards can't be set.
+    """
+
+    type = "gauge"
+
+    def dec(self, amount: int = 1) -> None:
+        self.shard()[0] -= amount
+
+
+class Histogram(Metric):
+    """
+        Records the distribution of a value (e.g. a latency in seconds) in fixed log-linear buckets.
+        Recording a value is O(1), and the relative error of the percentiles is at most 1/16th.
+    """
+
+    type = "histogram"
+
+    def new_shard(self) -> list:
+        return [0, 0.0, [0] * HISTOGRAM_BUCKETS] # count, sum, bucket counts
+
+    def observe(self, value: float) -> None:
+        shard = self.shard()
+        shard[0] += 1
+        shard[1] += value
+        shard[2][get_bucket_index(value)] += 1
+
+    def get_snapshot(self) -> tuple[int, float, list[int]]:
+        count, total, buckets = 0, 0.0, [0] * HISTOGRAM_BUCKETS
+        for shard in self.get_shards():
+            count += shard[0]
+            total += shard[1]
+            for i, bucket_count in enumerate(shard[2]):
+                if bucket_count:
+                    buckets[i] += bucket_count
+        return count, total, buckets
+
+    def get_count(self) -> int:
+        return sum([shard[0] for shard in self.get_shards()])
+
+    def get_percentile(self, percentile: float) -> float or None:
+        """
+            Returns the upper bound of the bucket holding the given percentile (0 to 100), or None if no value was recorded.
+        """
+        count, total, buckets = self.get_snapshot()
+        if count == 0:
+            return None
+        rank = max(1, percentile / 100 * count)
+        seen = 0
+        for i, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return get_bucket_upper_bound(i)
+        return get_bucket_upper_bound(HISTOGRAM_BUCKETS - 1)
+
+    def render(self) -> list[str]:
+        # Only the buckets that have values are written, Prometheus buckets are cumulative.
+        count, total, buckets = self.get_snapshot()
+        lines = []
+        seen = 0
+        for i, bucket_count in enumerate(buckets):
+            if bucket_count:
+                seen += bucket_count
+                lines.append(f'{self.name}_bucket{{le="{get_bucket_upper_bound(i):.6g}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+def get_bucket_index(value: float) -> int:
+    if value <= 0:
+        return 0
+    mantissa, exponent = frexp(value) # value = mantissa * 2^exponent, 0.5 <= mantissa < 1
+    if exponent < HISTOGRAM_MIN_EXPONENT:
+        return 0
+    if exponent > HISTOGRAM_MAX_EXPONENT:
+        return HISTOGRAM_BUCKETS - 1
+    sub_bucket = int((mantissa - 0.5) * 2 * HISTOGRAM_SUB_BUCKETS)
+    return (exponent - HISTOGRAM_MIN_EXPONENT) * HISTOGRAM_SUB_BUCKETS + sub_bucket
+
+
+def get_bucket_upper_bound(index: int) -> float:
+    exponent = index // HISTOGRAM_SUB_BUCKETS + HISTOGRAM_MIN_EXPONENT
+    sub_bucket = index % HISTOGRAM_SUB_BUCKETS
+    return ldexp(1 + (sub_bucket + 1) / HISTOGRAM_SUB_BUCKETS, exponent - 1)
+
+
+class MetricsRegistry:
+    """
+        Holds the metrics of the process by name. Asking for a metric that already exists returns it.
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = dict()
+        self._lock = Lock()
+
+    def get_or_create(self, metric_class, name: str, help: str) -> Metric:
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, help)
+            elif type(metric) is not metric_class:
+                raise ValueError(f"Metric {name} is already registered as a {metric.type}.")
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.get_or_create(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.get_or_create(Gauge, name, help)
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        return self.get_or_create(Histogram, name, help)
+
+    def render(self) -> str:
+        """
+            Returns every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+# The registry every connection in the process reports to.
+METRICS = MetricsRegistry()
+CONNECTIONS_ACTIVE = METRICS.gauge("quic_connections_active", "Connections that are currently connected.")
+HANDSHAKES = METRICS.counter("quic_handshakes_total", "Handshakes completed, as client or server.")
+ACCEPT_QUEUE_DEPTH = METRICS.gauge("quic_accept_queue_depth", "Connections handshaking on a listening socket that accept hasn't returned or given up on yet.")
+DATAGRAMS_RECEIVED = METRICS.counter("quic_datagrams_received_total", "UDP datagrams received.")
+RECEIVE_CALLS = METRICS.counter("quic_receive_calls_total", "recvfrom system calls made, including the ones that found no datagram.")
+DATAGRAMS_SENT = METRICS.counter("quic_datagrams_sent_total", "UDP datagrams sent.")
+SEND_BATCHES = METRICS.counter("quic_send_batches_total", "send_batch calls made on transports, each sends one or more datagrams.")
+PARSE_ERRORS = METRICS.counter("quic_packet_parse_errors_total", "Datagrams dropped because they couldn't be parsed as a packet.")
+RTT = METRICS.histogram("quic_rtt_seconds", "RTT samples taken from acknowledgements.")
+BUFFERED_BYTES = METRICS.gauge("quic_buffered_bytes", "Bytes held in the stream buffers of every connection, see MemoryBudget.")
+CONNECTIONS_REFUSED = METRICS.counter("quic_connections_refused_total", "INITIAL packets dropped because the memory budget was used up.")
+STREAMS_REFUSED = METRICS.counter("quic_streams_refused_total", "Packets opening a stream that were dropped because the memory budget was used up.")
+HANDSHAKE_TIME = METRICS.histogram("quic_handshake_seconds", "Time taken by completed handshakes.")
+SEND_TIME = METRICS.histogram("quic_send_seconds", "Time spent in QUICSocket.send calls.")
+RECV_TIME = METRICS.histogram("quic_recv_seconds", "Time spent in QUICSocket.recv, recv_into and recv_exactly calls.")
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes aren't logged.
+
+
+class MetricsExporter:
+    """
+        Makes a registry available to Prometheus. serve_http and serve_unix answer scrapes from
+        a background thread, write_file rewrites a file (e.g. for the node exporter's textfile
+        collector) every interval seconds. The metrics are only rendered when they are read.
+    """
+
+    def __init__(self, registry: MetricsRegistry = METRICS):
+        self.registry = registry
+        self._servers = []
+        self._threads: list[Thread] = []
+        self._stopped = Event()
+
+    def serve_http(self, address: tuple[str, int] = ("127.0.0.1", 9464)) -> tuple[str, int]:
+        """
+            Serves the metrics on http://address/metrics and returns the address, which
+            has the port the server was bound to if port 0 was given.
+        """
+        server = ThreadingHTTPServer(address, MetricsRequestHandler)
+        self.start_server(server)
+        return server.server_address
+
+    def serve_unix(self, path: str) -> None:
+        # Answers HTTP scrapes on a Unix socket, e.g. curl --unix-socket path http://localhost/metrics
+        if os.path.exists(path):
+            os.remove(path)
+        server = ThreadingUnixStreamServer(path, MetricsRequestHandler)
+        self.start_server(server)
+
+    def start_server(self, server) -> None:
+        server.registry = self.registry
+        server.daemon_threads = True
+        self._servers.append(server)
+        thread = Thread(target=server.serve_forever, name="MetricsExporter", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def write_file(self, path: str, interval: float = METRICS_FILE_INTERVAL) -> None:
+        self.write_metrics(path)
+        thread = Thread(target=self.run_file_writer, args=(path, interval), name="MetricsExporter", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def write_metrics(self, path: str) -> None:
+        # The file is replaced in one go so that readers never see half of it.
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as f:
+            f.write(self.registry.render())
+        os.replace(temporary_path, path)
+
+    def run_file_writer(self, path: str, interval: float) -> None:
+        while not self._stopped.wait(interval):
+            self.write_metrics(path)
+
+    def close(self) -> None:
+        self._stopped.set()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server, ThreadingUnixStreamServer) and os.path.exists(server.server_address):
+                os.remove(server.server_address)
+        for thread in self._threads:
+            thread.join()
+        self._servers = []
+        self._threads = []
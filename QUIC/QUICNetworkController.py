@@ -2,20 +2,16 @@ from .QUICPacketParser import parse_packet_bytes, PacketParserError
 from .QUICPacket import *
 from .QUICConnection import ConnectionContext, create_connection_id
 from .QUICEncryption import EncryptionContext
-from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR
+from .QUICStream import SendStream, ReceiveStream, StreamError, is_server_initiated, is_unidirectional, get_stream_index, make_stream_id
+from .QUICFlowControl import SendCredit, ReceiveWindow, StreamLimit, INITIAL_MAX_DATA, MAX_CONNECTION_WINDOW, CONNECTION_WINDOW_MULTIPLIER, INITIAL_MAX_STREAMS, MEMORY_BUDGET
+from .QUICScheduler import StreamScheduler
+from .QUICMetrics import CONNECTIONS_ACTIVE, HANDSHAKES, ACCEPT_QUEUE_DEPTH, DATAGRAMS_RECEIVED, RECEIVE_CALLS, PARSE_ERRORS, RTT, HANDSHAKE_TIME, \
+    BUFFERED_BYTES, CONNECTIONS_REFUSED, STREAMS_REFUSED, DATAGRAMS_SENT, SEND_BATCHES
+from .QUICTransport import DatagramTransport, RECEIVE_BATCH
+from threading import RLock, Condition
+from bisect import bisect_left
 import math
 from time import time
-import logging
-
-# Initialize logging facility.
-def setup_logger(name: str, filepath: str, level=logging.DEBUG):
-    file_handler = logging.FileHandler(filepath)
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(file_handler)
-    return logger
-
-log = setup_logger("log", "packet.log")
 
 # Congestion Controller States
 SLOW_START = 1
@@ -29,6 +25,33 @@ SAFE_DATAGRAM_PAYLOAD_SIZE = 512 # bytes
 INITIAL_CONGESTION_WINDOW = MAX_DATAGRAM_SIZE*10 # Initial window is 10 times max datagram size RFC 9002
 MINIMUM_CONGESTION_WINDOW = MAX_DATAGRAM_SIZE*2  # Minimum window is 2 times max datagram size RFC 9002
 
+# HyStart++ Data (RFC 9406)
+HYSTART_MIN_RTT_THRESH = 0.004   # seconds
+HYSTART_MAX_RTT_THRESH = 0.016   # seconds
+HYSTART_MIN_RTT_DIVISOR = 8
+HYSTART_N_RTT_SAMPLE = 8         # RTT samples required per round before deciding to exit.
+HYSTART_CSS_GROWTH_DIVISOR = 4   # Conservative Slow Start grows cwnd 4 times slower than slow start.
+HYSTART_CSS_ROUNDS = 5           # Rounds spent in Conservative Slow Start before entering congestion avoidance.
+
+# Loss Detection Data
+PACKET_THRESHOLD = 3            # Initial reordering threshold in packets RFC 9002
+MAX_PACKET_THRESHOLD = 32       # The packet threshold never grows past this many packets.
+TIME_THRESHOLD = 9/8            # Initial reordering threshold as a multiple of the RTT RFC 9002
+MAX_TIME_THRESHOLD = 2.0        # The time threshold never grows past this multiple of the RTT.
+TIMER_GRANULARITY = 0.001       # seconds
+INITIAL_RTT = 0.333             # RTT assumed before the first sample is taken RFC 9002
+MAX_PROBE_PACKETS = 2           # Packets sent when the probe timeout fires.
+LOST_PACKET_HISTORY = 256       # Number of packets declared lost that are remembered to detect spurious losses.
+
+# Pacing Data
+PACING_GAIN = 1.25                        # Pace slightly faster than cwnd/smoothed_rtt so the window can still be filled RFC 9002
+PACING_MAX_BURST = MAX_DATAGRAM_SIZE*4    # Largest number of bytes that can be sent back to back.
+MAX_SEND_WAIT = 0.05                      # Longest time (seconds) a blocked sender waits for an ACK before trying again.
+
+# Memory Limits
+MAX_BUFFERED_PACKETS = 256      # Packets kept until the handshake has progressed far enough to process them.
+MAX_ACK_PACKET_NUMBERS = 1024   # Received packet numbers kept for ACK frames, the oldest ones are no longer acknowledged.
+
 # This means we have ended the connection.
 DISCONNECTED = 1
 # This means we have completed the handshake and are currently connected.
@@ -51,6 +74,12 @@ def contains_long_header(pkt: Packet):
 
 
 class PacketSentInfo:
+    """
+        Bookkeeping for a packet that has been sent. Stream data is not kept here,
+        only the byte ranges the packet carried, the data itself stays in the SendStream
+        until it is acknowledged. Other frames are kept so that they can be retransmitted
+        or, for ACK frames, so that we know which packet numbers the peer has seen acknowledged.
+    """
 
     def __init__(self, in_flight=False, sent_bytes=0, time_sent=0.0, packet_number=0, ack_eliciting=False, packet=None):
         self.in_flight: bool = in_flight
@@ -58,7 +87,65 @@ class PacketSentInfo:
         self.time_sent: float = time_sent
         self.ack_eliciting: bool = ack_eliciting
         self.packet_number: int = packet_number
-        self.packet: Packet = packet
+        self.header_type: int = HT_DATA
+        self.frames: list = []                                  # Frames other than stream frames.
+        self.stream_ranges: list[tuple[int, int, int, bool]] = [] # (stream_id, offset, length, fin) of each stream frame.
+        if packet:
+            self.header_type = packet.header.type
+            for frame in packet.frames:
+                if frame.type == FT_STREAM:
+                    self.stream_ranges.append((frame.stream_id, frame.offset, frame.length, frame.fin))
+                else:
+                    self.frames.append(frame)
+        # Set when the packet is declared lost, used to detect spurious losses.
+        self.loss_event: int = 0
+        self.largest_acknowledged_when_lost: int = -1
+
+
+class ConnectionStats:
+    """
+        A snapshot of the counters and transport state of a connection, see QUICSocket.get_stats.
+        Times are in seconds, rates in bytes per second. ack_ranges is the number of ranges in
+        the last ACK frame sent and ack_packet_numbers the number of received packet numbers
+        that are acknowledged until the peer has seen an ACK for them. The buffer sizes are
+        the bytes held by the streams of the connection, send_buffer_size counts data that
+        has been sent but not yet acknowledged. memory_used is the sum of the two, which is what the
+        connection charges to the MemoryBudget. The buffers of a single stream are reported by
+        get_stream_stats, so that taking a snapshot doesn't depend on the number of streams.
+    """
+
+    def __init__(self):
+        self.state = DISCONNECTED
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_retransmitted = 0
+        self.probes_sent = 0
+        self.packets_lost = 0
+        self.spurious_losses = 0
+        self.congestion_window = 0
+        self.slow_start_threshold = INFINITY
+        self.bytes_in_flight = 0
+        self.smoothed_rtt = 0.0
+        self.min_rtt = INFINITY
+        self.latest_rtt = 0.0
+        self.pacing_rate = INFINITY
+        self.ack_ranges = 0
+        self.ack_packet_numbers = 0
+        self.send_buffer_size = 0
+        self.receive_buffer_size = 0
+        self.memory_used = 0
+        self.buffered_packets = 0
+        self.send_streams = 0
+        self.receive_streams = 0
+        self.handshake_duration: float = None
+
+    def __repr__(self) -> str:
+        representation = "------ Connection Stats ------\n"
+        for name, value in self.__dict__.items():
+            representation += f"{name}: {value}\n"
+        return representation
 
 
 class PacketReceivedInfo:
@@ -77,6 +164,7 @@ class QUICPacketizer:
 
     def __init__(self):
         self._next_packet_number = 0
+        self.ack_ranges = 0 # Number of ranges in the last ACK frame.
 
 
     def get_next_packet_number(self):
@@ -100,14 +188,52 @@ class QUICPacketizer:
             )
         return None
         
-    def packetize_retransmissions(self, lost_packets: list[PacketSentInfo]) -> list[Packet]:
+    def packetize_retransmissions(self, lost_packets: list[PacketSentInfo], connection_context: ConnectionContext) -> list[Packet]:
+        # Stream data is retransmitted from the send streams, see packetize_stream_retransmission.
+        # Here we only resend the other ack eliciting frames of lost packets in packets with new headers.
         pkts: list[Packet] = []
         for info in lost_packets:
-            hdr: LongHeader or ShortHeader = info.packet.header
-            hdr.packet_number = self.get_next_packet_number()
-            pkts.append(Packet(header=hdr, frames=info.packet.frames))
+            frames = [frame for frame in info.frames if frame.type not in [FT_ACK, FT_PADDING]]
+            if frames:
+                pkts.append(Packet(header=self.create_header(info.header_type, connection_context), frames=frames))
         return pkts
 
+
+    def packetize_stream_retransmission(self, connection_context: ConnectionContext, send_streams: dict) -> Packet or None:
+        # Fills a single packet with as much lost stream data as fits, taken from any stream that has lost data.
+        MAX_ALLOWED = SAFE_DATAGRAM_PAYLOAD_SIZE-LONG_HEADER_SIZE
+        frames = []
+        space = MAX_ALLOWED
+        for stream in send_streams.values():
+            frame_size = get_stream_frame_size(stream.stream_id)
+            while stream.has_lost_data() and space > frame_size:
+                offset, data = stream.next_lost_range(space-frame_size)
+                frames.append(StreamFrame(stream_id=stream.stream_id, offset=offset, length=len(data), data=data))
+                space -= frame_size + len(data)
+            if space <= STREAM_FRAME_SIZE:
+                break
+        if not frames:
+            return None
+        return Packet(header=self.create_header(HT_DATA, connection_context), frames=frames)
+
+
+    def packetize_probes(self, probes: list[PacketSentInfo], connection_context: ConnectionContext, send_streams: dict) -> list[Packet]:
+        # Probe packets carry whatever is still unacknowledged from packets that are in flight, under new packet numbers.
+        pkts: list[Packet] = []
+        for info in probes:
+            frames = [frame for frame in info.frames if frame.type not in [FT_ACK, FT_PADDING]]
+            for stream_id, offset, length, fin in info.stream_ranges:
+                if stream_id not in send_streams:
+                    continue
+                for piece_offset, data in send_streams[stream_id].get_unacked_data(offset, offset+length):
+                    frames.append(StreamFrame(stream_id=stream_id, offset=piece_offset, length=len(data), data=data))
+                if fin and not send_streams[stream_id].fin_acked:
+                    frames.append(StreamFrame(stream_id=stream_id, offset=offset+length, fin=True))
+            if frames:
+                pkts.append(Packet(header=self.create_header(info.header_type, connection_context), frames=frames))
+        return pkts
+
+
     def packetize_initial_packet(self, connection_context: ConnectionContext) -> Packet:
         hdr = self.create_header(HT_INITIAL, connection_context)
         frames = [] # TODO Add crypto frames.
@@ -142,24 +268,27 @@ class QUICPacketizer:
         if len(packet_numbers_received) == 1:
             return AckFrame(largest_acknowledged=packet_numbers_received[0], ack_delay=0, ack_range_count=0, ack_range=[])
         # If the received packets list is greater than 1.
-        # We sort the packet number list.
-        # Then we incrementally create AckRanges.
-        # In the resulting AckRanges, an AckRange with gap 0 is the most recent AckRange,
-        # from this AckRange we can get first ack range value.
-        packet_numbers_received.sort()
+        # We sort a copy of the packet number list from largest to smallest, the caller's list is left as it is.
+        # Then we incrementally create AckRanges walking down from the largest packet number.
+        # The first contiguous range is encoded in first_ack_range, every following range
+        # records the number of missing packets above it (gap) and the number of packets in it.
+        packet_numbers_received = sorted(set(packet_numbers_received), reverse=True)
+        largest_acknowledged = packet_numbers_received[0]
+        first_ack_range = None
         ranges = []
-        count = 0
-        for i in range(0, len(packet_numbers_received)):
-            count += 1
-            if i == len(packet_numbers_received)-1:
-                ranges.append(AckRange(gap=0, ack_range_length=count))
-                break
-            if packet_numbers_received[i+1] != packet_numbers_received[i]+1:
-                ranges.append(AckRange(gap=packet_numbers_received[i+1] - packet_numbers_received[i] - 1, ack_range_length=count))
-                count = 0
-        first_ack_range = ranges[-1].ack_range_length - 1
-        largest_acknowledged = packet_numbers_received[-1]
-        ranges.remove(ranges[-1])
+        range_largest = previous = largest_acknowledged
+        gap = 0
+        # A range ends where the next packet number isn't one less, the sentinel ends the last one.
+        for pn in packet_numbers_received + [-2]:
+            if pn < previous - 1:
+                # previous is the smallest packet number of the current range.
+                if first_ack_range is None:
+                    first_ack_range = range_largest - previous
+                else:
+                    ranges.append(AckRange(gap=gap, ack_range_length=range_largest - previous + 1))
+                range_largest = pn
+                gap = previous - pn - 1
+            previous = pn
         return AckFrame(largest_acknowledged=largest_acknowledged, ack_delay=0, ack_range_count=len(ranges), first_ack_range=first_ack_range, ack_range=ranges)
 
 
@@ -172,85 +301,57 @@ class QUICPacketizer:
 
         hdr = self.create_header(HT_DATA, connection_context)
         frames = [self.create_ack_frame(packet_numbers_received)]
+        self.ack_ranges = frames[0].ack_range_count + 1
         pkt = Packet(header=hdr, frames=frames)
         return pkt
 
 
-    def packetize_stream_data(self, stream_id: int, data: bytes, connection_context: ConnectionContext, send_streams: dict) -> list[Packet]:
-        packets = []
-        MAX_ALLOWED = SAFE_DATAGRAM_PAYLOAD_SIZE-LONG_HEADER_SIZE-STREAM_FRAME_SIZE
-        # If the length of this data would go over the safe datagram size - long header size - stream frame size,
-        # then we need to split this data into multiple QUIC packets.
-        datasize = len(data)
-        if datasize > MAX_ALLOWED:
-            bytes_written = 0
-            while bytes_written < datasize:
-                data_chunk = data[0:MAX_ALLOWED]
-                hdr = self.create_header(HT_DATA, connection_context)
-                frames = [StreamFrame(stream_id=stream_id, offset=send_streams[stream_id].get_offset(), length=len(data_chunk), data=data_chunk)]
-                packets.append(Packet(header=hdr, frames=frames))
-                send_streams[stream_id].update_offset(len(data_chunk))
-                data = data[MAX_ALLOWED:]
-                bytes_written += len(data_chunk)
-        else:
-            hdr = self.create_header(HT_DATA, connection_context)
-            frames = [StreamFrame(stream_id=stream_id, offset=send_streams[stream_id].get_offset(), length=len(data), data=data)]
-            packets.append(Packet(header=hdr, frames=frames))
-            send_streams[stream_id].update_offset(len(data))
-        return packets
-
-
-
-
-class SendStream:
-
-    def __init__(self, stream_id: int):
-        self.stream_id = stream_id
-        self.offset = 0
-
-    def get_offset(self) -> int:
-        return self.offset
-
-    def update_offset(self, data_length: int) -> None:
-        self.offset += data_length
-
-
-
-
-class ReceiveStream:
-
-    def __init__(self, stream_id: int):
-        self.stream_id = stream_id
-        self.data = b""
-        self.offset = 0
-        self.buffered_frames: list[StreamFrame] = []
-
-    def buffer(self, frame: StreamFrame):
-        self.buffered_frames.append(frame)
-
-    def write(self, new_data: bytes):
-        self.offset += len(new_data)
-        self.data += new_data
-        self.process_buffered_frames()
-
-    def process_buffered_frames(self):
-        frames_to_remove = []
-        frames = ""
-        for frame in self.buffered_frames:
-            frames += frame.__repr__() + '\n'
-        for frame in self.buffered_frames:
-            if self.offset == frame.offset:
-                self.data += frame.data
-                self.offset += len(frame.data)
-                frames_to_remove.append(frame)
-        for frame in frames_to_remove:
-            self.buffered_frames.remove(frame)
+    def packetize_control_frames(self, frames: list, connection_context: ConnectionContext) -> Packet:
+        hdr = self.create_header(HT_DATA, connection_context)
+        return Packet(header=hdr, frames=frames)
 
-    def read(self, num_bytes: int) -> bytes:
-        data = self.data[0:num_bytes]
-        self.data = self.data[len(data):]
-        return data
 
+    def packetize_scheduled_data(self, scheduler: StreamScheduler, connection_context: ConnectionContext, send_streams: dict, send_credit: SendCredit) -> Packet or None:
+        """
+            Fills a single packet with the pending data of the streams the scheduler picks, as far as
+            flow control allows. The stream frames reference the pending data through memoryviews
+            instead of copying it, and the data is only added to the send streams once it is packetized.
+            Streams that have nothing left they are allowed to send are unscheduled.
+        """
+        MAX_ALLOWED = SAFE_DATAGRAM_PAYLOAD_SIZE-LONG_HEADER_SIZE
+        frames = []
+        space = MAX_ALLOWED
+        while send_credit.get_available() > 0:
+            stream_id = scheduler.next_stream()
+            if stream_id is None:
+                break
+            frame_size = get_stream_frame_size(stream_id)
+            if space <= frame_size:
+                break
+            send_stream: SendStream = send_streams.get(stream_id)
+            if send_stream is None:
+                scheduler.unschedule(stream_id)
+                continue
+            length = min(send_stream.pending_size, send_stream.credit.get_available(), send_credit.get_available(), space-frame_size)
+            if length == 0:
+                # Either everything has been sent or the stream is blocked by its flow control limit.
+                scheduler.unschedule(stream_id)
+                continue
+            # The pending data is made of the chunks passed to send, a frame never spans two of them.
+            data_chunk = send_stream.take_pending(length)
+            length = len(data_chunk)
+            # The data is kept in the send stream until it is acknowledged.
+            offset = send_stream.write(data_chunk)
+            send_stream.credit.on_data_sent(length)
+            send_credit.on_data_sent(length)
+            # A stream closed while it still had pending data sends its FIN with the last of it.
+            fin = send_stream.fin_offset is not None and not send_stream.has_pending_data()
+            frames.append(StreamFrame(stream_id=stream_id, offset=offset, length=length, data=data_chunk, fin=fin))
+            space -= frame_size + length
+            scheduler.on_data_sent(stream_id)
+        if not frames:
+            return None
+        return Packet(header=self.create_header(HT_DATA, connection_context), frames=frames)
 
 
 
@@ -270,7 +371,41 @@ class QUICNetworkController:
         self._receive_streams = dict() # Key: Stream ID (int) | Value: Stream object
         self._send_streams = dict()
         self.buffered_packets = []
-        self.new_socket = None
+        self.pending_retransmissions: list[Packet] = [] # Retransmissions and control frames held back by congestion control or pacing.
+        self.send_credit = SendCredit(INITIAL_MAX_DATA) # Connection level flow control limit set by the peer.
+        self.receive_window = ReceiveWindow(INITIAL_MAX_DATA, MAX_CONNECTION_WINDOW) # Connection level flow control.
+        self.flow_control_violations = 0
+        # Stream limits keyed by whether they are for unidirectional streams. The local limits are
+        # set by the peer for the streams we open, the peer limits are the ones we set for the peer.
+        self.local_stream_limits = {False: StreamLimit(INITIAL_MAX_STREAMS), True: StreamLimit(INITIAL_MAX_STREAMS)}
+        self.peer_stream_limits = {False: StreamLimit(INITIAL_MAX_STREAMS), True: StreamLimit(INITIAL_MAX_STREAMS)}
+        self.stream_limit_violations = 0
+        self.new_peer_streams: list[int] = [] # Streams opened by the peer that the application hasn't accepted yet.
+        self.streams_with_lost_data: dict[int, None] = dict() # Used as an ordered set.
+        self.scheduler = StreamScheduler() # Decides which stream's pending data is sent next.
+        # Taken by every QUICSocket call. A reactor takes it while servicing the connection
+        # and notifies the condition once it has processed packets.
+        self.lock = RLock()
+        self.condition = Condition(self.lock)
+        self.reactor = None
+        self.tracer = None # A QLogTracer, set with set_tracer.
+        self.profiler = None # A StageProfiler, set with set_profiler.
+        self.clock = time # Returns the current time in seconds, replaced by a virtual clock in simulations.
+
+        # ---- Statistics ----
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_retransmitted = 0
+        self.send_buffer_size = 0 # Bytes queued on the send streams that haven't been acknowledged.
+        self.receive_buffer_size = 0 # Bytes held by the receive streams that haven't been read.
+        self.buffered_packets_dropped = 0
+        self.memory_budget = MEMORY_BUDGET
+        self.memory_charged = 0 # Bytes this connection has charged to the memory budget.
+        self.handshake_start_time: float = None
+        self.accept_pending = False # Counted in ACCEPT_QUEUE_DEPTH, until the handshake completes or the listener gives up on it.
+        self.handshake_duration: float = None
+        self.is_server = False
+        self.new_transport = None
         self.peer_issued_connection_closed = False
 
         # ---- Handshake Data ----
@@ -285,28 +420,61 @@ class QUICNetworkController:
         # ---- Acknowledgement Data ----
         self.largest_acknowledged = -1
         self.largest_packet_number_received: int = 0
+        # Sorted from smallest to largest and without duplicates, only changed by
+        # update_received_packet_numbers and forget_received_packet_numbers.
         self.unacked_packet_numbers_received: list[int] = []
 
 
-    def initiate_connection_termination(self, udp_socket: socket) -> None:
+    def initiate_connection_termination(self, transport: DatagramTransport) -> None:
         """
             1. Send short header packet with ConnectionClose Frame.
                 1. Use the packetizer to create a ConnectionClose packet.
                 2. transmit the packet using the regular functions.
-                3. Close the underlying UDP socket.
+                3. Close the underlying transport.
                 4. Update the connection context information.
         """
+        # Data the application has already sent is packetized before the connection is closed.
+        self.flush_stream_data(transport)
         connection_close_packet = self._packetizer.packetize_connection_close_packet(self._connection_context)
-        self.send_packets(udp_socket=udp_socket, packets=[connection_close_packet])
-        udp_socket.close()
-        self._connection_context.connected = False
-        self.state = CLOSED
+        self.send_packets(transport=transport, packets=[connection_close_packet])
+        transport.close()
+        self.on_closed()
 
 
-    def respond_to_connection_termination(self, udp_socket: socket):
-        udp_socket.close()
+    def respond_to_connection_termination(self, transport: DatagramTransport):
+        transport.close()
+        self.on_closed()
+
+
+    def on_closed(self) -> None:
+        if self.state == CONNECTED:
+            CONNECTIONS_ACTIVE.dec()
+        self.leave_accept_queue() # A listener closed in the middle of a handshake.
         self._connection_context.connected = False
         self.state = CLOSED
+        self.update_memory_usage()
+
+
+    def get_memory_usage(self) -> int:
+        if self.state == CLOSED:
+            return 0 # The buffers of a closed connection are never used again.
+        return self.send_buffer_size + self.receive_buffer_size
+
+
+    def update_memory_usage(self) -> None:
+        # Charges the change in the bytes held by the streams since the last call to the memory budget.
+        change = self.get_memory_usage() - self.memory_charged
+        if change:
+            self.memory_budget.charge(change)
+            BUFFERED_BYTES.inc(change)
+            self.memory_charged += change
+
+
+    def buffer_packets(self, packets: list[Packet]) -> None:
+        # Packets that can't be processed yet are kept until the handshake gets further, up to a limit.
+        room = MAX_BUFFERED_PACKETS - len(self.buffered_packets)
+        self.buffered_packets += packets[:max(0, room)]
+        self.buffered_packets_dropped += max(0, len(packets) - room)
 
 
     def is_client_handshake_complete(self) -> bool:
@@ -315,6 +483,26 @@ class QUICNetworkController:
     # def is_server_handshake_complete(self) -> bool:
     #     return self.client_handshake_received and self.client_initial_received
 
+    def set_tracer(self, tracer) -> None:
+        # The sender side controller traces the packets it sends and its congestion control events.
+        if tracer is not None:
+            tracer.start("server" if self.is_server else "client")
+        self.tracer = tracer
+        self._sender_side_controller.tracer = tracer
+
+
+    def set_profiler(self, profiler) -> None:
+        # The stages are only timed while a profiler is set, None turns profiling off.
+        self.profiler = profiler
+        self._sender_side_controller.profiler = profiler
+
+
+    def set_clock(self, clock) -> None:
+        # Every timestamp, RTT sample and timer of the connection is taken from clock, a function returning seconds.
+        self.clock = clock
+        self._sender_side_controller.set_clock(clock)
+
+
     def set_buffered_packets(self, buffered_packets: list):
         self.buffered_packets = buffered_packets
     
@@ -368,117 +556,598 @@ class QUICNetworkController:
 
 
     def create_stream(self, stream_id: int) -> None:
-        self._receive_streams[stream_id] = ReceiveStream(stream_id=stream_id)
-        self._send_streams[stream_id] = SendStream(stream_id=stream_id)
+        # Unidirectional streams only have a send side on the endpoint that opened them
+        # and a receive side on the other endpoint.
+        local = self.is_local_stream(stream_id)
+        if not is_unidirectional(stream_id) or not local:
+            self._receive_streams[stream_id] = ReceiveStream(stream_id=stream_id)
+        if not is_unidirectional(stream_id) or local:
+            self._send_streams[stream_id] = SendStream(stream_id=stream_id)
+        self.get_stream_limit(stream_id).on_opened(get_stream_index(stream_id))
+
+
+    def open_stream(self, unidirectional: bool = False) -> int:
+        """
+            Opens the next stream of the given type and returns its stream ID.
+        """
+        limit: StreamLimit = self.local_stream_limits[unidirectional]
+        if limit.get_available() == 0:
+            raise StreamError(f"The peer does not allow more than {limit.max_streams} {'unidirectional' if unidirectional else 'bidirectional'} streams.")
+        stream_id = make_stream_id(limit.opened, self.is_server, unidirectional)
+        self.create_stream(stream_id)
+        return stream_id
+
+
+    def close_stream(self, stream_id: int, transport: DatagramTransport) -> None:
+        # Ends the send side of the stream by sending a FIN at its final offset.
+        stream: SendStream = self._send_streams.get(stream_id)
+        if stream is None:
+            raise StreamError(f"Stream {stream_id} is not open for sending.")
+        if stream.fin_offset is not None:
+            return
+        stream.close()
+        if not stream.has_pending_data():
+            self.send_fin(stream, transport)
+
+
+    def send_fin(self, stream: SendStream, transport: DatagramTransport) -> None:
+        frames = [StreamFrame(stream_id=stream.stream_id, offset=stream.fin_offset, fin=True)]
+        packet = self._packetizer.packetize_control_frames(frames, self._connection_context)
+        self.pending_retransmissions += self.send_packets([packet], transport)
+
+
+    def open_peer_stream(self, stream_id: int) -> ReceiveStream or None:
+        # Called for the first frame of a stream we don't have. Returns None if the frame
+        # must be ignored: it belongs to a stream that was closed, to one of our own streams
+        # or to a stream over the limit we gave the peer.
+        if self.is_local_stream(stream_id):
+            return None
+        limit: StreamLimit = self.get_stream_limit(stream_id)
+        index = get_stream_index(stream_id)
+        if limit.is_closed(index):
+            return None
+        if index >= limit.max_streams:
+            self.stream_limit_violations += 1
+            return None
+        self.create_stream(stream_id)
+        self.new_peer_streams.append(stream_id)
+        return self._receive_streams[stream_id]
+
+
+    def accept_stream(self, transport: DatagramTransport) -> int or None:
+        self.poll_packets(transport)
+        if not self.new_peer_streams:
+            return None
+        return self.new_peer_streams.pop(0)
+
+
+    def maybe_remove_stream(self, stream_id: int, transport: DatagramTransport) -> None:
+        # Streams are forgotten once both sides are finished, closing a peer stream lets the peer open another one.
+        send_stream: SendStream = self._send_streams.get(stream_id)
+        receive_stream: ReceiveStream = self._receive_streams.get(stream_id)
+        if send_stream is None and receive_stream is None:
+            return
+        if send_stream is not None and not send_stream.is_finished():
+            return
+        if receive_stream is not None and not receive_stream.is_finished():
+            return
+        self._send_streams.pop(stream_id, None)
+        self._receive_streams.pop(stream_id, None)
+        limit: StreamLimit = self.get_stream_limit(stream_id)
+        limit.on_closed(get_stream_index(stream_id))
+        if not self.is_local_stream(stream_id) and limit.should_update():
+            frames = [MaxStreamsFrame(maximum_streams=limit.update(), unidirectional=is_unidirectional(stream_id))]
+            packet = self._packetizer.packetize_control_frames(frames, self._connection_context)
+            self.pending_retransmissions += self.send_packets([packet], transport)
+
+
+    def is_local_stream(self, stream_id: int) -> bool:
+        return is_server_initiated(stream_id) == self.is_server
+
 
+    def get_stream_limit(self, stream_id: int) -> StreamLimit:
+        limits = self.local_stream_limits if self.is_local_stream(stream_id) else self.peer_stream_limits
+        return limits[is_unidirectional(stream_id)]
 
-    def listen(self, udp_socket: socket):
+
+    def is_stream_closed(self, stream_id: int) -> bool:
+        return self.get_stream_limit(stream_id).is_closed(get_stream_index(stream_id))
+
+
+    def get_stream_status(self, stream_id: int) -> bool:
+        # True when no more data will arrive on the stream: the peer closed the connection,
+        # or the peer finished the stream and all of its data has been read.
+        if self.peer_issued_connection_closed:
+            return True
+        stream: ReceiveStream = self._receive_streams.get(stream_id)
+        if stream is not None:
+            return stream.is_finished()
+        return self.is_stream_closed(stream_id)
+
+
+    def listen(self, transport: DatagramTransport):
         # When a socket is listening, we need to bind it to the wildcard
         # address so that it doesn't associate itself with incoming connections.
         self.state = LISTENING_INITIAL
-        udp_socket.bind(("", self._connection_context.get_local_port()))
+        transport.listen(self._connection_context.get_local_port())
 
 
-    def create_connection(self, udp_socket: socket, server_address: tuple[str, int]):
+    def create_connection(self, transport: DatagramTransport, server_address: tuple[str, int]):
         
         if self.state != DISCONNECTED:
             print("Socket must be DISCONNECTED to create a connection.")
             exit(1)
 
         # ---- UPDATE 5-TUPLE ----
-        udp_socket.connect(server_address)
+        transport.connect(server_address)
 
         # ---- INITIALIZE CONNECTION CONTEXT ----
         self._connection_context.set_peer_address(server_address)
         self._connection_context.set_peer_connection_id(create_connection_id())
 
         # ---- PACKETIZE INITIAL PACKET ----
+        self.handshake_start_time = self.clock()
         initial = self._packetizer.packetize_initial_packet(self._connection_context)
-        self.send_packets([initial], udp_socket)
+        self.send_packets([initial], transport)
         self.state = INITIALIZING
 
         # ---- PROCESSING RESPONSE ----
         while not self.is_client_handshake_complete():
-            packets = self.receive_new_packets(udp_socket, self._encryption_context)
-            self.process_packets(packets, udp_socket)
+            packets = self.receive_new_packets(transport, self._encryption_context)
+            self.process_packets(packets, transport)
         
         # ---- Connection Complete ----
         self.state = CONNECTED
+        self.on_connected()
         self.create_stream(1)
 
 
-    def accept_connection(self, udp_socket: socket) -> ConnectionContext:
+    def accept_connection(self, transport: DatagramTransport) -> ConnectionContext:
         if self.state != LISTENING_INITIAL:
             print("Must be in LISTENING state to accept()")
             exit(1)
-        while not self.handshake_complete:
-            if self.new_socket:
-                packets = self.receive_new_packets(self.new_socket, self._encryption_context)
-                self.process_packets(packets, self.new_socket)
-            else:
-                packets = self.receive_new_packets(udp_socket, self._encryption_context)
-                self.process_packets(packets, udp_socket)
+        try:
+            while not self.handshake_complete:
+                if self.new_transport:
+                    packets = self.receive_new_packets(self.new_transport, self._encryption_context)
+                    self.process_packets(packets, self.new_transport)
+                else:
+                    packets = self.receive_new_packets(transport, self._encryption_context)
+                    self.process_packets(packets, transport)
+        except BaseException:
+            # accept was interrupted, the connection being handshaked is given up.
+            self.leave_accept_queue()
+            raise
         self.state = CONNECTED
+        self.on_connected()
         return self
 
 
-    def send_stream_data(self, stream_id: int, data: bytes, udp_socket: socket) -> bool:
+    def on_connected(self) -> None:
+        self._connection_context.set_connected(True)
+        self.handshake_duration = self.clock() - self.handshake_start_time
+        HANDSHAKES.inc()
+        HANDSHAKE_TIME.observe(self.handshake_duration)
+        CONNECTIONS_ACTIVE.inc()
+        self.leave_accept_queue()
+
+
+    def leave_accept_queue(self) -> None:
+        if self.accept_pending:
+            self.accept_pending = False
+            ACCEPT_QUEUE_DEPTH.dec()
+
+
+    def send_stream_data(self, stream_id: int, data: bytes, transport: DatagramTransport, block: bool = None) -> bool:
+        """
+            Queues data on the stream. Unless the stream has a send buffer (see set_send_buffer) or block
+            is True, this returns once all of the data has been packetized. With a send buffer it returns
+            straight away and the data is sent in the background whenever packets are processed, or
+            BlockingIOError is raised if the buffer is already at its high water mark.
+        """
         # Check for new packets to process and process them.
-        packets_to_process = self.receive_new_packets(udp_socket, self._encryption_context)
-        self.process_packets(packets_to_process, udp_socket)
+        self.poll_packets(transport)
 
         # If the connection has been closed, we return -1.
         if self.peer_issued_connection_closed:
             return False
 
-        # Packetize the stream data.
-        packets: list[Packet] = self._packetizer.packetize_stream_data(stream_id, data, self._connection_context, self._send_streams)
-        # Add the currently buffered packets to the list of packets to send.
-
-        could_not_send: list[Packet] = self.send_packets(packets, udp_socket)
-        while could_not_send:
-            # Reprocess packets that could not be sent.
-            packets_to_process = self.receive_new_packets(udp_socket, self._encryption_context)
-            self.process_packets(packets_to_process, udp_socket)
-            could_not_send = self.send_packets(could_not_send, udp_socket)        
+        send_stream: SendStream = self._send_streams.get(stream_id)
+        if send_stream is None:
+            raise StreamError(f"Stream {stream_id} is not open for sending.")
+        if send_stream.fin_offset is not None:
+            raise StreamError(f"Stream {stream_id} has been closed.")
+        if block is None:
+            block = send_stream.high_water_mark is None
+        if block:
+            self.queue_stream_data(send_stream, data)
+            self.schedule_stream(send_stream)
+            # The data is sent in the order the scheduler picks, so more urgent streams
+            # go first, and we return once all of the data has been packetized.
+            return self.flush_stream_data(transport, [stream_id])
+        if not send_stream.is_writable():
+            send_stream.notify_writable = True
+            raise BlockingIOError(f"The send buffer of stream {stream_id} is full.")
+        if self.memory_budget.is_exhausted():
+            # on_writable is called once acknowledgements free some of this connection's buffers.
+            send_stream.notify_writable = True
+            raise BlockingIOError("The memory budget is used up.")
+        # The caller may reuse its buffer once we return, so anything mutable is copied.
+        self.queue_stream_data(send_stream, data if isinstance(data, bytes) else bytes(data))
+        self.schedule_stream(send_stream)
+        self.send_scheduled_data(transport)
+        if not send_stream.is_writable():
+            send_stream.notify_writable = True
         return True
 
 
-    def send_packets(self, packets: list[Packet], udp_socket: socket) -> list[Packet]:
+    def queue_stream_data(self, send_stream: SendStream, data: bytes) -> None:
+        pending_size = send_stream.pending_size
+        send_stream.queue(data)
+        self.send_buffer_size += send_stream.pending_size - pending_size
+        self.update_memory_usage()
+
+
+    def flush_stream_data(self, transport: DatagramTransport, stream_ids: list[int] = None) -> bool:
+        """
+            Blocks until the pending data of the given streams (or of every stream) has been packetized.
+            Returns False if the peer closed the connection first.
+        """
+        if stream_ids is None:
+            stream_ids = list(self._send_streams)
+        streams: list[SendStream] = [self._send_streams[stream_id] for stream_id in stream_ids if stream_id in self._send_streams]
+        while True:
+            self.send_scheduled_data(transport)
+            streams = [stream for stream in streams if stream.has_pending_data()]
+            if not streams:
+                return True
+            blocked = [stream for stream in streams if self.is_stream_blocked(stream)]
+            for stream in blocked:
+                # Let the peer know we are blocked by flow control.
+                self.send_blocked_frames(stream.stream_id, transport)
+            if len(blocked) == len(streams):
+                # Wait for a window update.
+                self.wait_for_packets(transport, self.get_wait_timeout())
+            else:
+                # Sleep until the pacer allows the next packet or an ACK arrives.
+                self.wait_for_packets(transport, self._sender_side_controller.time_until_send(SAFE_DATAGRAM_PAYLOAD_SIZE))
+            if self.peer_issued_connection_closed:
+                return False
+
+
+    def detach_stream_data(self, stream_id: int) -> None:
+        """
+            Stops the data of the stream that hasn't been sent yet from referencing the buffer it
+            was sent from, so that the caller can release the buffer, e.g. a mapped file. The data
+            is copied, or dropped if the peer has closed the connection and it will never be sent.
+        """
+        copy = not self.peer_issued_connection_closed
+        send_stream: SendStream = self._send_streams.get(stream_id)
+        if send_stream is not None:
+            self.send_buffer_size -= send_stream.detach_pending(copy)
+            self.update_memory_usage()
+        # Packets held back by congestion control or the pacer are built from the same views, they hold a packet's worth at most.
+        for packet in self.pending_retransmissions:
+            for frame in packet.frames:
+                if frame.type == FT_STREAM and isinstance(frame.data, memoryview):
+                    frame.data = bytes(frame.data)
+
+
+    def set_send_buffer(self, stream_id: int, high_water_mark: int or None, on_writable=None) -> None:
+        send_stream: SendStream = self._send_streams.get(stream_id)
+        if send_stream is None:
+            raise StreamError(f"Stream {stream_id} is not open for sending.")
+        send_stream.high_water_mark = high_water_mark
+        send_stream.on_writable = on_writable
+
+
+    def is_stream_writable(self, stream_id: int) -> bool:
+        send_stream: SendStream = self._send_streams.get(stream_id)
+        return send_stream is not None and send_stream.fin_offset is None and send_stream.is_writable() and not self.memory_budget.is_exhausted()
+
+
+    def schedule_stream(self, send_stream: SendStream) -> None:
+        if send_stream.has_pending_data():
+            self.scheduler.schedule(send_stream.stream_id, send_stream.urgency, send_stream.incremental)
+            self.notify_reactor()
+
+
+    def notify_reactor(self) -> None:
+        # Lets the reactor know that an application thread has changed what the connection's timers depend on.
+        if self.reactor is not None and not self.reactor.is_reactor_thread():
+            self.reactor.poke(self)
+
+
+    def set_stream_priority(self, stream_id: int, urgency: int, incremental: bool) -> None:
+        send_stream: SendStream = self._send_streams.get(stream_id)
+        if send_stream is None:
+            raise StreamError(f"Stream {stream_id} is not open for sending.")
+        send_stream.set_priority(urgency, incremental)
+        if self.scheduler.is_scheduled(stream_id):
+            self.scheduler.schedule(stream_id, urgency, incremental)
+
+
+    def is_stream_blocked(self, send_stream: SendStream) -> bool:
+        return send_stream.credit.get_available() == 0 or self.send_credit.get_available() == 0
+
+
+    def send_scheduled_data(self, transport: DatagramTransport) -> None:
+        # Lost data and held back packets go before new data. New packets are only built once
+        # congestion control and the pacer allow a full packet, so the scheduler picks the
+        # data for each packet at the time it can actually be sent.
+        # Everything sent here goes to the transport in one send_batch call.
+        batching = self._sender_side_controller.start_batch(transport)
+        try:
+            self.send_pending_retransmissions(transport)
+            profiler = self.profiler
+            while not self.pending_retransmissions and not self.streams_with_lost_data and self.can_send_packet(SAFE_DATAGRAM_PAYLOAD_SIZE):
+                if profiler is not None:
+                    profiler.enter("packetize")
+                packet = self._packetizer.packetize_scheduled_data(self.scheduler, self._connection_context, self._send_streams, self.send_credit)
+                if profiler is not None:
+                    profiler.exit("packetize")
+                if packet is None:
+                    break
+                self.pending_retransmissions += self.send_packets([packet], transport)
+        finally:
+            if batching:
+                self.end_batch()
+
+
+    def can_send_packet(self, size: int) -> bool:
+        return self._sender_side_controller.can_send() and self._sender_side_controller.pacer.can_send(size)
+
+
+    def send_blocked_frames(self, stream_id: int, transport: DatagramTransport) -> None:
+        frames = []
+        stream_credit: SendCredit = self._send_streams[stream_id].credit
+        if stream_credit.should_send_blocked():
+            frames.append(StreamDataBlockedFrame(stream_id=stream_id, maximum_stream_data=stream_credit.max_data))
+        if self.send_credit.should_send_blocked():
+            frames.append(DataBlockedFrame(maximum_data=self.send_credit.max_data))
+        if frames:
+            packet = self._packetizer.packetize_control_frames(frames, self._connection_context)
+            self.pending_retransmissions += self.send_packets([packet], transport)
+
+
+    def on_stream_data_consumed(self, stream_id: int, transport: DatagramTransport) -> None:
+        # Credits the data the application has read from the stream back to the peer.
+        self.update_memory_usage()
+        stream: ReceiveStream = self._receive_streams.get(stream_id)
+        if stream is None:
+            return
+        consumed = stream.read_offset - stream.window.consumed
+        if consumed > 0:
+            stream.window.on_data_consumed(consumed)
+            self.receive_window.on_data_consumed(consumed)
+        if stream.is_finished():
+            # No more data will arrive on the stream, so only the connection window needs updating.
+            self.send_window_updates(transport)
+            self.maybe_remove_stream(stream_id, transport)
+        else:
+            self.send_window_updates(transport, stream_id)
+
+
+    def send_window_updates(self, transport: DatagramTransport, stream_id: int = None) -> None:
+        now = self.clock()
+        rtt = self._sender_side_controller.smoothed_rtt or INITIAL_RTT
+        # When memory is short the windows stop growing and shrink, so the peer is given less new credit.
+        grow = not self.memory_budget.is_under_pressure()
+        if not grow:
+            self.receive_window.shrink()
+        frames = []
+        if stream_id is not None:
+            stream_window: ReceiveWindow = self._receive_streams[stream_id].window
+            if not grow:
+                stream_window.shrink()
+            if stream_window.should_update():
+                frames.append(MaxStreamDataFrame(stream_id=stream_id, maximum_stream_data=stream_window.update(now, rtt, grow)))
+                if grow:
+                    self.receive_window.ensure_window(stream_window.window * CONNECTION_WINDOW_MULTIPLIER)
+        if self.receive_window.should_update():
+            frames.append(MaxDataFrame(maximum_data=self.receive_window.update(now, rtt, grow)))
+        if frames:
+            packet = self._packetizer.packetize_control_frames(frames, self._connection_context)
+            self.pending_retransmissions += self.send_packets([packet], transport)
+
+
+    def poll_packets(self, transport: DatagramTransport) -> None:
+        # Processes the packets that have arrived and runs the loss detection timer.
+        # When a reactor services the connection it has already done this in its own thread.
+        if self.reactor is not None:
+            return
+        packets: list[Packet] = self.receive_new_packets(transport, self._encryption_context)
+        batching = self._sender_side_controller.start_batch(transport)
+        try:
+            self.process_packets(packets, transport)
+            self.on_loss_detection_timeout(transport)
+        finally:
+            if batching:
+                self.end_batch()
+
+
+    def wait_for_packets(self, transport: DatagramTransport, timeout: float) -> None:
+        # Blocks until packets arrive or the timeout passes, then processes them. With a reactor
+        # the lock is released while waiting and the reactor wakes us up once it has processed packets.
+        if self.reactor is not None:
+            self.condition.wait(timeout)
+            return
+        if timeout > 0:
+            transport.wait_readable(timeout)
+        self.poll_packets(transport)
+
+
+    def service(self, transport: DatagramTransport) -> None:
+        """
+            Called by the reactor, with the lock held, when the transport is readable or the deadline from
+            get_service_deadline has passed. Processes packets (which sends the ACKs for them), runs the
+            loss detection timer, sends the data the pacer now allows and wakes up waiting application threads.
+        """
+        packets: list[Packet] = self.receive_new_packets(transport, self._encryption_context)
+        # The ACKs, data and probes sent in response go to the transport in one send_batch call.
+        batching = self._sender_side_controller.start_batch(transport)
+        try:
+            self.process_packets(packets, transport)
+            self.on_loss_detection_timeout(transport)
+        finally:
+            if batching:
+                self.end_batch()
+        self.condition.notify_all()
+
+
+    def end_batch(self) -> None:
+        # Sends the datagrams held back since start_batch.
+        try:
+            self._sender_side_controller.send_batch(self._connection_context.get_peer_address())
+        except ConnectionRefusedError:
+            pass
+
+
+    def get_service_deadline(self) -> float or None:
+        # The time at which the connection needs servicing even if no packets arrive: when the
+        # loss detection timer fires, or when the pacer allows data that is waiting to be sent.
+        deadlines = []
+        loss_deadline = self._sender_side_controller.get_loss_detection_deadline()
+        if loss_deadline:
+            deadlines.append(loss_deadline)
+        if (self.scheduler.scheduled or self.pending_retransmissions or self.streams_with_lost_data) and self._sender_side_controller.can_send():
+            deadlines.append(self.clock() + self._sender_side_controller.pacer.time_until_send(SAFE_DATAGRAM_PAYLOAD_SIZE))
+        return min(deadlines) if deadlines else None
+
+
+    def get_stats(self) -> ConnectionStats:
+        sc = self._sender_side_controller
+        stats = ConnectionStats()
+        stats.state = self.state
+        stats.packets_sent = sc.total_packets_sent
+        stats.bytes_sent = sc.total_bytes_sent
+        stats.packets_received = self.packets_received
+        stats.bytes_received = self.bytes_received
+        stats.packets_retransmitted = self.packets_retransmitted
+        stats.probes_sent = sc.probes_sent
+        stats.packets_lost = sc.packets_declared_lost
+        stats.spurious_losses = sc.spurious_losses
+        stats.congestion_window = sc.congestion_window
+        stats.slow_start_threshold = sc.slow_start_threshold
+        stats.bytes_in_flight = sc.bytes_in_flight
+        stats.smoothed_rtt = sc.smoothed_rtt
+        stats.min_rtt = sc.min_rtt
+        stats.latest_rtt = sc.latest_rtt
+        stats.pacing_rate = sc.get_pacing_rate()
+        stats.ack_ranges = self._packetizer.ack_ranges
+        stats.ack_packet_numbers = len(self.unacked_packet_numbers_received)
+        stats.send_buffer_size = self.send_buffer_size
+        stats.receive_buffer_size = self.receive_buffer_size
+        stats.memory_used = self.send_buffer_size + self.receive_buffer_size
+        stats.buffered_packets = len(self.buffered_packets)
+        stats.send_streams = len(self._send_streams)
+        stats.receive_streams = len(self._receive_streams)
+        stats.handshake_duration = self.handshake_duration
+        return stats
+
+
+    def get_stream_stats(self, stream_id: int) -> tuple[int, int]:
+        # The bytes held in the send and receive buffers of the stream.
+        send_stream: SendStream = self._send_streams.get(stream_id)
+        receive_stream: ReceiveStream = self._receive_streams.get(stream_id)
+        if send_stream is None and receive_stream is None:
+            raise StreamError(f"Stream {stream_id} does not exist.")
+        return (send_stream.get_send_buffer_size() if send_stream else 0,
+                receive_stream.get_buffered_bytes() if receive_stream else 0)
+
+
+    def send_packets(self, packets: list[Packet], transport: DatagramTransport) -> list[Packet]:
         could_not_send: list[Packet] = []
         for packet in packets:
-            log.debug(f"Sent: \n{packet}")
             if self.is_ack_eliciting(packet):
                 # If the packet is ack eliciting,
-                # then send it with congestion control.
-                if self._sender_side_controller.can_send():
+                # then send it with congestion control and pacing.
+                # Once a packet has been held back the rest are held back as well to keep them in order.
+                # The packet is only serialized once the congestion window has room, and sent with the same bytes.
+                raw = self._sender_side_controller.serialize(packet) if not could_not_send and self._sender_side_controller.can_send() else None
+                if raw is not None and self._sender_side_controller.pacer.can_send(len(raw)):
                     # bytes in flight < congestion window
                     try:
-                        self._sender_side_controller.send_packet_cc(packet, udp_socket, self._connection_context, self._encryption_context)
+                        self._sender_side_controller.send_packet_cc(packet, transport, self._connection_context, self._encryption_context, raw)
                     except ConnectionRefusedError:
                         pass
+                    self.notify_reactor()
                 else:
-                    # bytes in flight >= congestion window
-                    # Need to wait to receive more acks before continuing to send.
+                    # bytes in flight >= congestion window, or the pacer has run out of tokens.
+                    # Need to wait to receive more acks or for the pacer before continuing to send.
                     could_not_send.append(packet)
             else:
                 # This is an Ack, Padding, or ConnectionClose packet,
                 try:
-                    self._sender_side_controller.send_non_ack_eliciting_packet(packet, udp_socket, self._connection_context, self._encryption_context)
+                    self._sender_side_controller.send_non_ack_eliciting_packet(packet, transport, self._connection_context, self._encryption_context)
                 except ConnectionRefusedError:
                     pass
         return could_not_send
 
 
-    def read_stream_data(self, stream_id: int, num_bytes: int, udp_socket: socket) -> tuple[bytes, bool]:
+    def read_stream_data(self, stream_id: int, num_bytes: int, transport: DatagramTransport) -> tuple[bytes, bool]:
         """
         """
         # Receive and process new packets.
-        packets: list[Packet] = self.receive_new_packets(udp_socket, self._encryption_context)
-        self.process_packets(packets, udp_socket)
+        self.poll_packets(transport)
         # Now we can read from the receive_stream.
-        data: bytes = self._receive_streams[stream_id].read(num_bytes)
-        return data, self.peer_issued_connection_closed
+        stream: ReceiveStream = self._receive_streams.get(stream_id)
+        data: bytes = stream.read(num_bytes) if stream else b""
+        self.receive_buffer_size -= len(data)
+        self.on_stream_data_consumed(stream_id, transport)
+        return data, self.get_stream_status(stream_id)
+
+
+    def read_stream_data_into(self, stream_id: int, buffer, transport: DatagramTransport) -> tuple[int, bool]:
+        # Same as read_stream_data, but copies the data into the caller's buffer.
+        self.poll_packets(transport)
+        stream: ReceiveStream = self._receive_streams.get(stream_id)
+        num_bytes: int = stream.readinto(buffer) if stream else 0
+        self.receive_buffer_size -= num_bytes
+        self.on_stream_data_consumed(stream_id, transport)
+        return num_bytes, self.get_stream_status(stream_id)
+
+
+    def read_stream_data_exactly(self, stream_id: int, buffer, transport: DatagramTransport) -> tuple[int, bool]:
+        # Blocks until the buffer is full, the peer finishes the stream or the peer closes the connection.
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        closed = False
+        while filled < len(view):
+            num_bytes, closed = self.read_stream_data_into(stream_id, view[filled:], transport)
+            filled += num_bytes
+            if closed and num_bytes == 0:
+                break
+            if num_bytes == 0:
+                self.wait_for_packets(transport, self.get_wait_timeout())
+        return filled, closed
+
+
+    def read_stream_data_to_file(self, stream_id: int, fd: int, count: int, transport: DatagramTransport) -> tuple[int, bool]:
+        # Blocks until count bytes of the stream (or everything, if count is None) have been written
+        # into the file, the peer finishes the stream or the peer closes the connection.
+        stream: ReceiveStream = self._receive_streams.get(stream_id)
+        if stream is None:
+            return 0, self.get_stream_status(stream_id)
+        # The data that was buffered is written into the file.
+        buffered_bytes = stream.get_buffered_bytes()
+        stream.attach_sink(fd, count)
+        self.receive_buffer_size += stream.get_buffered_bytes() - buffered_bytes
+        self.poll_packets(transport)
+        while True:
+            self.on_stream_data_consumed(stream_id, transport)
+            if stream.is_sink_done() or self.get_stream_status(stream_id):
+                break
+            self.wait_for_packets(transport, self.get_wait_timeout())
+        return stream.detach_sink(), self.get_stream_status(stream_id)
+
+
+    def get_wait_timeout(self) -> float:
+        # How long we can wait for a packet before the loss detection timer needs to run.
+        deadline = self._sender_side_controller.get_loss_detection_deadline()
+        if not deadline:
+            return MAX_SEND_WAIT
+        return min(MAX_SEND_WAIT, max(0.0, deadline - self.clock()))
 
 
     def is_active_stream(self, stream_id: int) -> bool:
@@ -492,9 +1161,9 @@ class QUICNetworkController:
         return False
 
 
-    def create_and_send_acknowledgements(self, udp_socket: socket) -> None:
+    def create_and_send_acknowledgements(self, transport: DatagramTransport) -> None:
         ack_pkt: Packet = self._packetizer.packetize_acknowledgement(self._connection_context, self.unacked_packet_numbers_received)
-        self.send_packets([ack_pkt], udp_socket)
+        self.send_packets([ack_pkt], transport)
 
 
     def update_largest_packet_number_received(self, packet: Packet) -> None:
@@ -502,11 +1171,22 @@ class QUICNetworkController:
 
 
     def update_received_packet_numbers(self, pkt_num: int) -> None:
-        if pkt_num not in self.unacked_packet_numbers_received:
-            self.unacked_packet_numbers_received.append(pkt_num)
+        # The packet numbers are kept sorted, packets mostly arrive in order so they are appended at the end.
+        packet_numbers = self.unacked_packet_numbers_received
+        index = bisect_left(packet_numbers, pkt_num)
+        if index == len(packet_numbers) or packet_numbers[index] != pkt_num:
+            packet_numbers.insert(index, pkt_num)
+            if len(packet_numbers) > MAX_ACK_PACKET_NUMBERS:
+                # The peer has long since declared the oldest packets we didn't acknowledge lost.
+                del packet_numbers[0]
 
 
-    def process_short_header_packet(self, packet: Packet, udp_socket: socket) -> None:
+    def forget_received_packet_numbers(self, packet_numbers: set[int]) -> None:
+        # The peer has seen an ACK for these packet numbers, so they aren't acknowledged again.
+        self.unacked_packet_numbers_received = [pn for pn in self.unacked_packet_numbers_received if pn not in packet_numbers]
+
+
+    def process_short_header_packet(self, packet: Packet, transport: DatagramTransport) -> None:
         # Processing Short Header Packet Frames:
         # 1. Stream Frame --> Write to stream or buffer data.
         # 2. Ack Frame    --> Remove from packets_sent, decrement bytes_in_flight, other congestion control stuff.
@@ -514,30 +1194,50 @@ class QUICNetworkController:
             if frame.type == FT_STREAM:
                 self.on_stream_frame_received(frame)
             if frame.type == FT_ACK:
-                self.on_ack_frame_received(frame, udp_socket)
+                self.on_ack_frame_received(frame, transport)
             if frame.type == FT_CONNECTIONCLOSE:
                 self.peer_issued_connection_closed = True
+            if frame.type == FT_MAXDATA:
+                self.send_credit.on_max_data(frame.maximum_data)
+            if frame.type in [FT_MAXSTREAMS, FT_MAXSTREAMSUNI]:
+                self.local_stream_limits[frame.unidirectional].on_max_streams(frame.maximum_streams)
+            if frame.type == FT_MAXSTREAMDATA and frame.stream_id in self._send_streams:
+                self._send_streams[frame.stream_id].credit.on_max_data(frame.maximum_stream_data)
+                # The stream was unscheduled if it was blocked.
+                self.schedule_stream(self._send_streams[frame.stream_id])
+            if frame.type == FT_DATABLOCKED:
+                self.receive_window.on_blocked()
+                self.send_window_updates(transport)
+            if frame.type == FT_STREAMDATABLOCKED and self.is_active_stream(frame.stream_id):
+                self._receive_streams[frame.stream_id].window.on_blocked()
+                self.send_window_updates(transport, frame.stream_id)
             # TODO: Add checks for other frame types i.e. StreamClose, ConnectionClose, etc.
 
 
-    def process_long_header_packet(self, packet: Packet, udp_socket: socket) -> None:
+    def process_long_header_packet(self, packet: Packet, transport: DatagramTransport) -> None:
 
         # Client has sent the HT_INITIAL packet to the server.
         # Client is waiting for the HT_INITIAL and HT_HANDSHAKE response.
         if self.get_state() == INITIALIZING:
             if packet.header.type == HT_INITIAL:
                 self.server_initial_received = True
-                self._connection_context.set_peer_address(self.last_peer_address_received) # TODO This doesn't need to be here
+                # The server answers from the transport of the new connection, which has an
+                # address of its own on transports that can't share the listening address.
+                if self.last_peer_address_received != self._connection_context.get_peer_address():
+                    transport.connect(self.last_peer_address_received)
+                self._connection_context.set_peer_address(self.last_peer_address_received)
                 self._connection_context.set_local_connection_id(packet.header.destination_connection_id)
             if packet.header.type == HT_HANDSHAKE:
-                self.server_handshake_received = True
                 if self.server_initial_received:
+                    # Only counted once it has been answered, a HANDSHAKE that overtook the INITIAL
+                    # waits in the buffer and would otherwise end the handshake without a response.
+                    self.server_handshake_received = True
                     response = self._packetizer.packetize_handshake_packet(self._connection_context)
-                    self.send_packets([response], udp_socket)
+                    self.send_packets([response], transport)
                     self._encryption_context = EncryptionContext(key=packet.frames[0].data)
                     self.state = CONNECTED
                 else:
-                    self.buffered_packets.append(packet)
+                    self.buffer_packets([packet])
                     self.state = INITIALIZING
             return
         
@@ -546,20 +1246,25 @@ class QUICNetworkController:
             # When we are listening for INITIAL packets,
             # we only care about INITIAL packets so buffer all other types.
             if packet.header.type == HT_INITIAL:
+                if self.memory_budget.is_exhausted():
+                    # The connection is refused by dropping its INITIAL packet.
+                    CONNECTIONS_REFUSED.inc()
+                    return
+                self.is_server = True
+                self.handshake_start_time = self.clock()
+                self.accept_pending = True
+                ACCEPT_QUEUE_DEPTH.inc()
                 self._connection_context.set_peer_address(self.last_peer_address_received)
                 self._connection_context.set_local_connection_id(packet.header.destination_connection_id)
                 self._connection_context.set_peer_connection_id(create_connection_id())
-                self.new_socket = socket(AF_INET, SOCK_DGRAM)
-                self.new_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-                self.new_socket.bind(self._connection_context.get_local_address())
-                self.new_socket.connect(self._connection_context.get_peer_address())
+                self.new_transport = transport.accept(self._connection_context.get_peer_address(), self._connection_context.get_local_address())
                 self.temp_encryption_context = EncryptionContext()
                 packets = self._packetizer.packetize_connection_response_packets(self._connection_context, self.temp_encryption_context)
-                self.send_packets(packets, self.new_socket)
+                self.send_packets(packets, self.new_transport)
                 # self.client_initial_received = True
                 self.state = LISTENING_HANDSHAKE
                 return
-            self.buffered_packets.append(packet)
+            self.buffer_packets([packet])
             return
 
         # Server has received the INITIAL packet from the client and has sent a response.
@@ -572,81 +1277,134 @@ class QUICNetworkController:
                 self.temp_encryption_context = None
                 self.handshake_complete = True
                 return
-            self.buffered_packets.append(packet)
+            self.buffer_packets([packet])
             return
 
 
-    def process_packets(self, packets: list[Packet], udp_socket: socket) -> None:
+    def process_packets(self, packets: list[Packet], transport: DatagramTransport) -> None:
 
         if not packets:
             return
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter("process")
 
         # We should process long header packets first.
         lh_packets = [packet for packet in packets if packet.header.type in [HT_INITIAL, HT_HANDSHAKE, HT_RETRY]]
         sh_packets = [packet for packet in packets if packet.header.type in [HT_DATA]]
 
         for packet in lh_packets:
-            self.process_long_header_packet(packet, udp_socket)
+            self.process_long_header_packet(packet, transport)
+        refused = []
         if self.state == CONNECTED:
             for packet in sh_packets:
-                self.process_short_header_packet(packet, udp_socket)
+                if self.memory_budget.is_exhausted() and self.opens_peer_stream(packet):
+                    # The packet is dropped without being acknowledged, so the
+                    # peer sends it again once it has declared it lost.
+                    STREAMS_REFUSED.inc()
+                    refused.append(packet)
+                    continue
+                self.process_short_header_packet(packet, transport)
         else:
-            self.buffered_packets += sh_packets
+            self.buffer_packets(sh_packets)
         for packet in packets:
+            if refused and any(packet is refused_packet for refused_packet in refused):
+                continue
             self.update_largest_packet_number_received(packet)
             self.update_received_packet_numbers(packet.header.packet_number)
             if self.state == CONNECTED:
                 if self.is_ack_eliciting(packet):
+                    if profiler is not None:
+                        profiler.enter("ack")
                     pkt = self._packetizer.packetize_acknowledgement(self._connection_context, self.unacked_packet_numbers_received)
-                    self.send_packets([pkt], udp_socket)
+                    if profiler is not None:
+                        profiler.exit("ack")
+                    self.send_packets([pkt], transport)
+        # ACKs and window updates may have made room to send buffered data, it is sent by
+        # on_loss_detection_timeout, which is always called next, after lost data has been found.
+        self.update_memory_usage()
+        if profiler is not None:
+            profiler.exit("process")
 
 
-    def receive_new_packets(self, udp_socket: socket, encryption_context: EncryptionContext or None, block=False):
+    def opens_peer_stream(self, packet: Packet) -> bool:
+        for frame in packet.frames:
+            if frame.type == FT_STREAM and frame.stream_id not in self._receive_streams and not self.is_local_stream(frame.stream_id) \
+                    and not self.get_stream_limit(frame.stream_id).is_closed(get_stream_index(frame.stream_id)):
+                return True
+        return False
+
+
+    def receive_new_packets(self, transport: DatagramTransport, encryption_context: EncryptionContext or None, block=False):
         packets: list[Packet] = [] + self.buffered_packets
         self.buffered_packets = []
-        datagrams: list[bytes] = []
-        udp_socket.setblocking(block)
+        datagrams: list[tuple[bytes, object]] = []
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter("recvfrom")
+        if block:
+            transport.wait_readable(None)
         while True:
-            try:
-                datagram, address = udp_socket.recvfrom(4096)
-                datagrams.append(datagram)
-            except BlockingIOError:
+            batch = transport.receive_batch(RECEIVE_BATCH)
+            datagrams += batch
+            if len(batch) < RECEIVE_BATCH:
                 break
-            except ConnectionRefusedError:
-                break
-        for datagram in datagrams:
+        if profiler is not None:
+            profiler.exit("recvfrom")
+        # Every datagram took a recvfrom call, and so did finding out that there were no more.
+        RECEIVE_CALLS.inc(len(datagrams) + 1)
+        if datagrams:
+            DATAGRAMS_RECEIVED.inc(len(datagrams))
+        for datagram, address in datagrams:
+            if profiler is not None:
+                profiler.enter("parse")
             try:
                 # if encryption_context:
                 #     packet = parse_packet_bytes(encryption_context.decrypt(datagram))
                 # else:
                 packet = parse_packet_bytes(datagram)
             except PacketParserError:
+                packet = None
+            if profiler is not None:
+                profiler.exit("parse")
+            if packet is None:
+                PARSE_ERRORS.inc()
                 continue # If a datagram fails to be parsed, just drop it.
             if packet.header.type == HT_INITIAL:
                 self.last_peer_address_received = address
-            log.debug(f"Received: \n{packet}")
+            self.packets_received += 1
+            self.bytes_received += len(datagram)
+            if self.tracer is not None:
+                self.tracer.on_packet_received(packet, len(datagram))
             packets.append(packet)
         return packets
 
 
     def on_stream_frame_received(self, frame: StreamFrame):
-        if not self.is_active_stream(frame.stream_id):
-            self.create_stream(1)
-
-        if self.is_active_stream(frame.stream_id):
-            stream = self._receive_streams[frame.stream_id]
-            if frame.offset != stream.offset:
-                stream.buffer(frame)
-            else:
-                stream.write(frame.data)
-            self._receive_streams[frame.stream_id] = stream
-        else:
-            print(f"Stream ID {frame.stream_id} does not exist.")
-            exit(1)
-
-
-    def extract_ack_frame(self, pkt: Packet) -> bool:
-        for frame in pkt.frames:
+        stream: ReceiveStream = self._receive_streams.get(frame.stream_id)
+        if stream is None:
+            stream = self.open_peer_stream(frame.stream_id)
+        if stream is not None:
+            # Data beyond the limits we advertised is dropped, so a peer that
+            # ignores flow control can't grow our buffers without bound.
+            end = frame.offset + frame.length
+            limit = min(stream.window.max_data, stream.window.received + self.receive_window.get_available())
+            if end > limit:
+                self.flow_control_violations += 1
+                end = limit
+            new_bytes = max(0, end - stream.window.received)
+            stream.window.on_data_received(new_bytes)
+            self.receive_window.on_data_received(new_bytes)
+            if end > frame.offset:
+                buffered_bytes = stream.get_buffered_bytes()
+                stream.receive(frame.offset, frame.data[:end-frame.offset])
+                self.receive_buffer_size += stream.get_buffered_bytes() - buffered_bytes
+            if frame.fin and end == frame.offset + frame.length:
+                stream.on_fin(end)
+
+
+    def extract_ack_frame(self, info: PacketSentInfo) -> AckFrame or None:
+        for frame in info.frames:
             if frame.type == FT_ACK:
                 return frame
         return None
@@ -657,40 +1415,258 @@ class QUICNetworkController:
         # and checks whether any of the packets that were acknowledged are
         # ack packets, if they are ack packets, then we remove from our list of received packets,
         # so that we don't double acknowledge packets.
+        pkt_nums_acked: set[int] = set()
         for info in packets_acked:
-            frame: AckFrame = self.extract_ack_frame(info.packet)
+            frame: AckFrame = self.extract_ack_frame(info)
             if frame:
                 # If ack ack frame was acked, we can remove the packet numbers it was acking from out received list.
-                pkt_nums_acked = [i for i in range(frame.largest_acknowledged, frame.largest_acknowledged - frame.first_ack_range - 1, -1)]
-                for pn in pkt_nums_acked:
-                    try:
-                        self.unacked_packet_numbers_received.remove(pn)
-                    except ValueError:
-                        pass
+                pkt_nums_acked.update(self.get_packet_numbers_acknowledged(frame))
+        if pkt_nums_acked:
+            # Filtered in one pass, removing them one by one is quadratic in the length of the list.
+            self.forget_received_packet_numbers(pkt_nums_acked)
 
 
-    def on_ack_frame_received(self, frame: AckFrame, udp_socket: socket):
+    def get_packet_numbers_acknowledged(self, frame: AckFrame) -> list[int]:
+        # Walks down from the largest acknowledged packet number,
+        # skipping the gap before each ack range.
+        smallest = frame.largest_acknowledged - frame.first_ack_range
+        pkt_nums_acknowledged = [i for i in range(frame.largest_acknowledged, smallest-1, -1)]
+        for ackrange in frame.ack_range:
+            range_largest = smallest - ackrange.gap - 1
+            smallest = range_largest - ackrange.ack_range_length + 1
+            pkt_nums_acknowledged += [i for i in range(range_largest, smallest-1, -1)]
+        return pkt_nums_acknowledged
+
+
+    def on_ack_frame_received(self, frame: AckFrame, transport: DatagramTransport):
 
         # Calculate packet numbers being acked.
-        pkt_nums_acknowledged = [i for i in range(frame.largest_acknowledged, frame.largest_acknowledged-frame.first_ack_range-1, -1)]
-        if frame.ack_range_count > 0:
-            pn = frame.largest_acknowledged - frame.first_ack_range - 1
-            for ackrange in frame.ack_range:
-                pn -= ackrange.gap
-                pkt_nums_acknowledged += [i for i in range(pn, pn-ackrange.ack_range_length-1, -1)]
-        
+        pkt_nums_acknowledged = self.get_packet_numbers_acknowledged(frame)
         packets_acked = self._sender_side_controller.on_packet_numbers_acked(pkt_nums_acknowledged)
         self.largest_acknowledged = max(self.largest_acknowledged, max(pkt_nums_acknowledged))
         self.remove_from_packets_received(packets_acked)
+        self.on_stream_data_acked(packets_acked, transport)
 
         # Detect and handle packet loss.
         lost_packets = self._sender_side_controller.detect_and_remove_lost_packets(self.largest_acknowledged)
         if lost_packets: # Packet loss detected.
-            retransmissions = self._packetizer.packetize_retransmissions(lost_packets) # Creates new packets
-            self.send_packets(retransmissions, udp_socket) # Retransmits packets.
+            self.on_packets_lost(lost_packets)
+            self.send_pending_retransmissions(transport) # Retransmits packets.
         # If there is no loss, then continue as normal.
 
 
+    def on_stream_data_acked(self, packets_acked: list[PacketSentInfo], transport: DatagramTransport) -> None:
+        finished = []
+        acked_streams: dict[int, SendStream] = dict()
+        for info in packets_acked:
+            for stream_id, offset, length, fin in info.stream_ranges:
+                stream: SendStream = self._send_streams.get(stream_id)
+                if stream is None:
+                    continue
+                acked_offset = stream.acked_offset
+                stream.on_range_acked(offset, offset+length)
+                self.send_buffer_size -= stream.acked_offset - acked_offset
+                acked_streams[stream_id] = stream
+                if fin:
+                    stream.fin_acked = True
+                if stream.is_finished():
+                    finished.append(stream_id)
+        for stream_id, stream in acked_streams.items():
+            # Acknowledged data leaves the send buffer, which may make room for more.
+            if stream.notify_writable and stream.is_writable() and not self.memory_budget.is_exhausted():
+                stream.notify_writable = False
+                if stream.on_writable is not None:
+                    stream.on_writable(stream_id)
+        for stream_id in finished:
+            self.maybe_remove_stream(stream_id, transport)
+
+
+    def on_packets_lost(self, lost_packets: list[PacketSentInfo]) -> None:
+        # Lost stream data is marked in its send stream and repacketized when it can be sent,
+        # other frames are packetized again straight away.
+        for info in lost_packets:
+            for stream_id, offset, length, fin in info.stream_ranges:
+                stream: SendStream = self._send_streams.get(stream_id)
+                if stream is None:
+                    continue
+                stream.on_range_lost(offset, offset+length)
+                if stream.has_lost_data():
+                    self.streams_with_lost_data[stream_id] = None
+                if fin and not stream.fin_acked:
+                    frames = [StreamFrame(stream_id=stream_id, offset=stream.fin_offset, fin=True)]
+                    self.pending_retransmissions.append(self._packetizer.packetize_control_frames(frames, self._connection_context))
+                    self.packets_retransmitted += 1
+        retransmissions = self._packetizer.packetize_retransmissions(lost_packets, self._connection_context)
+        self.packets_retransmitted += len(retransmissions)
+        self.pending_retransmissions += retransmissions
+
+
+    def send_pending_retransmissions(self, transport: DatagramTransport) -> None:
+        if self.pending_retransmissions:
+            self.pending_retransmissions = self.send_packets(self.pending_retransmissions, transport)
+        # Repacketize lost stream data into full packets for as long as we are allowed to send.
+        # Only the streams with lost data are looked at, there can be many streams.
+        lost_streams = {stream_id: self._send_streams[stream_id] for stream_id in self.streams_with_lost_data if stream_id in self._send_streams}
+        profiler = self.profiler
+        while not self.pending_retransmissions:
+            if profiler is not None:
+                profiler.enter("packetize")
+            packet = self._packetizer.packetize_stream_retransmission(self._connection_context, lost_streams)
+            if profiler is not None:
+                profiler.exit("packetize")
+            if not packet:
+                break
+            self.packets_retransmitted += 1
+            self.pending_retransmissions = self.send_packets([packet], transport)
+        self.streams_with_lost_data = {stream_id: None for stream_id, stream in lost_streams.items() if stream.has_lost_data()}
+
+
+    def on_loss_detection_timeout(self, transport: DatagramTransport) -> None:
+        # Without new ACKs, losses are only found by the loss detection timer:
+        # packets past the time threshold are retransmitted, and when nothing has been
+        # acknowledged for a probe timeout the oldest in flight packets are sent again as probes.
+        if self.state != CONNECTED:
+            return
+        lost_packets, probes = self._sender_side_controller.on_loss_detection_timeout()
+        if lost_packets:
+            self.on_packets_lost(lost_packets)
+        self.send_scheduled_data(transport)
+        if probes:
+            # Probes are sent even if the congestion window is full RFC 9002.
+            for packet in self._packetizer.packetize_probes(probes, self._connection_context, self._send_streams):
+                try:
+                    self._sender_side_controller.send_packet_cc(packet, transport, self._connection_context, self._encryption_context)
+                except ConnectionRefusedError:
+                    pass
+
+
+
+
+class HyStart:
+    """
+        HyStart++ (RFC 9406) slow start exit.
+        Slow start is divided into rounds, a round ends when the packet that was the
+        largest sent at the start of the round is acknowledged. The minimum RTT of each
+        round is compared to the minimum RTT of the previous round, when it has increased
+        by more than the RTT threshold the queue at the bottleneck is filling up and we enter
+        Conservative Slow Start (CSS). After HYSTART_CSS_ROUNDS rounds of CSS we leave slow start,
+        unless the RTT drops back below the baseline which means the increase was spurious.
+    """
+
+    def __init__(self):
+        self.window_end: int = -1
+        self.last_round_min_rtt: float = INFINITY
+        self.current_round_min_rtt: float = INFINITY
+        self.rtt_sample_count: int = 0
+        self.css_baseline_min_rtt: float = INFINITY
+        self.css_rounds: int = 0
+        self.in_css: bool = False
+        self.rounds: int = 0
+        self.css_entries: int = 0
+        self.css_spurious_exits: int = 0
+
+
+    def is_round_complete(self, largest_acknowledged: int) -> bool:
+        return largest_acknowledged > self.window_end
+
+
+    def on_round_end(self, largest_sent_packet_number: int) -> bool:
+        """
+            Starts a new round which ends once largest_sent_packet_number is acknowledged.
+            Returns True when CSS has lasted HYSTART_CSS_ROUNDS rounds and slow start should end.
+        """
+        self.rounds += 1
+        self.window_end = largest_sent_packet_number
+        self.last_round_min_rtt = self.current_round_min_rtt
+        self.current_round_min_rtt = INFINITY
+        self.rtt_sample_count = 0
+        if self.in_css:
+            self.css_rounds += 1
+            if self.css_rounds >= HYSTART_CSS_ROUNDS:
+                self.in_css = False
+                return True
+        return False
+
+
+    def on_rtt_sample(self, rtt: float) -> None:
+        self.current_round_min_rtt = min(self.current_round_min_rtt, rtt)
+        self.rtt_sample_count += 1
+        if self.rtt_sample_count < HYSTART_N_RTT_SAMPLE:
+            return
+        if not self.in_css:
+            if self.current_round_min_rtt == INFINITY or self.last_round_min_rtt == INFINITY:
+                return
+            rtt_thresh = max(HYSTART_MIN_RTT_THRESH, min(self.last_round_min_rtt / HYSTART_MIN_RTT_DIVISOR, HYSTART_MAX_RTT_THRESH))
+            if self.current_round_min_rtt >= self.last_round_min_rtt + rtt_thresh:
+                # Delay increase detected, enter Conservative Slow Start.
+                self.in_css = True
+                self.css_rounds = 0
+                self.css_baseline_min_rtt = self.current_round_min_rtt
+                self.css_entries += 1
+        elif self.current_round_min_rtt < self.css_baseline_min_rtt:
+            # RTT went back down, the increase was spurious so resume slow start.
+            self.in_css = False
+            self.css_baseline_min_rtt = INFINITY
+            self.css_spurious_exits += 1
+
+
+    def reset(self) -> None:
+        self.in_css = False
+        self.css_rounds = 0
+        self.css_baseline_min_rtt = INFINITY
+
+
+
+
+class Pacer:
+    """
+        Token bucket pacer. Tokens are bytes and refill at the pacing rate,
+        up to PACING_MAX_BURST bytes. A rate of INFINITY means there is no RTT
+        estimate yet and packets are only limited by the congestion window.
+    """
+
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.enabled: bool = True
+        self.rate: float = INFINITY # bytes per second
+        self.capacity: int = PACING_MAX_BURST
+        self.tokens: float = PACING_MAX_BURST
+        self.last_refill: float = self.clock()
+
+
+    def set_rate(self, rate: float) -> None:
+        self.refill()
+        self.rate = rate
+
+
+    def refill(self) -> None:
+        now = self.clock()
+        if self.rate == INFINITY:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+
+    def can_send(self, size: int) -> bool:
+        if not self.enabled or self.rate == INFINITY:
+            return True
+        self.refill()
+        return self.tokens >= min(size, self.capacity)
+
+
+    def on_packet_sent(self, size: int) -> None:
+        if not self.enabled or self.rate == INFINITY:
+            return
+        self.tokens -= size
+
+
+    def time_until_send(self, size: int) -> float:
+        if self.can_send(size):
+            return 0.0
+        return (min(size, self.capacity) - self.tokens) / self.rate
+
+
 
 
 class QUICSenderSideController:
@@ -705,26 +1681,115 @@ class QUICSenderSideController:
         self.packets_sent: dict[int, PacketSentInfo] = dict()
         self.congestion_recovery_start_time = 0
         self.sent_time_of_last_loss = 0
-    
+        self.largest_sent_packet_number = -1
+        self.total_packets_sent = 0
+        self.total_bytes_sent = 0
+
+        # ---- Loss Detection ----
+        self.packet_threshold: int = PACKET_THRESHOLD
+        self.time_threshold: float = TIME_THRESHOLD
+        self.lost_packets: dict[int, PacketSentInfo] = dict() # Recently declared lost packets.
+        self.packets_declared_lost: int = 0
+        self.spurious_losses: int = 0
+        self.largest_acknowledged: int = -1
+        self.loss_time: float = 0.0 # Time at which the next packet crosses the time threshold, 0 if none.
+        self.time_of_last_ack_eliciting_packet: float = 0.0
+        self.pto_count: int = 0
+        self.probes_sent: int = 0
+
+        # ---- Congestion Undo ----
+        self.loss_event: int = 0
+        self.loss_event_outstanding: int = 0 # Packets declared lost in the current loss event which haven't been acked.
+        self.prior_congestion_window: float = INITIAL_CONGESTION_WINDOW
+        self.prior_slow_start_threshold: float = INFINITY
+        self.congestion_undos: int = 0
+
+        # ---- RTT Estimation (RFC 9002) ----
+        self.latest_rtt: float = 0.0
+        self.smoothed_rtt: float = 0.0
+        self.rttvar: float = 0.0
+        self.min_rtt: float = INFINITY
+        self.rtt_samples: int = 0
+
+        # ---- HyStart++ ----
+        self.hystart = HyStart()
+        self.slow_start_exits_delay: int = 0
+        self.slow_start_exits_loss: int = 0
+
+        # ---- Pacing ----
+        self.pacer = Pacer()
+
+        # ---- Batching ----
+        self.batch: list[bytes] = None # Datagrams held back between start_batch and send_batch.
+        self.batch_transport: DatagramTransport = None
+
+        self.tracer = None
+        self.profiler = None
+        self.clock = time
+
+
+    def set_clock(self, clock) -> None:
+        self.clock = clock
+        self.pacer.clock = clock
+        self.pacer.last_refill = clock()
+
 
     def on_packet_loss(self):
         if self.in_recovery(self.sent_time_of_last_loss):
             return
+        if self.in_slow_start():
+            self.slow_start_exits_loss += 1
+            self.hystart.reset()
+        # Remember the window so that the reduction can be undone if the loss was spurious.
+        self.loss_event += 1
+        self.loss_event_outstanding = 0
+        self.prior_congestion_window = self.congestion_window
+        self.prior_slow_start_threshold = self.slow_start_threshold
         self.slow_start_threshold = self.congestion_window / 2
         self.congestion_window = max(self.slow_start_threshold, MINIMUM_CONGESTION_WINDOW)
-        self.congestion_recovery_start_time = time()
+        self.congestion_recovery_start_time = self.clock()
+        self.pacer.set_rate(self.get_pacing_rate())
+        if self.tracer is not None:
+            self.tracer.on_metrics_updated(self)
 
 
     def detect_and_remove_lost_packets(self, largest_acknowledged: int) -> list[PacketSentInfo]:
         # Detecting Loss:
         # A packet is deemed lost if it if ack-eliciting, in-flight, and was sent prior to an acknowledged packet.
         # AND
-        # The packet was sent K packets before an acknowledged packet.
+        # The packet was sent packet_threshold packets before an acknowledged packet,
+        # OR
+        # The packet was sent more than time_threshold RTTs ago (once we have an RTT estimate).
         lost_packets: list[PacketSentInfo] = []
+        self.largest_acknowledged = max(self.largest_acknowledged, largest_acknowledged)
+        self.loss_time = 0.0
+        loss_delay = INFINITY
+        lost_send_time = -INFINITY
+        if self.rtt_samples > 0:
+            loss_delay = max(self.time_threshold * max(self.smoothed_rtt, self.latest_rtt), TIMER_GRANULARITY)
+            lost_send_time = self.clock() - loss_delay
+        expired: list[int] = []
         for pkt_num in self.packets_sent:
-            packet_is_lost = pkt_num < largest_acknowledged and self.packets_sent[pkt_num].ack_eliciting and self.packets_sent[pkt_num].in_flight and (largest_acknowledged - pkt_num) >= 3
-            if packet_is_lost:                               # If the packet is deemed lost.
-                lost_packets.append(self.packets_sent[pkt_num])      # Add to lost packets list.
+            info = self.packets_sent[pkt_num]
+            if pkt_num >= largest_acknowledged:
+                continue
+            if not info.ack_eliciting or not info.in_flight:
+                # Packets that only carry ACKs aren't retransmitted and don't count toward bytes_in_flight,
+                # they are forgotten once they would have been declared lost.
+                if (largest_acknowledged - pkt_num) >= self.packet_threshold or info.time_sent <= lost_send_time:
+                    expired.append(pkt_num)
+                continue
+            if (largest_acknowledged - pkt_num) >= self.packet_threshold or info.time_sent <= lost_send_time:
+                lost_packets.append(info)      # Add to lost packets list.
+                if self.tracer is not None:
+                    trigger = "reordering_threshold" if (largest_acknowledged - pkt_num) >= self.packet_threshold else "time_threshold"
+                    self.tracer.on_packet_lost(info, trigger)
+            elif loss_delay != INFINITY:
+                # Not lost yet, remember when it will be.
+                if self.loss_time == 0.0 or info.time_sent + loss_delay < self.loss_time:
+                    self.loss_time = info.time_sent + loss_delay
+        for pkt_num in expired:
+            del self.packets_sent[pkt_num]
         if lost_packets:
             for info in lost_packets:
                 self.packets_sent.pop(info.packet_number)
@@ -732,15 +1797,110 @@ class QUICSenderSideController:
                 self.sent_time_of_last_loss = max(self.sent_time_of_last_loss, info.time_sent)
             if self.sent_time_of_last_loss != 0:
                 self.on_packet_loss()
+            for info in lost_packets:
+                self.remember_lost_packet(info, largest_acknowledged)
         return lost_packets
 
 
-    def on_packet_numbers_acked(self, packet_numbers: list[int]) -> None:
+    def remember_lost_packet(self, info: PacketSentInfo, largest_acknowledged: int) -> None:
+        # Keep the packet around for a while so that a late ACK for it can be recognized as a spurious loss.
+        info.loss_event = self.loss_event
+        info.largest_acknowledged_when_lost = largest_acknowledged
+        self.lost_packets[info.packet_number] = info
+        self.loss_event_outstanding += 1
+        self.packets_declared_lost += 1
+        if len(self.lost_packets) > LOST_PACKET_HISTORY:
+            oldest = next(iter(self.lost_packets))
+            if self.lost_packets.pop(oldest).loss_event == self.loss_event:
+                # Can no longer tell if the current loss event was spurious.
+                self.loss_event_outstanding = -1
+
+
+    def on_spurious_loss(self, info: PacketSentInfo) -> None:
+        # An ACK arrived for a packet that was declared lost, it was only reordered or delayed.
+        # Grow the reordering thresholds so the same amount of reordering isn't declared lost again.
+        self.spurious_losses += 1
+        reordering = info.largest_acknowledged_when_lost - info.packet_number + 1
+        self.packet_threshold = min(MAX_PACKET_THRESHOLD, max(self.packet_threshold, reordering))
+        rtt = max(self.smoothed_rtt, self.latest_rtt)
+        if rtt > 0:
+            self.time_threshold = min(MAX_TIME_THRESHOLD, max(self.time_threshold, (self.clock() - info.time_sent) / rtt))
+        # If every packet declared lost in the current loss event was spurious, undo the window reduction.
+        if info.loss_event == self.loss_event and self.loss_event_outstanding > 0:
+            self.loss_event_outstanding -= 1
+            if self.loss_event_outstanding == 0:
+                self.undo_congestion_event()
+
+
+    def get_probe_timeout(self) -> float:
+        # smoothed_rtt + 4*rttvar, doubled every time the probe timeout fires without an ACK.
+        if self.rtt_samples == 0:
+            pto = INITIAL_RTT + max(4 * INITIAL_RTT / 2, TIMER_GRANULARITY)
+        else:
+            pto = self.smoothed_rtt + max(4 * self.rttvar, TIMER_GRANULARITY)
+        return pto * (2 ** self.pto_count)
+
+
+    def get_loss_detection_deadline(self) -> float:
+        # Returns the time at which on_loss_detection_timeout has work to do, 0 if it has none.
+        if self.loss_time:
+            return self.loss_time
+        if self.bytes_in_flight <= 0 or not self.time_of_last_ack_eliciting_packet:
+            return 0.0
+        return self.time_of_last_ack_eliciting_packet + self.get_probe_timeout()
+
+
+    def on_loss_detection_timeout(self) -> tuple[list[PacketSentInfo], list[PacketSentInfo]]:
+        """
+            Returns the packets declared lost by the time threshold and the packets
+            that should be sent again as probes because the probe timeout expired.
+        """
+        deadline = self.get_loss_detection_deadline()
+        if not deadline or self.clock() < deadline:
+            return [], []
+        if self.loss_time:
+            return self.detect_and_remove_lost_packets(self.largest_acknowledged), []
+        self.pto_count += 1
+        probes = []
+        for pkt_num in self.packets_sent:
+            info = self.packets_sent[pkt_num]
+            if info.ack_eliciting and info.in_flight:
+                probes.append(info)
+                if len(probes) == MAX_PROBE_PACKETS:
+                    break
+        self.probes_sent += len(probes)
+        return [], probes
+
+
+    def undo_congestion_event(self) -> None:
+        self.congestion_window = max(self.congestion_window, self.prior_congestion_window)
+        self.slow_start_threshold = max(self.slow_start_threshold, self.prior_slow_start_threshold)
+        self.congestion_recovery_start_time = 0
+        self.sent_time_of_last_loss = 0
+        self.congestion_undos += 1
+        self.pacer.set_rate(self.get_pacing_rate())
+        if self.tracer is not None:
+            self.tracer.on_metrics_updated(self)
+
+
+    def on_packet_numbers_acked(self, packet_numbers: list[int]) -> list[PacketSentInfo]:
+
+        # Packets that were declared lost but are now acknowledged were lost spuriously.
+        # They are still returned so that their data is known to have arrived.
+        spurious_packets = []
+        for x in packet_numbers:
+            if x in self.lost_packets:
+                spurious_packets.append(self.lost_packets.pop(x))
+                self.on_spurious_loss(spurious_packets[-1])
 
         # We only want to process packet numbers that exist in our packets_sent list.
         packet_numbers = [x for x in packet_numbers if x in self.packets_sent]
         packets_acked = []
 
+        if packet_numbers:
+            self.on_ack_received(max(packet_numbers))
+            self.pto_count = 0
+
         for x in packet_numbers:
             if not self.packets_sent[x].in_flight:
                 # packets that aren't in flight don't count toward cwnd or bytes_in_flight.
@@ -753,8 +1913,11 @@ class QUICSenderSideController:
                 continue
             if self.in_slow_start():
                 # slow start
-                # increase congestion window by bytes acked.
-                self.congestion_window += self.packets_sent[x].sent_bytes
+                # increase congestion window by bytes acked, or a fraction of it in conservative slow start.
+                if self.hystart.in_css:
+                    self.congestion_window += self.packets_sent[x].sent_bytes / HYSTART_CSS_GROWTH_DIVISOR
+                else:
+                    self.congestion_window += self.packets_sent[x].sent_bytes
             else:
                 # congestion avoidance
                 # Additive increase, multiplicitive decrease
@@ -762,38 +1925,151 @@ class QUICSenderSideController:
             self.congestion_recovery_start_time = 0
             self.sent_time_of_last_loss = 0
             packets_acked.append(self.packets_sent.pop(x))
-        return packets_acked
+        if packet_numbers:
+            self.pacer.set_rate(self.get_pacing_rate())
+            if self.tracer is not None:
+                self.tracer.on_metrics_updated(self)
+        return packets_acked + spurious_packets
+
+
+    def get_pacing_rate(self) -> float:
+        # Bytes per second, INFINITY until the first RTT sample is taken.
+        if self.smoothed_rtt <= 0:
+            return INFINITY
+        return PACING_GAIN * self.congestion_window / self.smoothed_rtt
+
+
+    def time_until_send(self, size: int) -> float:
+        # How long a sender should wait before it can send a packet of the given size.
+        if not self.can_send():
+            return MAX_SEND_WAIT
+        return min(self.pacer.time_until_send(size), MAX_SEND_WAIT)
+
+
+    def on_ack_received(self, largest_newly_acked: int) -> None:
+        # Take an RTT sample from the largest newly acknowledged packet,
+        # then let HyStart++ decide whether slow start should end.
+        info = self.packets_sent[largest_newly_acked]
+        rtt_sample = None
+        if info.ack_eliciting:
+            rtt_sample = self.clock() - info.time_sent
+            self.update_rtt(rtt_sample)
+        if not self.in_slow_start():
+            return
+        if self.hystart.is_round_complete(largest_newly_acked):
+            if self.hystart.on_round_end(self.largest_sent_packet_number):
+                self.slow_start_threshold = self.congestion_window
+                self.slow_start_exits_delay += 1
+                return
+        if rtt_sample is not None:
+            self.hystart.on_rtt_sample(rtt_sample)
+
+
+    def update_rtt(self, latest_rtt: float) -> None:
+        RTT.observe(latest_rtt)
+        self.latest_rtt = latest_rtt
+        self.rtt_samples += 1
+        if self.rtt_samples == 1:
+            self.min_rtt = latest_rtt
+            self.smoothed_rtt = latest_rtt
+            self.rttvar = latest_rtt / 2
+            return
+        self.min_rtt = min(self.min_rtt, latest_rtt)
+        self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.smoothed_rtt - latest_rtt)
+        self.smoothed_rtt = 0.875 * self.smoothed_rtt + 0.125 * latest_rtt
 
 
     def in_recovery(self, time_last_loss: float) -> bool:
         return time_last_loss <= self.congestion_recovery_start_time
 
 
-    def send_packet_cc(self, packet: Packet, udp_socket: socket, connection_context: ConnectionContext, encryption_context: EncryptionContext or None) -> None:
+    def serialize(self, packet: Packet) -> bytes:
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter("serialize")
+        raw = packet.raw()
+        if profiler is not None:
+            profiler.exit("serialize")
+        return raw
+
+
+    def start_batch(self, transport: DatagramTransport) -> bool:
+        """
+            Holds back the datagrams sent on transport until send_batch is called, so that they are
+            handed to the transport in one send_batch call. The packets count as sent straight away.
+            Returns False, and changes nothing, if a batch has already been started.
+        """
+        if self.batch is not None:
+            return False
+        self.batch = []
+        self.batch_transport = transport
+        return True
+
+
+    def send_batch(self, address) -> None:
+        datagrams, transport = self.batch, self.batch_transport
+        self.batch = self.batch_transport = None
+        if datagrams:
+            self.transmit(datagrams, transport, address)
+
+
+    def transmit(self, datagrams: list[bytes], transport: DatagramTransport, address) -> None:
+        if transport is self.batch_transport:
+            self.batch += datagrams
+            return
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter("sendto")
+        try:
+            transport.send_batch(datagrams, address)
+        finally:
+            if profiler is not None:
+                profiler.exit("sendto")
+        SEND_BATCHES.inc()
+        DATAGRAMS_SENT.inc(len(datagrams))
+
+
+    def send_packet_cc(self, packet: Packet, transport: DatagramTransport, connection_context: ConnectionContext, encryption_context: EncryptionContext or None, raw: bytes = None) -> None:
         # Send packets based on the internal congestion control state.
+        # raw is the serialized packet if the caller already has it.
         # if encryption_context:
-        #     udp_socket.sendto(encryption_context.encrypt(packet.raw()), connection_context.get_peer_address())
+        #     transport.send(encryption_context.encrypt(packet.raw()), connection_context.get_peer_address())
         # else:
-        udp_socket.sendto(packet.raw(), connection_context.get_peer_address())
-        self.bytes_in_flight += len(packet.raw())
-        self.packets_sent[packet.header.packet_number] = PacketSentInfo(time_sent=time(), 
+        if raw is None:
+            raw = self.serialize(packet)
+        self.transmit([raw], transport, connection_context.get_peer_address())
+        self.total_packets_sent += 1
+        self.total_bytes_sent += len(raw)
+        if self.tracer is not None:
+            self.tracer.on_packet_sent(packet, len(raw))
+        self.bytes_in_flight += len(raw)
+        self.pacer.on_packet_sent(len(raw))
+        now = self.clock()
+        self.time_of_last_ack_eliciting_packet = now
+        self.largest_sent_packet_number = max(self.largest_sent_packet_number, packet.header.packet_number)
+        self.packets_sent[packet.header.packet_number] = PacketSentInfo(time_sent=now, 
                                                                     in_flight=True,
                                                                     ack_eliciting=True,
-                                                                    sent_bytes=len(packet.raw()), 
+                                                                    sent_bytes=len(raw), 
                                                                     packet_number=packet.header.packet_number,
                                                                     packet=packet)
 
 
-    def send_non_ack_eliciting_packet(self, packet: Packet, udp_socket: socket, connection_context: ConnectionContext, encryption_context: EncryptionContext or None) -> None:
+    def send_non_ack_eliciting_packet(self, packet: Packet, transport: DatagramTransport, connection_context: ConnectionContext, encryption_context: EncryptionContext or None) -> None:
         # For non-ack eliciting packets we don't care about congestion control state.
         # if encryption_context:
-        #     udp_socket.sendto(encryption_context.encrypt(packet.raw()), connection_context.get_peer_address())
+        #     transport.send(encryption_context.encrypt(packet.raw()), connection_context.get_peer_address())
         # else:
-        udp_socket.sendto(packet.raw(), connection_context.get_peer_address())
-        self.packets_sent[packet.header.packet_number] = PacketSentInfo(time_sent=time(), 
+        raw = self.serialize(packet)
+        self.transmit([raw], transport, connection_context.get_peer_address())
+        self.total_packets_sent += 1
+        self.total_bytes_sent += len(raw)
+        if self.tracer is not None:
+            self.tracer.on_packet_sent(packet, len(raw))
+        self.packets_sent[packet.header.packet_number] = PacketSentInfo(time_sent=self.clock(), 
                                                                     in_flight=False,
                                                                     ack_eliciting=False,
-                                                                    sent_bytes=len(packet.raw()), 
+                                                                    sent_bytes=len(raw), 
                                                                     packet_number=packet.header.packet_number,
                                                                     packet=packet)
 
@@ -802,6 +2078,12 @@ class QUICSenderSideController:
         return self.bytes_in_flight < self.congestion_window
 
 
+    def get_congestion_state(self) -> int:
+        if self.congestion_recovery_start_time:
+            return RECOVERY
+        return SLOW_START if self.in_slow_start() else CONGESTION_AVOIDANCE
+
+
     def in_slow_start(self) -> bool:
         return self.congestion_window < self.slow_start_threshold
 
@@ -13,6 +13,7 @@ MAX_LONG = 18446744073709551615   # 8 bytes max - Use Q in struct.pack
 MAX_INT = 4294967295              # 4 bytes max - Use I in struct.pack
 MAX_SHORT = 65535                 # 2 bytes max - Use H in struct.pack
 MAX_CHAR = 255                    # 1 byte max  - Use B in struct.pack
+MAX_VARINT = 4611686018427387903  # 2^62-1, the largest variable length integer.
 
 HT_INITIAL = 0xC0 # 11000000
 HT_0RTT = 0xD0 # 11010000
@@ -23,11 +24,14 @@ HT_DATA = 0x40 # 0100 0000
 LONG_HEADER_SIZE = 19 # num bytes
 SHORT_HEADER_SIZE = 9 # num bytes
 
-STREAM_FRAME_SIZE = 12 # Not including stream data.
+STREAM_FRAME_SIZE = 19 # Not including stream data, with the largest (8 byte) stream ID.
 CRYPTO_FRAME_SIZE = 11 # Not including crypto data.
 ACK_FRAME_SIZE = 17    # Not including the ack range field.
 ACK_RANGE_SIZE = 8     # Size of a single ack range.
 CONNECTION_CLOSE_FRAME_SIZE = 3
+MAX_DATA_FRAME_SIZE = 9
+DATA_BLOCKED_FRAME_SIZE = 9
+MAX_STREAMS_FRAME_SIZE = 9
 
 QUIC_VERSION = 0x01
 CONN_ID_LEN = 0x04
@@ -42,9 +46,11 @@ FT_RESETSTREAM = 0x04
 FT_STOPSENDING = 0x05
 FT_CRYPTO = 0x06
 FT_STREAM = 0x08
+FT_STREAMFIN = 0x09 # Stream frame with the FIN bit set.
 FT_MAXDATA = 0x10
 FT_MAXSTREAMDATA = 0x11
 FT_MAXSTREAMS = 0x12
+FT_MAXSTREAMSUNI = 0x13
 FT_DATABLOCKED = 0x14
 FT_STREAMDATABLOCKED = 0x15
 FT_STREAMSBLOCKED = 0x16
@@ -66,6 +72,7 @@ STR_STREAM = "STREAM"
 STR_MAXDATA = "MAXDATA"
 STR_MAXSTREAMDATA = "MAXSTREAMDATA"
 STR_MAXSTREAMS = "MAXSTREAMS"
+STR_MAXSTREAMSUNI = "MAXSTREAMSUNI"
 STR_DATABLOCKED = "DATABBLOCKED"
 STR_STREAMDATABLOCKED = "STREAMDATABLOCKED"
 STR_STREAMSBLOCKED = "STREAMSBLOCKED"
@@ -112,6 +119,54 @@ def check_char_type(var_name: str, var: int) -> None:
     return None
 
 
+def check_varint_type(var_name: str, var: int) -> None:
+    if var < 0:
+        raise InvalidArgumentException(f"Variable '{var_name}' cannot be negative. '{var_name}' value: {var}")
+    if var > MAX_VARINT:
+        raise InvalidArgumentException(f"Variable '{var_name}' cannot be greater than {MAX_VARINT}. '{var_name}' value: {var}")
+    return None
+
+
+def encode_varint(value: int) -> bytes:
+    """
+        Encodes a variable length integer (RFC 9000 section 16), the two
+        most significant bits of the first byte hold the length of the encoding.
+    """
+    if value < 0x40:
+        return struct.pack("!B", value)
+    if value < 0x4000:
+        return struct.pack("!H", 0x4000 | value)
+    if value < 0x40000000:
+        return struct.pack("!I", 0x80000000 | value)
+    return struct.pack("!Q", 0xC000000000000000 | value)
+
+
+def get_varint_size(value: int) -> int:
+    if value < 0x40:
+        return 1
+    if value < 0x4000:
+        return 2
+    if value < 0x40000000:
+        return 4
+    return 8
+
+
+def get_stream_frame_size(stream_id: int) -> int:
+    # Size of a stream frame for the given stream, not including stream data.
+    return STREAM_FRAME_SIZE - 8 + get_varint_size(stream_id)
+
+
+def decode_varint(raw: bytes, position: int = 0) -> tuple[int, int]:
+    """
+        Decodes the variable length integer at position and returns its value and its length in bytes.
+    """
+    length = 1 << (raw[position] >> 6)
+    value = raw[position] & 0x3F
+    for i in range(position+1, position+length):
+        value = (value << 8) | raw[i]
+    return value, length
+
+
 def header_type_string_to_hex(type: str) -> int:
     if type == STR_INITIAL:
         return HT_INITIAL
@@ -153,6 +208,8 @@ def frame_type_hex_to_string(type: int) -> str:
         return STR_MAXSTREAMDATA
     if type == FT_MAXSTREAMS:
         return STR_MAXSTREAMS
+    if type == FT_MAXSTREAMSUNI:
+        return STR_MAXSTREAMSUNI
     if type == FT_DATABLOCKED:
         return STR_DATABLOCKED
     if type == FT_STREAMDATABLOCKED:
@@ -187,6 +244,8 @@ def frame_type_string_to_hex(type: str) -> int:
         return FT_MAXSTREAMDATA
     if type == STR_MAXSTREAMS:
         return FT_MAXSTREAMS
+    if type == STR_MAXSTREAMSUNI:
+        return FT_MAXSTREAMSUNI
     if type == STR_DATABLOCKED:
         return FT_DATABLOCKED
     if type == STR_STREAMDATABLOCKED:
@@ -213,10 +272,7 @@ class Packet():
         self.frames = frames
 
     def raw(self) -> bytes:
-        frame_data = b""
-        for frame in self.frames:
-            frame_data += frame.raw()
-        return self.header.raw() + frame_data
+        return self.header.raw() + b"".join([frame.raw() for frame in self.frames])
 
     def __repr__(self) -> str:
         representation = ""
@@ -388,8 +444,9 @@ class StreamFrame:
         StreamFrame format:
             Type:
                 First Byte of the frame. Identifies the frame type.
+                The FIN bit (0x01) is set on the last frame of a stream.
             Stream ID:
-                Second Byte of the frame. Identifies the stream.
+                Variable length integer (1 to 8 bytes). Identifies the stream.
             Offset:
                 The next 8 bytes are the byte offset for the data in this stream frame.
                 It needs to support large values
@@ -399,7 +456,7 @@ class StreamFrame:
                 The stream bytes to be delivered at the given offset value in the identified stream.
     """
 
-    def __init__(self, stream_id = 0, offset = 0, length = 0, data = b""):
+    def __init__(self, stream_id = 0, offset = 0, length = 0, data = b"", fin = False):
 
         if not isinstance(stream_id, int) or isinstance(stream_id, bool):
             raise TypeError("stream_id must be of type int.")
@@ -410,10 +467,11 @@ class StreamFrame:
         if not isinstance(length, int) or isinstance(length, bool):
             raise TypeError("length must be of type int.")
         
-        if not isinstance(data, bytes):
-            raise TypeError("data must be of type bytes.")
+        # memoryview lets the frame reference a slice of the sender's buffer until the packet is serialized.
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError("data must be of type bytes, bytearray or memoryview.")
 
-        check_char_type("stream_id", stream_id)
+        check_varint_type("stream_id", stream_id)
         check_long_type("offset", offset)
         check_short_type("length", length)
         
@@ -422,9 +480,11 @@ class StreamFrame:
         self.offset = offset
         self.length = length
         self.data = data
+        self.fin = fin
 
     def raw(self):
-        return struct.pack("!BBQH", self.type, self.stream_id, self.offset, self.length) + self.data
+        frame_type = FT_STREAMFIN if self.fin else self.type
+        return struct.pack("!B", frame_type) + encode_varint(self.stream_id) + struct.pack("!QH", self.offset, self.length) + self.data
 
     def __repr__(self) -> str:
         representation = ""
@@ -433,7 +493,177 @@ class StreamFrame:
         representation += f"Stream ID: {self.stream_id}\n"
         representation += f"Offset: {self.offset}\n"
         representation += f"Length: {self.length}\n"
-        representation += f"Data: {self.data}"
+        representation += f"FIN: {self.fin}\n"
+        representation += f"Data: {bytes(self.data)}"
+        return representation
+
+
+class MaxDataFrame:
+    """
+        MaxDataFrame format:
+            Type:
+                First Byte of the frame. Identifies the frame type.
+            Maximum Data:
+                The next 8 bytes are the maximum amount of data (summed over all streams)
+                that can be sent on the connection.
+    """
+
+    def __init__(self, maximum_data=0):
+
+        if not isinstance(maximum_data, int) or isinstance(maximum_data, bool):
+            raise TypeError("maximum_data must be of type int.")
+
+        check_long_type("maximum_data", maximum_data)
+
+        self.type = FT_MAXDATA
+        self.maximum_data = maximum_data
+
+    def raw(self):
+        return struct.pack("!BQ", self.type, self.maximum_data)
+
+    def __repr__(self) -> str:
+        representation = ""
+        representation += "------ FRAME ------\n"
+        representation += f"Type: {frame_type_hex_to_string(self.type)}\n"
+        representation += f"Maximum Data: {self.maximum_data}"
+        return representation
+
+
+class MaxStreamDataFrame:
+    """
+        MaxStreamDataFrame format:
+            Type:
+                First Byte of the frame. Identifies the frame type.
+            Stream ID:
+                Variable length integer (1 to 8 bytes). Identifies the stream.
+            Maximum Stream Data:
+                The next 8 bytes are the largest stream offset that can be sent on the stream.
+    """
+
+    def __init__(self, stream_id=0, maximum_stream_data=0):
+
+        if not isinstance(stream_id, int) or isinstance(stream_id, bool):
+            raise TypeError("stream_id must be of type int.")
+
+        if not isinstance(maximum_stream_data, int) or isinstance(maximum_stream_data, bool):
+            raise TypeError("maximum_stream_data must be of type int.")
+
+        check_varint_type("stream_id", stream_id)
+        check_long_type("maximum_stream_data", maximum_stream_data)
+
+        self.type = FT_MAXSTREAMDATA
+        self.stream_id = stream_id
+        self.maximum_stream_data = maximum_stream_data
+
+    def raw(self):
+        return struct.pack("!B", self.type) + encode_varint(self.stream_id) + struct.pack("!Q", self.maximum_stream_data)
+
+    def __repr__(self) -> str:
+        representation = ""
+        representation += "------ FRAME ------\n"
+        representation += f"Type: {frame_type_hex_to_string(self.type)}\n"
+        representation += f"Stream ID: {self.stream_id}\n"
+        representation += f"Maximum Stream Data: {self.maximum_stream_data}"
+        return representation
+
+
+class DataBlockedFrame:
+    """
+        DataBlockedFrame format:
+            Type:
+                First Byte of the frame. Identifies the frame type.
+            Maximum Data:
+                The next 8 bytes are the connection level limit at which the sender is blocked.
+    """
+
+    def __init__(self, maximum_data=0):
+
+        if not isinstance(maximum_data, int) or isinstance(maximum_data, bool):
+            raise TypeError("maximum_data must be of type int.")
+
+        check_long_type("maximum_data", maximum_data)
+
+        self.type = FT_DATABLOCKED
+        self.maximum_data = maximum_data
+
+    def raw(self):
+        return struct.pack("!BQ", self.type, self.maximum_data)
+
+    def __repr__(self) -> str:
+        representation = ""
+        representation += "------ FRAME ------\n"
+        representation += f"Type: {frame_type_hex_to_string(self.type)}\n"
+        representation += f"Maximum Data: {self.maximum_data}"
+        return representation
+
+
+class StreamDataBlockedFrame:
+    """
+        StreamDataBlockedFrame format:
+            Type:
+                First Byte of the frame. Identifies the frame type.
+            Stream ID:
+                Variable length integer (1 to 8 bytes). Identifies the stream.
+            Maximum Stream Data:
+                The next 8 bytes are the stream offset at which the sender is blocked.
+    """
+
+    def __init__(self, stream_id=0, maximum_stream_data=0):
+
+        if not isinstance(stream_id, int) or isinstance(stream_id, bool):
+            raise TypeError("stream_id must be of type int.")
+
+        if not isinstance(maximum_stream_data, int) or isinstance(maximum_stream_data, bool):
+            raise TypeError("maximum_stream_data must be of type int.")
+
+        check_varint_type("stream_id", stream_id)
+        check_long_type("maximum_stream_data", maximum_stream_data)
+
+        self.type = FT_STREAMDATABLOCKED
+        self.stream_id = stream_id
+        self.maximum_stream_data = maximum_stream_data
+
+    def raw(self):
+        return struct.pack("!B", self.type) + encode_varint(self.stream_id) + struct.pack("!Q", self.maximum_stream_data)
+
+    def __repr__(self) -> str:
+        representation = ""
+        representation += "------ FRAME ------\n"
+        representation += f"Type: {frame_type_hex_to_string(self.type)}\n"
+        representation += f"Stream ID: {self.stream_id}\n"
+        representation += f"Maximum Stream Data: {self.maximum_stream_data}"
+        return representation
+
+
+class MaxStreamsFrame:
+    """
+        MaxStreamsFrame format:
+            Type:
+                First Byte of the frame. Identifies the frame type,
+                FT_MAXSTREAMS for bidirectional streams and FT_MAXSTREAMSUNI for unidirectional streams.
+            Maximum Streams:
+                The next 8 bytes are the number of streams of that type the peer is allowed to open.
+    """
+
+    def __init__(self, maximum_streams=0, unidirectional=False):
+
+        if not isinstance(maximum_streams, int) or isinstance(maximum_streams, bool):
+            raise TypeError("maximum_streams must be of type int.")
+
+        check_long_type("maximum_streams", maximum_streams)
+
+        self.type = FT_MAXSTREAMSUNI if unidirectional else FT_MAXSTREAMS
+        self.maximum_streams = maximum_streams
+        self.unidirectional = unidirectional
+
+    def raw(self):
+        return struct.pack("!BQ", self.type, self.maximum_streams)
+
+    def __repr__(self) -> str:
+        representation = ""
+        representation += "------ FRAME ------\n"
+        representation += f"Type: {frame_type_hex_to_string(self.type)}\n"
+        representation += f"Maximum Streams: {self.maximum_streams}"
         return representation
 
 
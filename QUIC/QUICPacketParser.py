@@ -27,11 +27,13 @@ def parse_short_header(raw: bytes) -> ShortHeader:
 
 
 def parse_stream_frame(raw: bytes):
-    field_data = raw[0:STREAM_FRAME_SIZE]
-    fields = struct.unpack("!BBQH", field_data)
-    stream_data_len = fields[3]
-    stream_data = raw[STREAM_FRAME_SIZE:STREAM_FRAME_SIZE+stream_data_len]
-    return StreamFrame(stream_id=fields[1], offset=fields[2], length=fields[3], data=stream_data)
+    stream_id, id_length = decode_varint(raw, 1)
+    header_size = 1 + id_length + 10
+    offset, stream_data_len = struct.unpack("!QH", raw[1+id_length:header_size])
+    if header_size + stream_data_len > len(raw):
+        raise PacketParserError(f"Stream frame of {stream_data_len} bytes is longer than the {len(raw) - header_size} bytes left in the packet.")
+    stream_data = raw[header_size:header_size+stream_data_len]
+    return StreamFrame(stream_id=stream_id, offset=offset, length=stream_data_len, data=stream_data, fin=raw[0] == FT_STREAMFIN)
 
 
 def parse_ack_range(raw: bytes):
@@ -66,6 +68,48 @@ def parse_connection_close_frame(raw: bytes):
     return ConnectionCloseFrame(error_code=fields[1], reason_phrase_len=fields[2], reason_phrase=reason_phrase_data)
 
 
+def parse_max_data_frame(raw: bytes):
+    fields = struct.unpack("!BQ", raw[0:MAX_DATA_FRAME_SIZE])
+    return MaxDataFrame(maximum_data=fields[1])
+
+
+def parse_max_stream_data_frame(raw: bytes):
+    stream_id, id_length = decode_varint(raw, 1)
+    maximum_stream_data = struct.unpack("!Q", raw[1+id_length:9+id_length])[0]
+    return MaxStreamDataFrame(stream_id=stream_id, maximum_stream_data=maximum_stream_data)
+
+
+def parse_data_blocked_frame(raw: bytes):
+    fields = struct.unpack("!BQ", raw[0:DATA_BLOCKED_FRAME_SIZE])
+    return DataBlockedFrame(maximum_data=fields[1])
+
+
+def parse_stream_data_blocked_frame(raw: bytes):
+    stream_id, id_length = decode_varint(raw, 1)
+    maximum_stream_data = struct.unpack("!Q", raw[1+id_length:9+id_length])[0]
+    return StreamDataBlockedFrame(stream_id=stream_id, maximum_stream_data=maximum_stream_data)
+
+
+def parse_max_streams_frame(raw: bytes):
+    fields = struct.unpack("!BQ", raw[0:MAX_STREAMS_FRAME_SIZE])
+    return MaxStreamsFrame(maximum_streams=fields[1], unidirectional=fields[0] == FT_MAXSTREAMSUNI)
+
+
+FRAME_PARSERS = {
+    FT_STREAM: parse_stream_frame,
+    FT_STREAMFIN: parse_stream_frame,
+    FT_ACK: parse_ack_frame,
+    FT_CRYPTO: parse_crypto_frame,
+    FT_CONNECTIONCLOSE: parse_connection_close_frame,
+    FT_MAXDATA: parse_max_data_frame,
+    FT_MAXSTREAMDATA: parse_max_stream_data_frame,
+    FT_DATABLOCKED: parse_data_blocked_frame,
+    FT_STREAMDATABLOCKED: parse_stream_data_blocked_frame,
+    FT_MAXSTREAMS: parse_max_streams_frame,
+    FT_MAXSTREAMSUNI: parse_max_streams_frame,
+}
+
+
 def parse_frames(raw: bytes):
 
     # If we receive 0 bytes then return an empty list of frames.
@@ -76,33 +120,28 @@ def parse_frames(raw: bytes):
     bytes_to_process = raw
     while bytes_to_process:
         frame_type = struct.unpack("!B", bytes_to_process[0:1])[0]
-        if frame_type == FT_STREAM:
-            f = parse_stream_frame(bytes_to_process)
-            bytes_to_process = bytes_to_process[len(f.raw()):]
-            frames.append(f)
-            continue
-        if frame_type == FT_ACK:
-            f = parse_ack_frame(bytes_to_process)
-            bytes_to_process = bytes_to_process[len(f.raw()):]
-            frames.append(f)
-            continue
-        if frame_type == FT_CRYPTO:
-            f = parse_crypto_frame(bytes_to_process)
-            bytes_to_process = bytes_to_process[len(f.raw()):]
-            frames.append(f)
-            continue
-        if frame_type == FT_CONNECTIONCLOSE:
-            f = parse_connection_close_frame(bytes_to_process)
-            bytes_to_process = bytes_to_process[len(f.raw()):]
-            frames.append(f)
-            continue
+        if frame_type not in FRAME_PARSERS:
+            # We can't know where an unknown frame ends, so the packet can't be parsed.
+            raise PacketParserError
+        f = FRAME_PARSERS[frame_type](bytes_to_process)
+        bytes_to_process = bytes_to_process[len(f.raw()):]
+        frames.append(f)
     return frames
 
 
 def parse_packet_bytes(raw: bytes) -> Packet:
     """
-        TODO: docstring
+        Parses a datagram into a packet. Raises PacketParserError if the datagram isn't a
+        packet, has frames of an unknown type or is cut short.
     """
+    try:
+        return parse_packet(raw)
+    except (struct.error, IndexError, ValueError, InvalidArgumentException) as e:
+        # Truncated headers and frames run out of bytes in the middle of a field.
+        raise PacketParserError(f"Malformed packet: {e}") from e
+
+
+def parse_packet(raw: bytes) -> Packet:
     first_byte = raw[0:1]
     header_type = struct.unpack("!B", first_byte)
     if header_type[0] not in [HT_INITIAL, HT_HANDSHAKE, HT_RETRY, HT_DATA]:
@@ -0,0 +1,106 @@
+"""
+    This module contains the StageProfiler, which measures how much time the
+    receive and send pipelines of a connection spend in each of their stages
+    (recvfrom, parsing, processing, ACK generation, packetization, sendto).
+    Connections aren't profiled unless a profiler is given to their socket.
+"""
+
+from threading import local, Lock
+from time import perf_counter_ns
+
+
+class StageProfiler:
+    """
+        Records the number of calls, the total time and the self time (the total time minus the time
+        spent in the stages called from it) of every stage, in nanoseconds. Stages nest, and the self
+        time of every stack of stages is kept as well so that it can be drawn as a flame graph.
+        A profiler can be shared by several connections: like the metrics, every thread records its
+        stages in tables of its own, which are merged when they are read.
+    """
+
+    def __init__(self):
+        self._local = local()
+        self._shards: list[tuple[dict, dict]] = [] # The (stages, stacks) tables of every thread.
+        self._lock = Lock()
+
+    def get_shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            # stack, stages (stage -> [calls, total ns, self ns]) and stacks (stages from the outermost, separated by ";" -> self ns).
+            shard = self._local.shard = ([], dict(), dict())
+            with self._lock:
+                self._shards.append(shard[1:])
+            return shard
+
+    @property
+    def stages(self) -> dict[str, list[int]]:
+        # Key: stage | Value: [calls, total ns, self ns]
+        stages = dict()
+        for shard_stages, shard_stacks in self.get_shards():
+            for stage, totals in list(shard_stages.items()):
+                merged = stages.setdefault(stage, [0, 0, 0])
+                for i in range(3):
+                    merged[i] += totals[i]
+        return stages
+
+    @property
+    def stacks(self) -> dict[str, int]:
+        # Key: stages from the outermost, separated by ";" | Value: self ns
+        stacks = dict()
+        for shard_stages, shard_stacks in self.get_shards():
+            for path, self_time in list(shard_stacks.items()):
+                stacks[path] = stacks.get(path, 0) + self_time
+        return stacks
+
+    def get_shards(self) -> list[tuple[dict, dict]]:
+        with self._lock:
+            return list(self._shards)
+
+    def enter(self, stage: str) -> None:
+        stack = self.get_shard()[0]
+        path = stack[-1][1] + ";" + stage if stack else stage
+        stack.append([stage, path, 0, perf_counter_ns()]) # stage, path, time spent in the stages it called, start
+
+    def exit(self, stage: str) -> None:
+        end = perf_counter_ns()
+        stack, stages, stacks = self.get_shard()
+        # Stages left without an exit because an exception was raised in them are dropped.
+        while stack and stack[-1][0] != stage:
+            stack.pop()
+        if not stack:
+            return
+        stage, path, children, start = stack.pop()
+        elapsed = end - start
+        if stack:
+            stack[-1][2] += elapsed
+        totals = stages.get(stage)
+        if totals is None:
+            totals = stages[stage] = [0, 0, 0]
+        totals[0] += 1
+        totals[1] += elapsed
+        totals[2] += elapsed - children
+        stacks[path] = stacks.get(path, 0) + elapsed - children
+
+    def reset(self) -> None:
+        for shard_stages, shard_stacks in self.get_shards():
+            shard_stages.clear()
+            shard_stacks.clear()
+
+    def get_table(self) -> str:
+        """
+            Returns a table of the stages sorted by self time.
+        """
+        stages = self.stages
+        total_self = sum([totals[2] for totals in stages.values()]) or 1
+        lines = [f"{'Stage':<16}{'Calls':>10}{'Total ms':>12}{'Self ms':>12}{'Avg us':>10}{'Self %':>8}"]
+        for stage, (calls, total, self_time) in sorted(stages.items(), key=lambda item: -item[1][2]):
+            lines.append(f"{stage:<16}{calls:>10}{total/1e6:>12.3f}{self_time/1e6:>12.3f}{total/calls/1e3:>10.2f}{100*self_time/total_self:>8.1f}")
+        return "\n".join(lines)
+
+    def get_collapsed_stacks(self) -> str:
+        """
+            Returns the self time of every stack in the collapsed format read by flamegraph.pl
+            and speedscope, one "outer;inner nanoseconds" line per stack.
+        """
+        return "\n".join([f"{path} {self_time}" for path, self_time in sorted(self.stacks.items())])
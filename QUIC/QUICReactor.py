@@ -0,0 +1,182 @@
+"""
+    This module contains the QUICReactor, a thread that services many
+    connections at once: it receives and acknowledges their packets, runs
+    their retransmission timers and sends their buffered data as the pacer
+    allows, whether or not the application is calling into the sockets.
+"""
+
+from selectors import DefaultSelector, EVENT_READ
+from socket import socketpair
+from threading import Thread, Lock, current_thread
+from time import time
+from .QUICNetworkController import QUICNetworkController, CONNECTED, CLOSED, MAX_SEND_WAIT
+from .QUICTimerWheel import TimerWheel
+
+
+class ReactorError(Exception): pass
+
+
+class QUICReactor:
+    """
+        Owns the transports of the connections registered with it. Application threads keep
+        using the QUICSocket methods, which then only read from and write to the streams under
+        the connection's lock, and block on its condition until the reactor has processed packets.
+    """
+
+    def __init__(self):
+        self._selector = DefaultSelector()
+        self._connections: dict[int, tuple[QUICNetworkController, object]] = dict() # Key: fd | Value: (controller, transport)
+        self._timers = TimerWheel(time()) # Key: fd | Deadline: time the connection needs servicing.
+        self._fds: dict[QUICNetworkController, int] = dict()
+        self._changes: list[tuple[bool, int, QUICNetworkController, object]] = [] # (register, fd, controller, transport)
+        self._poked: list[QUICNetworkController] = [] # Connections application threads have sent on.
+        self._changes_lock = Lock()
+        # Writing to the wakeup socket interrupts the select so that changes are applied straight away.
+        self._wakeup_receiver, self._wakeup_sender = socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup_receiver, EVENT_READ)
+        self._thread = Thread(target=self.run, name="QUICReactor", daemon=True)
+        self._running = False
+
+
+    def start(self) -> None:
+        self._running = True
+        self._thread.start()
+
+
+    def stop(self) -> None:
+        self._running = False
+        self.wakeup()
+        self._thread.join()
+        for fd, (controller, transport) in list(self._connections.items()):
+            with controller.lock:
+                controller.reactor = None
+        self._connections.clear()
+        self._fds.clear()
+        self._selector.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+
+
+    def register(self, quic_socket) -> None:
+        """
+            Hands a connected QUICSocket over to the reactor.
+        """
+        controller: QUICNetworkController = quic_socket._network_controller
+        transport = quic_socket.get_transport()
+        with controller.lock:
+            if controller.get_state() != CONNECTED:
+                raise ReactorError("Only connected sockets can be registered with a reactor.")
+            if controller.reactor is not None:
+                raise ReactorError("The socket is already registered with a reactor.")
+            controller.reactor = self
+        with self._changes_lock:
+            self._changes.append((True, transport.fileno(), controller, transport))
+        self.wakeup()
+
+
+    def unregister(self, quic_socket) -> None:
+        """
+            Gives the connection back to the application, which services it again in its own calls.
+        """
+        controller: QUICNetworkController = quic_socket._network_controller
+        with controller.lock:
+            if controller.reactor is not self:
+                return
+            controller.reactor = None
+        with self._changes_lock:
+            self._changes.append((False, quic_socket.get_transport().fileno(), controller, None))
+        self.wakeup()
+
+
+    def poke(self, controller: QUICNetworkController) -> None:
+        # Application threads sent packets or queued data, so the connection's timers need to be looked at again.
+        with self._changes_lock:
+            self._poked.append(controller)
+        self.wakeup()
+
+
+    def is_reactor_thread(self) -> bool:
+        return current_thread() is self._thread
+
+
+    def wakeup(self) -> None:
+        try:
+            self._wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass # A wakeup is already pending.
+
+
+    def apply_changes(self) -> None:
+        with self._changes_lock:
+            changes, self._changes = self._changes, []
+            poked, self._poked = self._poked, []
+        for register, fd, controller, transport in changes:
+            if register:
+                self._connections[fd] = (controller, transport)
+                self._fds[controller] = fd
+                self._timers.schedule(fd, 0.0) # Service it once straight away.
+                self._selector.register(fd, EVENT_READ)
+            elif fd in self._connections and self._connections[fd][0] is controller:
+                self.remove_connection(fd)
+        for controller in poked:
+            if controller in self._fds:
+                self._timers.schedule(self._fds[controller], 0.0)
+
+
+    def remove_connection(self, fd: int) -> None:
+        controller, transport = self._connections.pop(fd)
+        self._fds.pop(controller, None)
+        self._timers.cancel(fd)
+        self._selector.unregister(fd)
+
+
+    def get_timeout(self) -> float:
+        # How long select can block before the next connection needs servicing.
+        deadline = self._timers.get_next_deadline()
+        if deadline is None:
+            return MAX_SEND_WAIT
+        return min(MAX_SEND_WAIT, max(0.0, deadline - time()))
+
+
+    def run(self) -> None:
+        while self._running:
+            events = self._selector.select(self.get_timeout())
+            readable = set()
+            for key, mask in events:
+                if key.fileobj is self._wakeup_receiver:
+                    try:
+                        while self._wakeup_receiver.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    readable.add(key.fd)
+            self.apply_changes()
+            for fd in readable.union(self._timers.expire(time())):
+                if fd in self._connections:
+                    self.service_connection(fd)
+
+
+    def service_connection(self, fd: int) -> None:
+        controller, transport = self._connections[fd]
+        with controller.lock:
+            if controller.reactor is not self or controller.get_state() == CLOSED:
+                # The application closed the connection, the unregister is still queued.
+                self._timers.cancel(fd)
+                return
+            try:
+                controller.service(transport)
+            except OSError:
+                # The transport is unusable, the connection can't be serviced anymore.
+                controller.peer_issued_connection_closed = True
+                controller.condition.notify_all()
+                controller.reactor = None
+                self.remove_connection(fd)
+                return
+            deadline = controller.get_service_deadline()
+        if deadline is None:
+            self._timers.cancel(fd)
+        else:
+            self._timers.schedule(fd, deadline)
@@ -0,0 +1,72 @@
+"""
+    This module contains the StreamScheduler which decides which stream's
+    data goes into the next packet when several streams have data waiting.
+    Priorities work like HTTP/3 extensible priorities (RFC 9218): every stream
+    has an urgency and an incremental flag.
+"""
+
+from bisect import insort
+from collections import deque
+
+URGENCY_LEVELS = 8 # Urgency 0 is the most urgent and 7 the least.
+DEFAULT_URGENCY = 3
+# Streams share their urgency level round robin unless they ask to be sent one at a time.
+DEFAULT_INCREMENTAL = True
+
+
+class StreamScheduler:
+    """
+        Keeps the streams that have data to send. The next stream is taken from the most urgent
+        level that has streams. Within a level, non incremental streams are sent one at a time
+        in stream ID order, before the incremental streams, which take turns a frame at a time.
+        A stream stays scheduled until it has no more data it is allowed to send.
+    """
+
+    def __init__(self):
+        self.sequential: list[list[int]] = [[] for i in range(URGENCY_LEVELS)]
+        self.incremental: list[deque[int]] = [deque() for i in range(URGENCY_LEVELS)]
+        self.scheduled: dict[int, tuple[int, bool]] = dict() # Key: Stream ID | Value: (urgency, incremental)
+
+    def is_scheduled(self, stream_id: int) -> bool:
+        return stream_id in self.scheduled
+
+    def schedule(self, stream_id: int, urgency: int, incremental: bool) -> None:
+        if stream_id in self.scheduled:
+            if self.scheduled[stream_id] == (urgency, incremental):
+                return
+            self.unschedule(stream_id)
+        self.scheduled[stream_id] = (urgency, incremental)
+        if incremental:
+            self.incremental[urgency].append(stream_id)
+        else:
+            insort(self.sequential[urgency], stream_id)
+
+    def unschedule(self, stream_id: int) -> None:
+        if stream_id not in self.scheduled:
+            return
+        urgency, incremental = self.scheduled.pop(stream_id)
+        if incremental:
+            self.incremental[urgency].remove(stream_id)
+        else:
+            self.sequential[urgency].remove(stream_id)
+
+    def next_stream(self) -> int | None:
+        """
+            Returns the ID of the stream that should send next, or None if no stream is scheduled.
+        """
+        if not self.scheduled:
+            return None
+        for urgency in range(URGENCY_LEVELS):
+            if self.sequential[urgency]:
+                return self.sequential[urgency][0]
+            if self.incremental[urgency]:
+                return self.incremental[urgency][0]
+        return None
+
+    def on_data_sent(self, stream_id: int) -> None:
+        # An incremental stream goes to the back of its level once it has sent a frame.
+        urgency, incremental = self.scheduled[stream_id]
+        if incremental:
+            queue = self.incremental[urgency]
+            if queue[0] == stream_id:
+                queue.rotate(-1)
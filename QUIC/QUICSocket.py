@@ -1,53 +1,185 @@
-from socket import socket, AF_INET, SOCK_DGRAM, SO_REUSEADDR, SOL_SOCKET
-from .QUICNetworkController import QUICNetworkController, LISTENING_INITIAL
+from mmap import mmap, ACCESS_READ, ALLOCATIONGRANULARITY
+import os
+from time import perf_counter
+from .QUICNetworkController import QUICNetworkController, LISTENING_INITIAL, CONNECTED
+from .QUICMetrics import SEND_TIME, RECV_TIME
+from .QUICTransport import DatagramTransport, UDPTransport
 
 
 class QUICSocket:
 
-    def __init__(self, local_ip: str):
-        self._socket = socket(AF_INET, SOCK_DGRAM)
-        self._socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    def __init__(self, local_ip: str, transport: DatagramTransport = None):
+        # The connection sends and receives on a UDP socket unless it is given another transport,
+        # e.g. a UnixTransport to reach a service on the same host, or a QueueTransport in tests.
+        self._transport = transport if transport is not None else UDPTransport()
         self._network_controller = QUICNetworkController()
         self._network_controller._connection_context.set_local_ip(local_ip)
 
 
     def connect(self, address: tuple[str, int]):
-        self._network_controller.create_connection(self._socket, address)
+        self._network_controller.create_connection(self._transport, address)
 
 
     def listen(self, port=8000):
+        # port is the UDP port, or what the transport listens on instead, e.g. the path of a UnixTransport.
+        # Accepted connections get their own transports.
         self._network_controller._connection_context.set_local_port(port)
         self._network_controller._connection_context.update_local_address()
-        self._network_controller.listen(self._socket)
+        self._network_controller.listen(self._transport)
 
 
     def accept(self):
 
-        # We give the network controller our wildcard socket.
-        # socket, connection_context, encryption_context, buffered_packets, recv_streams, send_streams, state, packetizer = self._network_controller.accept_connection(self._socket)
-        network_con: QUICNetworkController = self._network_controller.accept_connection(self._socket)
-        connection = QUICSocket("")
-        connection._socket = network_con.new_socket
+        # We give the network controller our listening transport.
+        try:
+            network_con: QUICNetworkController = self._network_controller.accept_connection(self._transport)
+        except BaseException:
+            # The handshake in progress is given up and the listener starts over with the next INITIAL.
+            self.reset_listener(self._network_controller)
+            raise
+        connection = QUICSocket("", network_con.new_transport)
         connection._network_controller = network_con
         connection._network_controller.create_stream(1)
 
         # When the above call is complete, the network controller's connection context will be filled out.
         # We just need  to copy it's QUICPacketizer and ConnectionContext into a new socket and then return it.
+        self.reset_listener(network_con)
+        return connection
+
+
+    def reset_listener(self, network_con: QUICNetworkController):
+        # Gives the listener a new network controller on the address of network_con, which no longer listens.
+        network_con.leave_accept_queue()
+        if network_con.new_transport is not None and network_con.state != CONNECTED:
+            network_con.new_transport.close()
         self._network_controller = QUICNetworkController()
         self._network_controller._connection_context.set_local_ip(network_con._connection_context.get_local_ip())
         self._network_controller._connection_context.set_local_port(network_con._connection_context.get_local_port())
         self._network_controller._connection_context.update_local_address()
         # Set network controller back to listening state.
         self._network_controller.state = LISTENING_INITIAL
-        return connection
 
 
     def send(self, stream_id: int, data: bytes) -> int:
-        return self._network_controller.send_stream_data(stream_id, data, self.get_udp_socket())
+        """
+            Sends data on a stream. Blocks until the data has been packetized, unless the stream
+            has a send buffer (see set_send_buffer). Returns False if the peer closed the connection.
+        """
+        start = perf_counter()
+        try:
+            with self._network_controller.lock:
+                return self._network_controller.send_stream_data(stream_id, data, self.get_transport())
+        finally:
+            SEND_TIME.observe(perf_counter() - start)
+
+
+    def set_send_buffer(self, stream_id: int, high_water_mark: int or None, on_writable=None):
+        """
+            Makes send return as soon as the data is buffered. The data is then sent whenever this
+            socket processes packets, e.g. during recv calls, as ACKs open the congestion window.
+            Once the buffered bytes (unsent plus unacknowledged) reach high_water_mark, send raises
+            BlockingIOError and on_writable(stream_id) is called when there is room again.
+            A high_water_mark of None makes send block again.
+        """
+        with self._network_controller.lock:
+            self._network_controller.set_send_buffer(stream_id, high_water_mark, on_writable)
+
+
+    def is_writable(self, stream_id: int) -> bool:
+        with self._network_controller.lock:
+            return self._network_controller.is_stream_writable(stream_id)
+
+
+    def flush(self, stream_id: int = None) -> bool:
+        """
+            Blocks until the buffered data of the stream (or of every stream) has been packetized.
+        """
+        stream_ids = None if stream_id is None else [stream_id]
+        with self._network_controller.lock:
+            return self._network_controller.flush_stream_data(self.get_transport(), stream_ids)
+
+
+    def send_file(self, stream_id: int, file, offset: int = 0, count: int = None) -> int:
+        """
+            Sends count bytes of a file starting at offset (or the rest of the file if count is None).
+            file can be a path or an open file descriptor. The file is memory mapped and packetized
+            straight from the mapping, so it is never read into memory as a whole. This always
+            blocks until the data has been packetized, even if the stream has a send buffer.
+        """
+        opened = not isinstance(file, int)
+        fd = os.open(file, os.O_RDONLY) if opened else file
+        try:
+            size = os.fstat(fd).st_size
+            if count is None:
+                count = size - offset
+            count = max(0, min(count, size - offset))
+            if count == 0:
+                with self._network_controller.lock:
+                    return self._network_controller.send_stream_data(stream_id, b"", self.get_transport(), block=True)
+            # Only the part of the file that is sent is mapped, a mapping starts at a multiple of the allocation granularity.
+            start = offset - offset % ALLOCATIONGRANULARITY
+            with mmap(fd, offset - start + count, access=ACCESS_READ, offset=start) as mapping:
+                with memoryview(mapping) as view, view[offset-start:] as data, self._network_controller.lock:
+                    try:
+                        return self._network_controller.send_stream_data(stream_id, data, self.get_transport(), block=True)
+                    finally:
+                        # If the peer closed the connection or sending failed, some of the data may still be
+                        # pending, it must not reference the mapping once it is closed.
+                        self._network_controller.detach_stream_data(stream_id)
+        finally:
+            if opened:
+                os.close(fd)
+
+
+    def recv_to_file(self, stream_id: int, fd: int, count: int = None) -> tuple[int, bool]:
+        """
+            Writes the stream data into the open file descriptor fd as it arrives, each frame
+            is written at its position in the stream so nothing is held in the receive buffer.
+            Blocks until count bytes have been written (or until the stream ends if count is None).
+            Returns the number of bytes written and whether the stream has ended, as recv does.
+        """
+        with self._network_controller.lock:
+            return self._network_controller.read_stream_data_to_file(stream_id, fd, count, self.get_transport())
 
 
     def recv(self, stream_id: int, num_bytes: int) -> tuple[bytes, bool]:
-        return self._network_controller.read_stream_data(stream_id, num_bytes, self.get_udp_socket())
+        """
+            Reads up to num_bytes from the stream. Also returns True once no more data
+            will arrive, i.e. the peer finished the stream or closed the connection.
+        """
+        start = perf_counter()
+        try:
+            with self._network_controller.lock:
+                return self._network_controller.read_stream_data(stream_id, num_bytes, self.get_transport())
+        finally:
+            RECV_TIME.observe(perf_counter() - start)
+
+
+    def recv_into(self, stream_id: int, buffer) -> tuple[int, bool]:
+        """
+            Like recv, but copies the received data into buffer (a bytearray, memoryview or
+            other writable buffer) instead of returning a new bytes object.
+            Returns the number of bytes copied and whether the stream has ended, as recv does.
+        """
+        start = perf_counter()
+        try:
+            with self._network_controller.lock:
+                return self._network_controller.read_stream_data_into(stream_id, buffer, self.get_transport())
+        finally:
+            RECV_TIME.observe(perf_counter() - start)
+
+
+    def recv_exactly(self, stream_id: int, buffer) -> tuple[int, bool]:
+        """
+            Blocks until buffer has been filled with stream data. Returns the number of
+            bytes copied, which is less than len(buffer) only if the stream ended first.
+        """
+        start = perf_counter()
+        try:
+            with self._network_controller.lock:
+                return self._network_controller.read_stream_data_exactly(stream_id, buffer, self.get_transport())
+        finally:
+            RECV_TIME.observe(perf_counter() - start)
 
 
     def close(self):
@@ -55,33 +187,103 @@ class QUICSocket:
             Issues a ConnectionClose frame to the peer and closes the connection.
             Used to inform the peer that you want to close the connection.
         """
-        self._network_controller.initiate_connection_termination(self.get_udp_socket())
+        self.leave_reactor()
+        with self._network_controller.lock:
+            self._network_controller.initiate_connection_termination(self.get_transport())
 
     def release(self):
         """
             Closes the connection without sending a ConnectionClose frame to the peer.
             Used to close a connection when a peer has issued a ConnectionClose frame.
         """
-        self._network_controller.respond_to_connection_termination(self.get_udp_socket())
+        self.leave_reactor()
+        with self._network_controller.lock:
+            self._network_controller.respond_to_connection_termination(self.get_transport())
 
     def close_stream(self, stream_id: int):
-        pass
+        """
+            Closes the sending side of a stream, the peer sees the end of the stream
+            once it has read all of the data sent before this call.
+        """
+        with self._network_controller.lock:
+            self._network_controller.close_stream(stream_id, self.get_transport())
+
+    def create_stream(self, unidirectional: bool = False) -> int:
+        """
+            Opens a new bidirectional (or unidirectional, send only) stream and returns its stream ID.
+            Stream IDs follow RFC 9000, the lowest bit is set on streams opened by the server and
+            the second bit on unidirectional streams. Stream 1 is open on every connection.
+        """
+        with self._network_controller.lock:
+            return self._network_controller.open_stream(unidirectional)
+
+    def set_priority(self, stream_id: int, urgency: int, incremental: bool = True):
+        """
+            Sets the priority of the data sent on a stream, like HTTP/3 extensible priorities.
+            urgency goes from 0 (most urgent) to 7, streams default to 3. The data of more urgent
+            streams is always sent first. Incremental streams of the same urgency share the
+            connection round robin, non incremental ones are sent one after the other.
+        """
+        with self._network_controller.lock:
+            self._network_controller.set_stream_priority(stream_id, urgency, incremental)
+
+    def accept_stream(self) -> int | None:
+        """
+            Returns the ID of the next stream opened by the peer, or None if there isn't one.
+        """
+        with self._network_controller.lock:
+            return self._network_controller.accept_stream(self.get_transport())
+
+    def set_tracer(self, tracer):
+        """
+            Records the events of the connection in a qlog file, e.g. set_tracer(QLogTracer("client.sqlog")).
+            Set it on a client socket before connect or on a socket returned by accept, and close
+            the tracer once the connection is closed. None stops tracing.
+        """
+        with self._network_controller.lock:
+            self._network_controller.set_tracer(tracer)
+
+    def set_profiler(self, profiler):
+        """
+            Times the stages of the connection's receive and send pipelines with a StageProfiler,
+            e.g. set_profiler(StageProfiler()). None stops profiling.
+        """
+        with self._network_controller.lock:
+            self._network_controller.set_profiler(profiler)
 
-    def create_stream(self, stream_id: int):
-        pass
+    def leave_reactor(self):
+        # The connection is serviced by the application's own calls again, e.g. before it is closed.
+        if self._network_controller.reactor is not None:
+            self._network_controller.reactor.unregister(self)
 
     def get_connection_state(self):
-        return self._network_controller.get_connection_state()
+        return self._network_controller.get_connection_context()
+
+    def get_stats(self):
+        """
+            Returns a ConnectionStats snapshot of the connection: packets and bytes sent and received,
+            retransmissions and losses, the congestion window, RTT and pacing rate, the ACK ranges
+            being tracked, the bytes held in the stream buffers and how long the handshake took.
+        """
+        with self._network_controller.lock:
+            return self._network_controller.get_stats()
+
+    def get_stream_stats(self, stream_id: int) -> tuple[int, int]:
+        """
+            Returns the number of bytes held in the send and receive buffers of the stream.
+        """
+        with self._network_controller.lock:
+            return self._network_controller.get_stream_stats(stream_id)
 
-    def get_udp_socket(self):
-        return self._socket
+    def get_transport(self) -> DatagramTransport:
+        return self._transport
 
-    def set_udp_socket(self, new_socket: socket):
-        self._socket = new_socket
+    def set_transport(self, transport: DatagramTransport):
+        self._transport = transport
 
 
     def __repr__(self) -> str:
-        connection_context = self._network_controller.get_connection_state()
+        connection_context = self.get_connection_state()
         representation = ""
         representation += f"------ QUIC Socket ------\n"
         representation += f"Connection Status: {'Connected' if connection_context.is_connected() else 'Not Connected'}\n"
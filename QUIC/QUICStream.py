@@ -0,0 +1,424 @@
+"""
+    This module contains the SendStream and ReceiveStream classes
+    which hold the data of a single QUIC stream, and the helpers
+    used to track byte ranges within a stream and to build stream IDs.
+"""
+from bisect import bisect_left
+from collections import deque
+from math import inf
+from os import pwrite
+from .QUICPacket import *
+from .QUICFlowControl import SendCredit, ReceiveWindow, INITIAL_MAX_STREAM_DATA, MAX_STREAM_WINDOW
+from .QUICScheduler import URGENCY_LEVELS, DEFAULT_URGENCY, DEFAULT_INCREMENTAL
+
+
+# The two least significant bits of a stream ID identify the type of the stream (RFC 9000 section 2.1).
+STREAM_SERVER_INITIATED = 0x01
+STREAM_UNIDIRECTIONAL = 0x02
+
+
+class StreamError(Exception): pass
+
+
+def is_server_initiated(stream_id: int) -> bool:
+    return (stream_id & STREAM_SERVER_INITIATED) != 0
+
+
+def is_unidirectional(stream_id: int) -> bool:
+    return (stream_id & STREAM_UNIDIRECTIONAL) != 0
+
+
+def get_stream_index(stream_id: int) -> int:
+    # Streams of each type are numbered 0, 1, 2, ... in the order they are opened.
+    return stream_id >> 2
+
+
+def make_stream_id(index: int, server_initiated: bool, unidirectional: bool) -> int:
+    stream_id = index << 2
+    if server_initiated:
+        stream_id |= STREAM_SERVER_INITIATED
+    if unidirectional:
+        stream_id |= STREAM_UNIDIRECTIONAL
+    return stream_id
+
+
+def add_range(ranges: list[tuple[int, int]], start: int, end: int) -> None:
+    """
+        Adds the byte range [start, end) to a sorted list of disjoint ranges,
+        merging it with any ranges it overlaps or touches.
+    """
+    if start >= end:
+        return
+    i = bisect_left(ranges, (start, start))
+    if i > 0 and ranges[i-1][1] >= start:
+        i -= 1
+    j = i
+    while j < len(ranges) and ranges[j][0] <= end:
+        start = min(start, ranges[j][0])
+        end = max(end, ranges[j][1])
+        j += 1
+    ranges[i:j] = [(start, end)]
+
+
+def remove_range(ranges: list[tuple[int, int]], start: int, end: int) -> None:
+    """
+        Removes the byte range [start, end) from a sorted list of disjoint ranges,
+        splitting any range that only partially overlaps it.
+    """
+    if start >= end:
+        return
+    i = bisect_left(ranges, (start, start))
+    if i > 0 and ranges[i-1][1] > start:
+        i -= 1
+    j = i
+    remaining = []
+    while j < len(ranges) and ranges[j][0] < end:
+        s, e = ranges[j]
+        if s < start:
+            remaining.append((s, start))
+        if e > end:
+            remaining.append((end, e))
+        j += 1
+    ranges[i:j] = remaining
+
+
+def missing_ranges(ranges: list[tuple[int, int]], start: int, end: int) -> list[tuple[int, int]]:
+    """
+        Returns the parts of the byte range [start, end) that are not
+        covered by a sorted list of disjoint ranges.
+    """
+    pieces = [(start, end)]
+    i = bisect_left(ranges, (start, start))
+    if i > 0:
+        i -= 1
+    while i < len(ranges) and ranges[i][0] < end:
+        remove_range(pieces, ranges[i][0], ranges[i][1])
+        i += 1
+    return pieces
+
+
+class SendStream:
+    """
+        Holds the data written to a stream until the peer has acknowledged it.
+        The buffer holds the bytes from acked_offset up to offset, everything below
+        acked_offset has been acknowledged and dropped. acked_ranges are acknowledged
+        byte ranges above acked_offset and lost_ranges are the byte ranges that
+        need to be retransmitted. fin_offset is set once the stream has been closed.
+        Data the application has sent but that hasn't been packetized yet waits in pending,
+        urgency and incremental decide when the scheduler lets the stream send it.
+        When high_water_mark is set, sends don't wait for the data to be packetized and
+        on_writable is called once the buffered data drops below the high water mark again.
+    """
+
+    __slots__ = ("stream_id", "offset", "acked_offset", "buffer", "acked_ranges", "lost_ranges", "credit", "fin_offset", "fin_acked",
+                 "pending", "pending_size", "urgency", "incremental", "high_water_mark", "on_writable", "notify_writable")
+
+    def __init__(self, stream_id: int):
+        self.stream_id = stream_id
+        self.offset = 0
+        self.acked_offset = 0
+        self.buffer = bytearray()
+        self.acked_ranges: list[tuple[int, int]] = []
+        self.lost_ranges: list[tuple[int, int]] = []
+        self.credit = SendCredit(INITIAL_MAX_STREAM_DATA) # Stream level flow control limit set by the peer.
+        self.fin_offset: int = None
+        self.fin_acked = False
+        self.pending: deque[memoryview] = deque()
+        self.pending_size = 0
+        self.urgency = DEFAULT_URGENCY
+        self.incremental = DEFAULT_INCREMENTAL
+        self.high_water_mark: int = None # None means sends block until the data is packetized.
+        self.on_writable = None
+        self.notify_writable = False
+
+    def get_offset(self) -> int:
+        return self.offset
+
+    def set_priority(self, urgency: int, incremental: bool) -> None:
+        if type(urgency) is not int or not 0 <= urgency < URGENCY_LEVELS:
+            raise StreamError(f"Urgency must be an integer from 0 to {URGENCY_LEVELS-1}.")
+        self.urgency = urgency
+        self.incremental = incremental
+
+    def queue(self, data: bytes) -> None:
+        """
+            Adds data to the data waiting to be packetized. The data is not copied,
+            so it must not change until take_pending has returned all of it.
+        """
+        if self.fin_offset is not None:
+            raise StreamError(f"Stream {self.stream_id} has been closed.")
+        view = memoryview(data).cast("B")
+        if len(view) > 0:
+            self.pending.append(view)
+            self.pending_size += len(view)
+
+    def has_pending_data(self) -> bool:
+        return self.pending_size > 0
+
+    def get_send_buffer_size(self) -> int:
+        # Bytes waiting to be packetized plus bytes sent but not yet acknowledged.
+        return self.pending_size + len(self.buffer)
+
+    def is_writable(self) -> bool:
+        return self.high_water_mark is None or self.get_send_buffer_size() < self.high_water_mark
+
+    def take_pending(self, max_length: int) -> memoryview:
+        """
+            Removes up to max_length bytes from the front of the pending data and returns them.
+            Only the first queued chunk is taken from, so fewer bytes may be returned.
+        """
+        view = self.pending[0]
+        if len(view) <= max_length:
+            self.pending.popleft()
+        else:
+            self.pending[0] = view[max_length:]
+            view = view[:max_length]
+        self.pending_size -= len(view)
+        return view
+
+    def detach_pending(self, copy: bool) -> int:
+        """
+            Replaces the views of the pending data with copies, or drops the pending data if copy
+            is False, so that the buffers they reference can be released. Returns the number of
+            bytes dropped.
+        """
+        views = self.pending
+        self.pending = deque([memoryview(bytes(view)) for view in views] if copy else ())
+        for view in views:
+            view.release()
+        dropped = 0 if copy else self.pending_size
+        self.pending_size -= dropped
+        return dropped
+
+    def write(self, data: bytes) -> int:
+        """
+            Appends data to the end of the stream and returns the offset it starts at.
+        """
+        if self.fin_offset is not None and self.offset + len(data) > self.fin_offset:
+            raise StreamError(f"Stream {self.stream_id} has been closed.")
+        start = self.offset
+        self.buffer += data
+        self.offset += len(data)
+        return start
+
+    def get_data(self, start: int, end: int) -> bytearray:
+        # Slicing the buffer already copies the data, so it is returned as it is. A memoryview
+        # would stop the buffer from being trimmed while a retransmission still referenced it.
+        return self.buffer[start-self.acked_offset:end-self.acked_offset]
+
+    def on_range_acked(self, start: int, end: int) -> None:
+        start = max(start, self.acked_offset)
+        if start >= end:
+            return
+        remove_range(self.lost_ranges, start, end)
+        add_range(self.acked_ranges, start, end)
+        # Drop the bytes at the front of the buffer once they are acknowledged.
+        first_start, first_end = self.acked_ranges[0]
+        if first_start == self.acked_offset:
+            del self.buffer[:first_end-self.acked_offset]
+            self.acked_offset = first_end
+            self.acked_ranges.pop(0)
+
+    def on_range_lost(self, start: int, end: int) -> None:
+        start = max(start, self.acked_offset)
+        if start >= end:
+            return
+        add_range(self.lost_ranges, start, end)
+        # Parts of the range may have been acknowledged by another packet.
+        for acked_start, acked_end in self.acked_ranges:
+            if acked_start >= end:
+                break
+            remove_range(self.lost_ranges, acked_start, acked_end)
+
+    def has_lost_data(self) -> bool:
+        return len(self.lost_ranges) > 0
+
+    def next_lost_range(self, max_length: int) -> tuple[int, bytes]:
+        """
+            Removes up to max_length bytes from the first lost range
+            and returns the offset and data that must be retransmitted.
+        """
+        start, end = self.lost_ranges[0]
+        end = min(end, start+max_length)
+        remove_range(self.lost_ranges, start, end)
+        return start, self.get_data(start, end)
+
+    def get_unacked_data(self, start: int, end: int) -> list[tuple[int, bytes]]:
+        """
+            Returns the parts of [start, end) that have not been acknowledged as (offset, data) pairs.
+        """
+        pieces = [(max(start, self.acked_offset), end)]
+        for acked_start, acked_end in self.acked_ranges:
+            if acked_start >= end:
+                break
+            remove_range(pieces, acked_start, acked_end)
+        return [(s, self.get_data(s, e)) for s, e in pieces if s < e]
+
+    def get_buffered_bytes(self) -> int:
+        return len(self.buffer)
+
+    def close(self) -> None:
+        # No data can be queued after this, the end of the stream is sent with a FIN
+        # once the data that is still pending has been packetized.
+        if self.fin_offset is None:
+            self.fin_offset = self.offset + self.pending_size
+
+    def is_finished(self) -> bool:
+        # True once the FIN and all of the data have been acknowledged.
+        return self.fin_acked and self.acked_offset == self.fin_offset
+
+
+class ReceiveStream:
+    """
+        Reassembles the data received on a stream. In order data waits in a bytearray
+        until it is read. Data that arrives ahead of the next expected offset is kept
+        as disjoint segments keyed by their offset, with the byte ranges they cover kept
+        in segment_ranges, so duplicate and overlapping frames only store new bytes once.
+
+        A file descriptor can be attached as a sink, in which case data from the read
+        position up to sink_end is written straight into the file at its position
+        relative to sink_offset, whether it arrives in order or not. sink_ranges
+        tracks which parts of the file have been written.
+
+        final_size is set when the FIN is received, the stream is finished
+        once everything up to it has been read.
+    """
+
+    __slots__ = ("stream_id", "buffer", "offset", "read_offset", "segments", "segment_ranges", "segment_bytes",
+                 "sink", "sink_offset", "sink_end", "sink_ranges", "window", "final_size")
+
+    def __init__(self, stream_id: int):
+        self.stream_id = stream_id
+        self.buffer = bytearray()  # In order data that hasn't been read yet.
+        self.offset = 0            # Next in order offset expected, i.e. the end of the buffer.
+        self.read_offset = 0       # Offset of the first byte in the buffer.
+        self.segments: dict[int, bytes] = dict()
+        self.segment_ranges: list[tuple[int, int]] = []
+        self.segment_bytes = 0
+        self.sink: int = None
+        self.sink_offset = 0
+        self.sink_end = 0
+        self.sink_ranges: list[tuple[int, int]] = []
+        self.window = ReceiveWindow(INITIAL_MAX_STREAM_DATA, MAX_STREAM_WINDOW) # Stream level flow control.
+        self.final_size: int = None
+
+    @property
+    def data(self) -> bytes:
+        return bytes(self.buffer)
+
+    def receive(self, offset: int, data: bytes) -> None:
+        """
+            Adds the data of a stream frame at the given offset.
+        """
+        end = offset + len(data)
+        if end <= self.offset:
+            return # Duplicate data that has already been received.
+        if self.sink is not None and offset < self.sink_end:
+            # The part of the data that belongs in the file goes there, the rest is buffered.
+            view = memoryview(data)
+            split = min(end, self.sink_end) - offset
+            self.write_to_sink(offset, view[:split])
+            if end <= self.sink_end:
+                return
+            offset, data = offset+split, view[split:]
+        if offset <= self.offset and not self.segments:
+            # In order data, the common case.
+            self.buffer += data[self.offset-offset:]
+            self.offset = end
+            return
+        # Only keep the parts of the data that haven't been received yet.
+        pieces = missing_ranges(self.segment_ranges, max(offset, self.offset), end)
+        view = memoryview(data)
+        for start, stop in pieces:
+            self.segments[start] = bytes(view[start-offset:stop-offset])
+            self.segment_bytes += stop - start
+            add_range(self.segment_ranges, start, stop)
+        self.process_segments()
+
+    def write_to_sink(self, offset: int, data: bytes) -> None:
+        # Writes the parts of the data that haven't been written yet into the sink file.
+        view = memoryview(data)
+        for start, stop in missing_ranges(self.sink_ranges, max(offset, self.offset), offset+len(data)):
+            pwrite(self.sink, view[start-offset:stop-offset], start-self.sink_offset)
+            add_range(self.sink_ranges, start, stop)
+        # Everything up to the first gap has now been delivered.
+        if self.sink_ranges and self.sink_ranges[0][0] <= self.offset:
+            self.offset = self.sink_ranges.pop(0)[1]
+            self.read_offset = self.offset
+
+    def attach_sink(self, fd: int, count: int = None) -> None:
+        """
+            Writes the next count bytes of the stream (or all of it if count is None)
+            into the file descriptor fd instead of buffering them.
+        """
+        buffered = [(self.read_offset, bytes(self.buffer))] + list(self.segments.items())
+        self.buffer = bytearray()
+        self.offset = self.read_offset
+        self.segments.clear()
+        self.segment_ranges = []
+        self.segment_bytes = 0
+        self.sink = fd
+        self.sink_offset = self.read_offset
+        self.sink_end = inf if count is None else self.read_offset + count
+        self.sink_ranges = []
+        # Data that was buffered before the sink was attached is passed through again.
+        for offset, data in buffered:
+            if data:
+                self.receive(offset, data)
+
+    def is_sink_done(self) -> bool:
+        return self.offset >= self.sink_end
+
+    def detach_sink(self) -> int:
+        """
+            Stops writing into the sink file and returns the number of bytes
+            that were written in order into it.
+        """
+        written = self.offset - self.sink_offset
+        self.sink = None
+        self.sink_ranges = []
+        self.process_segments()
+        return written
+
+    def process_segments(self) -> None:
+        # Move segments that are now in order into the buffer.
+        start = self.offset
+        while self.offset in self.segments:
+            segment = self.segments.pop(self.offset)
+            self.buffer += segment
+            self.segment_bytes -= len(segment)
+            self.offset += len(segment)
+        if self.offset != start:
+            remove_range(self.segment_ranges, start, self.offset)
+
+    def read(self, num_bytes: int) -> bytes:
+        data = bytes(self.buffer[0:num_bytes])
+        del self.buffer[0:len(data)]
+        self.read_offset += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        """
+            Copies as much in order data as fits into buffer (any writable buffer, e.g. a bytearray or memoryview)
+            and returns the number of bytes copied.
+        """
+        view = memoryview(buffer).cast("B")
+        num_bytes = min(len(view), len(self.buffer))
+        # Copied straight out of the buffer, the view is released before the buffer is resized.
+        with memoryview(self.buffer) as data:
+            view[0:num_bytes] = data[0:num_bytes]
+        del self.buffer[0:num_bytes]
+        self.read_offset += num_bytes
+        return num_bytes
+
+    def get_readable_bytes(self) -> int:
+        return len(self.buffer)
+
+    def on_fin(self, final_size: int) -> None:
+        self.final_size = final_size
+
+    def is_finished(self) -> bool:
+        return self.final_size is not None and self.read_offset >= self.final_size
+
+    def get_buffered_bytes(self) -> int:
+        return len(self.buffer) + self.segment_bytes
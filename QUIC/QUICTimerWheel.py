@@ -0,0 +1,146 @@
+"""
+    This module contains the TimerWheel, a hierarchical hashed timer wheel
+    used to keep the deadlines of many connections. Arming, cancelling and
+    re-arming a timer is O(1), and expiring timers costs the same no matter
+    how many timers are pending.
+"""
+
+from math import ceil
+
+TIMER_WHEEL_TICK = 0.001   # seconds, the resolution of the wheel.
+TIMER_WHEEL_BITS = 6
+TIMER_WHEEL_SLOTS = 1 << TIMER_WHEEL_BITS # Slots per level.
+TIMER_WHEEL_MASK = TIMER_WHEEL_SLOTS - 1
+TIMER_WHEEL_LEVELS = 4     # 64^4 ticks, about 4.6 hours. Later deadlines wait in the last level.
+MISSING = object()
+
+
+class TimerWheel:
+    """
+        Timers are identified by a key (e.g. a connection) and expire at the tick of their deadline.
+        Level 0 has a slot for each of the next 64 ticks, every following level has slots
+        64 times as long. A timer goes in the lowest level whose range covers its deadline and
+        is moved down a level (cascaded) when the clock reaches the start of its slot.
+        Timers with deadlines that have already passed are kept in ready until the next expire.
+    """
+
+    def __init__(self, now: float, tick: float = TIMER_WHEEL_TICK):
+        self.tick = tick
+        self.current = int(now / tick) # The last tick that has been expired.
+        self.levels: list[list[dict]] = [[dict() for i in range(TIMER_WHEEL_SLOTS)] for level in range(TIMER_WHEEL_LEVELS)]
+        self.counts = [0] * TIMER_WHEEL_LEVELS # Number of timers in each level.
+        self.timers: dict = dict() # Key: timer key | Value: (level, slot), or None if the timer is in ready.
+        self.ready: dict = dict()
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+    def __contains__(self, key) -> bool:
+        return key in self.timers
+
+    def schedule(self, key, deadline: float) -> None:
+        """
+            Arms the timer for key to expire at deadline (in seconds), replacing any earlier deadline.
+        """
+        self.cancel(key)
+        self.insert(key, ceil(deadline / self.tick))
+
+    def cancel(self, key) -> None:
+        location = self.timers.pop(key, MISSING)
+        if location is MISSING:
+            return
+        if location is None:
+            del self.ready[key]
+            return
+        level, slot = location
+        del self.levels[level][slot][key]
+        self.counts[level] -= 1
+
+    def insert(self, key, expiry: int) -> None:
+        delta = expiry - self.current
+        if delta <= 0:
+            self.ready[key] = expiry
+            self.timers[key] = None
+            return
+        level = 0
+        while level < TIMER_WHEEL_LEVELS-1 and delta >= 1 << (TIMER_WHEEL_BITS * (level+1)):
+            level += 1
+        # Timers too far away for the wheel are placed in its last slot and put back in when they get there.
+        position = min(expiry, self.current + (1 << (TIMER_WHEEL_BITS * TIMER_WHEEL_LEVELS)) - 1)
+        slot = (position >> (TIMER_WHEEL_BITS * level)) & TIMER_WHEEL_MASK
+        self.levels[level][slot][key] = expiry
+        self.counts[level] += 1
+        self.timers[key] = (level, slot)
+
+    def cascade(self) -> None:
+        # Called on the first tick of every level 0 round, moves the timers of the
+        # slots that are starting in the higher levels down to the levels below.
+        for level in range(1, TIMER_WHEEL_LEVELS):
+            index = (self.current >> (TIMER_WHEEL_BITS * level)) & TIMER_WHEEL_MASK
+            timers = self.levels[level][index]
+            if timers:
+                self.levels[level][index] = dict()
+                self.counts[level] -= len(timers)
+                for key, expiry in timers.items():
+                    self.insert(key, expiry)
+            if index != 0:
+                break
+
+    def expire(self, now: float) -> list:
+        """
+            Advances the clock to now and returns the keys of every timer that has expired, in a batch.
+        """
+        expired = list(self.ready)
+        for key in expired:
+            del self.timers[key]
+        self.ready.clear()
+        target = int(now / self.tick)
+        while self.current < target:
+            if not self.timers:
+                self.current = target
+                break
+            if self.counts[0] == 0:
+                # Nothing expires before the next cascade, skip straight to it.
+                self.current = min(target, self.current | TIMER_WHEEL_MASK)
+                if self.current == target:
+                    break
+            self.current += 1
+            if self.current & TIMER_WHEEL_MASK == 0:
+                self.cascade()
+            index = self.current & TIMER_WHEEL_MASK
+            timers = self.levels[0][index]
+            if timers:
+                self.levels[0][index] = dict()
+                self.counts[0] -= len(timers)
+                for key in timers:
+                    del self.timers[key]
+                expired += timers
+            # A cascade can move timers into ready if the last level held them past their deadline.
+            if self.ready:
+                expired += self.ready
+                for key in self.ready:
+                    del self.timers[key]
+                self.ready.clear()
+        return expired
+
+    def get_next_deadline(self) -> float or None:
+        """
+            Returns the time of the next tick at which expire has work to do, or None if no timer is armed.
+            For timers in the higher levels this is the start of their slot, which may be a little early.
+        """
+        if self.ready:
+            return self.current * self.tick
+        if not self.timers:
+            return None
+        ticks = []
+        if self.counts[0]:
+            for i in range(1, TIMER_WHEEL_SLOTS+1):
+                if self.levels[0][(self.current+i) & TIMER_WHEEL_MASK]:
+                    ticks.append(self.current+i)
+                    break
+        for level in range(1, TIMER_WHEEL_LEVELS):
+            if self.counts[level]:
+                shift = TIMER_WHEEL_BITS * level
+                ticks.append(((self.current >> shift) + 1) << shift)
+                break
+        return min(ticks) * self.tick
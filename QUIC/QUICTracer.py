@@ -0,0 +1,225 @@
+"""
+    This module contains the QLogTracer, which records the events of a
+    connection (packets sent, received and lost, congestion control metrics
+    and state changes) in the qlog format, so that a connection can be looked
+    at with qlog tools such as qvis. Connections aren't traced unless a tracer
+    is given to their socket.
+"""
+
+import json
+from queue import Queue, Full, Empty
+from random import random
+from threading import Thread
+from time import time
+from .QUICPacket import *
+from .QUICNetworkController import SLOW_START, RECOVERY, CONGESTION_AVOIDANCE, INFINITY
+
+QLOG_VERSION = "0.3"
+QLOG_QUEUE_SIZE = 8192 # Events waiting to be written, events that don't fit are dropped.
+RECORD_SEPARATOR = "\x1e" # Starts every record of a JSON text sequence (RFC 7464).
+
+PACKET_TYPES = {HT_INITIAL: "initial", HT_HANDSHAKE: "handshake", HT_RETRY: "retry", HT_DATA: "1RTT"}
+CONGESTION_STATES = {SLOW_START: "slow_start", RECOVERY: "recovery", CONGESTION_AVOIDANCE: "congestion_avoidance"}
+METRICS = ("congestion_window", "bytes_in_flight", "ssthresh", "smoothed_rtt", "min_rtt", "latest_rtt", "rtt_variance", "pacing_rate")
+
+
+class QLogTracer:
+    """
+        Writes the qlog events of one connection to a file, serialized as JSON-SEQ (a .sqlog file).
+        The connection only puts the values of each event in a bounded queue, a background thread
+        turns them into JSON and writes them, so tracing keeps formatting and disk writes out of
+        the connection. Events are dropped, and counted in dropped, when the writer falls behind.
+        sample_rate is the fraction of packet_sent, packet_received and metrics_updated events that
+        are traced, packet_lost and congestion_state_updated events are always traced.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0, queue_size: int = QLOG_QUEUE_SIZE, title: str = "quic-python"):
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be greater than 0 and at most 1.")
+        self.path = path
+        self.title = title
+        self.sample_rate = sample_rate
+        self.reference_time = time()
+        self.dropped = 0
+        self.congestion_state = None
+        self.metrics: dict = dict() # Last value written for each metric, metrics_updated only has the ones that changed.
+        self._queue: Queue = Queue(queue_size)
+        self._file = open(path, "w")
+        self._thread = Thread(target=self.run, name="QLogTracer", daemon=True)
+
+
+    def start(self, vantage_point: str) -> None:
+        """
+            Writes the qlog header and starts the writer thread. Called when the tracer is given to a
+            connection, vantage_point is "client" or "server".
+        """
+        if self._thread.is_alive():
+            raise ValueError("A tracer can only trace a single connection.")
+        header = {
+            "qlog_version": QLOG_VERSION,
+            "qlog_format": "JSON-SEQ",
+            "title": self.title,
+            "trace": {
+                "vantage_point": {"type": vantage_point},
+                "common_fields": {"time_format": "relative", "reference_time": self.reference_time * 1000},
+            },
+        }
+        self._file.write(RECORD_SEPARATOR + json.dumps(header) + "\n")
+        self._thread.start()
+
+
+    def close(self) -> None:
+        """
+            Writes the events still in the queue and closes the file.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if not self._file.closed:
+            self._file.close()
+
+
+    def put(self, event: tuple) -> None:
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+
+    # ---- Events, called by the connection ----
+
+    def on_packet_sent(self, packet: Packet, size: int) -> None:
+        if self.sample_rate >= 1 or random() < self.sample_rate:
+            self.put(("transport:packet_sent", time(), packet.header.type, packet.header.packet_number, frames_fields(packet.frames), size))
+
+
+    def on_packet_received(self, packet: Packet, size: int) -> None:
+        if self.sample_rate >= 1 or random() < self.sample_rate:
+            self.put(("transport:packet_received", time(), packet.header.type, packet.header.packet_number, frames_fields(packet.frames), size))
+
+
+    def on_packet_lost(self, info, trigger: str) -> None:
+        # info is the PacketSentInfo of the packet, trigger the threshold that declared it lost.
+        self.put(("recovery:packet_lost", time(), info.header_type, info.packet_number, trigger))
+
+
+    def on_metrics_updated(self, sender_side_controller) -> None:
+        sc = sender_side_controller
+        state = sc.get_congestion_state()
+        if state != self.congestion_state:
+            self.put(("recovery:congestion_state_updated", time(), self.congestion_state, state))
+            self.congestion_state = state
+        if self.sample_rate >= 1 or random() < self.sample_rate:
+            self.put(("recovery:metrics_updated", time(), sc.congestion_window, sc.bytes_in_flight, sc.slow_start_threshold,
+                      sc.smoothed_rtt, sc.min_rtt, sc.latest_rtt, sc.rttvar, sc.get_pacing_rate()))
+
+
+    # ---- Writer thread ----
+
+    def run(self) -> None:
+        running = True
+        while running:
+            events = [self._queue.get()]
+            # Write everything that is waiting in one go.
+            try:
+                while True:
+                    events.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            if None in events:
+                running = False
+                events = events[:events.index(None)]
+            self._file.write("".join([self.format_event(event) for event in events]))
+            self._file.flush()
+
+
+    def format_event(self, event: tuple) -> str:
+        name, timestamp = event[0], event[1]
+        if name == "recovery:metrics_updated":
+            data = dict()
+            for metric, value in zip(METRICS, event[2:]):
+                if value == INFINITY:
+                    continue # ssthresh and the pacing rate are infinite until the first loss and RTT sample.
+                if metric.endswith("rtt") or metric == "rtt_variance":
+                    value = value * 1000 # qlog times are in milliseconds.
+                elif metric == "pacing_rate":
+                    value = value * 8 # bits per second.
+                if self.metrics.get(metric) != value:
+                    data[metric] = self.metrics[metric] = value
+            if not data:
+                return ""
+        elif name == "recovery:congestion_state_updated":
+            data = {"new": CONGESTION_STATES[event[3]]}
+            if event[2] is not None:
+                data["old"] = CONGESTION_STATES[event[2]]
+        elif name == "recovery:packet_lost":
+            data = {"header": {"packet_type": PACKET_TYPES.get(event[2], "unknown"), "packet_number": event[3]}, "trigger": event[4]}
+        else:
+            header_type, packet_number, frames, size = event[2:]
+            data = {"header": {"packet_type": PACKET_TYPES.get(header_type, "unknown"), "packet_number": packet_number},
+                    "raw": {"length": size}, "frames": [frame_to_qlog(fields) for fields in frames]}
+        record = {"time": (timestamp - self.reference_time) * 1000, "name": name, "data": data}
+        return RECORD_SEPARATOR + json.dumps(record) + "\n"
+
+
+def frames_fields(frames: list) -> tuple:
+    # Copies the fields of the frames that are traced when the event is queued, the frames
+    # themselves aren't kept: the data of stream frames can be a view of the caller's buffer
+    # or of a mapped file, which would stay exported until the writer got to the event.
+    return tuple([frame_fields(frame) for frame in frames])
+
+
+def frame_fields(frame) -> tuple:
+    # The qlog frame type followed by the values of its FRAME_FIELDS.
+    if isinstance(frame, StreamFrame):
+        return ("stream", frame.stream_id, frame.offset, frame.length, frame.fin)
+    if isinstance(frame, AckFrame):
+        smallest = frame.largest_acknowledged - frame.first_ack_range
+        acked_ranges = [(smallest, frame.largest_acknowledged)]
+        for ack_range in frame.ack_range:
+            largest = smallest - ack_range.gap - 1
+            smallest = largest - ack_range.ack_range_length + 1
+            acked_ranges.append((smallest, largest))
+        return ("ack", frame.ack_delay / 1000, tuple(acked_ranges))
+    if isinstance(frame, CryptoFrame):
+        return ("crypto", frame.offset, frame.length)
+    if isinstance(frame, MaxDataFrame):
+        return ("max_data", frame.maximum_data)
+    if isinstance(frame, MaxStreamDataFrame):
+        return ("max_stream_data", frame.stream_id, frame.maximum_stream_data)
+    if isinstance(frame, DataBlockedFrame):
+        return ("data_blocked", frame.maximum_data)
+    if isinstance(frame, StreamDataBlockedFrame):
+        return ("stream_data_blocked", frame.stream_id, frame.maximum_stream_data)
+    if isinstance(frame, MaxStreamsFrame):
+        return ("max_streams", "unidirectional" if frame.unidirectional else "bidirectional", frame.maximum_streams)
+    if isinstance(frame, PaddingFrame):
+        return ("padding",)
+    if isinstance(frame, ConnectionCloseFrame):
+        return ("connection_close", "transport", frame.error_code, bytes(frame.reason_phrase))
+    return ("unknown", frame.type)
+
+
+FRAME_FIELDS = {
+    "stream": ("stream_id", "offset", "length", "fin"),
+    "ack": ("ack_delay", "acked_ranges"),
+    "crypto": ("offset", "length"),
+    "max_data": ("maximum",),
+    "max_stream_data": ("stream_id", "maximum"),
+    "data_blocked": ("limit",),
+    "stream_data_blocked": ("stream_id", "limit"),
+    "max_streams": ("stream_type", "maximum"),
+    "padding": (),
+    "connection_close": ("error_space", "error_code", "reason"),
+    "unknown": ("raw_frame_type",),
+}
+
+
+def frame_to_qlog(fields: tuple) -> dict:
+    data = {"frame_type": fields[0]}
+    data.update(zip(FRAME_FIELDS[fields[0]], fields[1:]))
+    if fields[0] == "ack":
+        data["acked_ranges"] = [list(acked_range) for acked_range in data["acked_ranges"]]
+    elif fields[0] == "connection_close":
+        data["reason"] = data["reason"].decode(errors="replace")
+    return data
@@ -0,0 +1,332 @@
+"""
+    This module contains the datagram transports connections send and receive
+    their packets on: UDP sockets, Unix datagram sockets for services on the same
+    host, and in-process queues that need no socket at all. QUICSocket uses a
+    UDPTransport unless it is given another transport.
+"""
+
+import os
+from collections import deque
+from select import select
+from socket import socket, socketpair, AF_INET, AF_UNIX, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR
+from threading import Lock, Condition
+from errno import EADDRINUSE
+
+RECEIVE_SIZE = 4096         # bytes, larger than any datagram a connection sends.
+RECEIVE_BATCH = 64          # datagrams returned by one receive_batch call at most.
+QUEUE_HOST = "queue"        # Host part of the addresses on a QueueNetwork.
+QUEUE_EPHEMERAL_PORT = 49152
+QUEUE_SIZE = 4096           # datagrams waiting in a QueueTransport before more are dropped, like a full socket buffer.
+
+
+class DatagramTransport:
+    """
+        Sends and receives datagrams for a connection. Receiving never blocks, wait_readable
+        blocks until there is something to receive. fileno returns a file descriptor that is
+        readable whenever datagrams are waiting, so transports can be registered with a reactor.
+    """
+
+    def send(self, datagram: bytes, address) -> None:
+        raise NotImplementedError
+
+    def send_batch(self, datagrams: list[bytes], address) -> None:
+        for datagram in datagrams:
+            self.send(datagram, address)
+
+    def receive_batch(self, max_datagrams: int = RECEIVE_BATCH) -> list[tuple[bytes, object]]:
+        # Returns up to max_datagrams (datagram, address) pairs, or an empty list if none have arrived.
+        raise NotImplementedError
+
+    def wait_readable(self, timeout: float or None) -> bool:
+        raise NotImplementedError
+
+    def fileno(self) -> int:
+        raise NotImplementedError
+
+    def bind(self, address) -> None:
+        raise NotImplementedError
+
+    def connect(self, address) -> None:
+        # Makes address the peer of the transport. Datagrams from other addresses may still be received.
+        raise NotImplementedError
+
+    def listen(self, port) -> None:
+        # Binds the transport so that the first datagrams of new connections arrive on it.
+        raise NotImplementedError
+
+    def accept(self, peer_address, local_address=None) -> "DatagramTransport":
+        # Returns a transport of its own for the connection with peer_address, which reached this listening transport.
+        raise NotImplementedError
+
+    def get_local_address(self):
+        raise NotImplementedError
+
+    def get_peer_address(self):
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class SocketTransport(DatagramTransport):
+    """
+        A transport on a datagram socket of the given family. The socket is non-blocking.
+    """
+
+    def __init__(self, family: int):
+        self._socket = socket(family, SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._peer_address = None
+
+    def send(self, datagram: bytes, address) -> None:
+        self._socket.sendto(datagram, address)
+
+    def receive_batch(self, max_datagrams: int = RECEIVE_BATCH) -> list[tuple[bytes, object]]:
+        datagrams = []
+        while len(datagrams) < max_datagrams:
+            try:
+                datagrams.append(self._socket.recvfrom(RECEIVE_SIZE))
+            except (BlockingIOError, ConnectionRefusedError):
+                break
+        return datagrams
+
+    def wait_readable(self, timeout: float or None) -> bool:
+        readable, writable, failed = select([self._socket], [], [], timeout)
+        return bool(readable)
+
+    def fileno(self) -> int:
+        return self._socket.fileno()
+
+    def bind(self, address) -> None:
+        self._socket.bind(address)
+
+    def get_local_address(self):
+        return self._socket.getsockname()
+
+    def get_peer_address(self):
+        return self._peer_address
+
+    def close(self) -> None:
+        self._socket.close()
+
+
+class UDPTransport(SocketTransport):
+    """
+        A UDP socket. Accepted connections get sockets of their own bound to the listening
+        address and connected to the peer, the kernel gives them the datagrams of their peer.
+    """
+
+    def __init__(self, family: int = AF_INET):
+        super().__init__(family)
+        self.family = family
+
+    def connect(self, address) -> None:
+        self._socket.connect(address)
+        self._peer_address = address
+
+    def listen(self, port) -> None:
+        # Only listening sockets may share their port: a client socket sharing its ephemeral port with another
+        # client's would have its packets delivered to the server side socket of the other connection.
+        self._socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self._socket.bind(("", port))
+
+    def accept(self, peer_address, local_address=None) -> "UDPTransport":
+        transport = UDPTransport(self.family)
+        transport._socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        transport.bind(local_address if local_address is not None else self.get_local_address())
+        transport.connect(peer_address)
+        return transport
+
+
+class UnixTransport(SocketTransport):
+    """
+        An AF_UNIX datagram socket, for connections between processes on the same host that
+        don't need to go through the IP stack. Listening transports are bound to a path, the
+        others to an autobound abstract address (Linux only). Accepted connections answer from
+        their own address, the client connects to it once it has the server's INITIAL packet.
+    """
+
+    def __init__(self):
+        super().__init__(AF_UNIX)
+        self._path = None # Removed when the transport is closed.
+        self.datagrams_dropped = 0 # Dropped because the receiver's queue was full.
+
+    def send(self, datagram: bytes, address) -> None:
+        # A full receive queue makes the send fail where UDP would drop the datagram, it is dropped
+        # here as well and recovered like any other loss. The queue holds net.unix.max_dgram_qlen
+        # datagrams, except for datagrams from the socket the receiver is connected to.
+        try:
+            self._socket.sendto(datagram, address)
+        except BlockingIOError:
+            self.datagrams_dropped += 1
+
+    def bind(self, address) -> None:
+        self._socket.bind(address)
+        if isinstance(address, str) and address and not address.startswith("\0"):
+            self._path = address
+
+    def connect(self, address) -> None:
+        # Paths (and abstract names given as strings) are listening addresses. The socket isn't connected
+        # to them: a connected Unix socket only receives from its peer, but the server answers from the
+        # autobound address of the accepted connection, which the kernel reports as bytes.
+        if not self._socket.getsockname():
+            self.bind("")
+        if isinstance(address, bytes):
+            self._socket.connect(address)
+        self._peer_address = address
+
+    def listen(self, port) -> None:
+        self.bind(port)
+
+    def accept(self, peer_address, local_address=None) -> "UnixTransport":
+        transport = UnixTransport()
+        transport.connect(peer_address)
+        return transport
+
+    def close(self) -> None:
+        super().close()
+        if self._path is not None:
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+            self._path = None
+
+
+class QueueNetwork:
+    """
+        Delivers datagrams between the QueueTransports created on it without leaving the
+        process. Addresses are (QUEUE_HOST, port) pairs, and datagrams sent to an address
+        that no transport is bound to are dropped.
+    """
+
+    def __init__(self):
+        self._transports: dict[tuple[str, int], QueueTransport] = dict()
+        self._next_port = QUEUE_EPHEMERAL_PORT
+        self._lock = Lock()
+
+    def create_transport(self) -> "QueueTransport":
+        return QueueTransport(self)
+
+    def bind(self, transport: "QueueTransport", address: tuple[str, int] or None) -> tuple[str, int]:
+        # Binds the transport to address, or to an unused port if address is None.
+        with self._lock:
+            if address is None:
+                while (QUEUE_HOST, self._next_port) in self._transports:
+                    self._next_port += 1
+                address = (QUEUE_HOST, self._next_port)
+            if address in self._transports:
+                raise OSError(EADDRINUSE, f"{address} is already in use.")
+            self._transports[address] = transport
+        return address
+
+    def unbind(self, address: tuple[str, int]) -> None:
+        with self._lock:
+            self._transports.pop(address, None)
+
+    def deliver(self, datagrams: list[bytes], source: tuple[str, int], destination: tuple[str, int]) -> None:
+        with self._lock:
+            transport = self._transports.get(tuple(destination))
+        if transport is not None:
+            transport.on_datagrams(datagrams, source)
+
+
+class QueueTransport(DatagramTransport):
+    """
+        A transport on a QueueNetwork, received datagrams wait in a queue until they are read.
+        fileno creates a socket pair the first time it is called, which is then written to
+        whenever datagrams arrive so that the transport can be selected on.
+    """
+
+    def __init__(self, network: QueueNetwork):
+        self.network = network
+        self._queue: deque[tuple[bytes, tuple[str, int]]] = deque()
+        self._condition = Condition(Lock())
+        self._local_address = None
+        self._peer_address = None
+        self._signal_receiver = None
+        self._signal_sender = None
+        self._closed = False
+        self.datagrams_dropped = 0 # Dropped because the queue was full.
+
+    def send(self, datagram: bytes, address) -> None:
+        self.send_batch([datagram], address)
+
+    def send_batch(self, datagrams: list[bytes], address) -> None:
+        if self._local_address is None:
+            self.bind(None)
+        # The receiver keeps the datagrams, so the caller's buffers are copied.
+        self.network.deliver([bytes(datagram) for datagram in datagrams], self._local_address, address)
+
+    def on_datagrams(self, datagrams: list[bytes], source: tuple[str, int]) -> None:
+        with self._condition:
+            room = QUEUE_SIZE - len(self._queue)
+            self.datagrams_dropped += max(0, len(datagrams) - room)
+            self._queue.extend((datagram, source) for datagram in datagrams[:room])
+            self._condition.notify_all()
+            if self._signal_sender is not None and self._queue:
+                try:
+                    self._signal_sender.send(b"\0")
+                except BlockingIOError:
+                    pass # The receiver hasn't read the previous signals yet.
+
+    def receive_batch(self, max_datagrams: int = RECEIVE_BATCH) -> list[tuple[bytes, tuple[str, int]]]:
+        with self._condition:
+            count = min(max_datagrams, len(self._queue))
+            datagrams = [self._queue.popleft() for i in range(count)]
+            if not self._queue and self._signal_receiver is not None:
+                try:
+                    while self._signal_receiver.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+        return datagrams
+
+    def wait_readable(self, timeout: float or None) -> bool:
+        with self._condition:
+            return bool(self._condition.wait_for(lambda: self._queue, timeout))
+
+    def fileno(self) -> int:
+        with self._condition:
+            if self._closed:
+                return -1 # Like a closed socket.
+            if self._signal_receiver is None:
+                self._signal_receiver, self._signal_sender = socketpair()
+                self._signal_receiver.setblocking(False)
+                self._signal_sender.setblocking(False)
+                if self._queue:
+                    self._signal_sender.send(b"\0")
+            return self._signal_receiver.fileno()
+
+    def bind(self, address) -> None:
+        self._local_address = self.network.bind(self, address)
+
+    def connect(self, address) -> None:
+        if self._local_address is None:
+            self.bind(None)
+        self._peer_address = address
+
+    def listen(self, port) -> None:
+        self.bind((QUEUE_HOST, port))
+
+    def accept(self, peer_address, local_address=None) -> "QueueTransport":
+        transport = QueueTransport(self.network)
+        transport.connect(peer_address)
+        return transport
+
+    def get_local_address(self):
+        return self._local_address
+
+    def get_peer_address(self):
+        return self._peer_address
+
+    def close(self) -> None:
+        if self._local_address is not None:
+            self.network.unbind(self._local_address)
+        with self._condition:
+            self._closed = True
+            self._queue.clear()
+            if self._signal_receiver is not None:
+                self._signal_receiver.close()
+                self._signal_sender.close()
+                self._signal_receiver = self._signal_sender = None
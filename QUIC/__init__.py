@@ -3,4 +3,13 @@ from .QUICEncryption import *
 from .QUICPacket import *
 from .QUICPacketParser import *
 from .QUICConnection import *
-from .QUICNetworkController import *
\ No newline at end of file
+from .QUICFlowControl import *
+from .QUICScheduler import *
+from .QUICMetrics import *
+from .QUICStream import *
+from .QUICNetworkController import *
+from .QUICTimerWheel import *
+from .QUICReactor import *
+from .QUICTracer import *
+from .QUICProfiler import *
+from .QUICTransport import *
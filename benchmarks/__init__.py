@@ -0,0 +1,5 @@
+"""
+    Benchmarks for the QUIC implementation. Every benchmark is run from the
+    repository root as a module, e.g. python -m benchmarks.loopback, and can
+    write its results as JSON or CSV and compare them to a saved baseline.
+"""
@@ -0,0 +1,166 @@
+"""
+    Helpers shared by the benchmarks: percentiles, JSON and CSV output, and
+    comparing results to a baseline saved by an earlier run.
+
+    A result is a flat dict. The fields listed in KEY_FIELDS identify what was
+    measured (e.g. the protocol and message size), every other number is a
+    metric. Metrics ending in one of HIGHER_IS_BETTER get worse when they drop,
+    all other metrics (times, latencies, CPU) get worse when they grow.
+"""
+
+import csv
+import json
+import os
+import platform
+import sys
+from socket import socket, AF_INET, SOCK_DGRAM, SOCK_STREAM
+from time import time
+
+KEY_FIELDS = ("benchmark", "protocol", "test", "mode", "size", "case")
+HIGHER_IS_BETTER = ("_per_sec", "_mbps", "_ops")
+DEFAULT_TOLERANCE = 0.2 # A metric regresses when it is more than 20% worse than the baseline.
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """
+        Returns the given percentile (0 to 100) of the values, interpolating between the closest ranks.
+    """
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values: list[float], prefix: str, scale: float = 1.0) -> dict:
+    # The usual percentiles of a list of samples, multiplied by scale (e.g. 1e6 for seconds to microseconds).
+    return {
+        f"{prefix}_p50": percentile(values, 50) * scale,
+        f"{prefix}_p90": percentile(values, 90) * scale,
+        f"{prefix}_p99": percentile(values, 99) * scale,
+        f"{prefix}_max": max(values) * scale if values else float("nan"),
+    }
+
+
+def get_free_port() -> int:
+    # A port that is free for both UDP and TCP on loopback when this returns.
+    while True:
+        with socket(AF_INET, SOCK_DGRAM) as udp_socket:
+            udp_socket.bind(("127.0.0.1", 0))
+            port = udp_socket.getsockname()[1]
+            try:
+                with socket(AF_INET, SOCK_STREAM) as tcp_socket:
+                    tcp_socket.bind(("127.0.0.1", port))
+                    return port
+            except OSError:
+                continue
+
+
+def get_key(result: dict) -> tuple:
+    return tuple((field, result[field]) for field in KEY_FIELDS if field in result)
+
+
+def get_metrics(result: dict) -> dict:
+    return {name: value for name, value in result.items() if name not in KEY_FIELDS and isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+
+def is_higher_better(metric: str) -> bool:
+    return metric.endswith(HIGHER_IS_BETTER)
+
+
+def get_environment() -> dict:
+    return {"python": sys.version.split()[0], "implementation": platform.python_implementation(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "time": time()}
+
+
+def write_json(path: str, results: list[dict]) -> None:
+    with open(path, "w") as f:
+        json.dump({"environment": get_environment(), "results": results}, f, indent=2)
+        f.write("\n")
+
+
+def write_csv(path: str, results: list[dict]) -> None:
+    fields = []
+    for result in results:
+        fields += [field for field in result if field not in fields]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def load_results(path: str) -> list[dict]:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare_to_baseline(results: list[dict], baseline: list[dict], tolerance: float = DEFAULT_TOLERANCE, metrics: list[str] = None) -> list[str]:
+    """
+        Returns a line for every metric that is more than tolerance worse than in the baseline.
+        Only the given metrics are compared, or every metric if metrics is None. Results
+        that aren't in the baseline, and baseline results that weren't run, are skipped.
+    """
+    baseline_by_key = {get_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_key.get(get_key(result))
+        if previous is None:
+            continue
+        for metric, value in get_metrics(result).items():
+            if metrics is not None and metric not in metrics:
+                continue
+            old = previous.get(metric)
+            if not isinstance(old, (int, float)) or old <= 0 or value != value: # value != value for NaN
+                continue
+            change = (value - old) / old
+            worse = -change if is_higher_better(metric) else change
+            if worse > tolerance:
+                name = " ".join(f"{field}={key_value}" for field, key_value in get_key(result))
+                regressions.append(f"{name}: {metric} {old:.6g} -> {value:.6g} ({change:+.1%})")
+    return regressions
+
+
+def format_table(results: list[dict], columns: list[str]) -> str:
+    # A plain text table of the given columns, numbers are shown with 4 significant digits.
+    rows = [columns] + [[format_value(result.get(column, "")) for column in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def finish(results: list[dict], args, metrics: list[str] = None) -> int:
+    """
+        Writes the results to the files named by the --json, --csv and --save-baseline arguments
+        and compares the given metrics (or all of them) to --baseline. Returns the exit status,
+        1 if a metric regressed.
+    """
+    if args.json:
+        write_json(args.json, results)
+    if args.csv:
+        write_csv(args.csv, results)
+    if args.save_baseline:
+        write_json(args.save_baseline, results)
+    if args.baseline:
+        regressions = compare_to_baseline(results, load_results(args.baseline), args.tolerance, metrics)
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.baseline}:")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print(f"No regressions against {args.baseline}.")
+    return 0
+
+
+def add_output_arguments(parser) -> None:
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    parser.add_argument("--csv", help="Write the results to this CSV file.")
+    parser.add_argument("--baseline", help="Fail if the results are worse than the ones in this JSON file.")
+    parser.add_argument("--save-baseline", help="Save the results as a baseline in this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Fraction a metric may be worse than the baseline.")
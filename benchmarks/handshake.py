@@ -0,0 +1,193 @@
+"""
+    Connection establishment benchmark. A listener process accepts connections on
+    loopback while a client process opens them, either one after the other
+    (concurrency 1) or from several threads at once. Reported for every run:
+
+    handshakes_per_sec: connections established per second of wall clock time.
+    connect_ms: how long QUICSocket.connect took on the client.
+    accept_ms: how long the listener took from the client's INITIAL packet to
+        returning the connection from accept (ConnectionStats.handshake_duration).
+    server_cpu_ms_per_handshake: CPU time used by the listener process per connection,
+        up to the last accept. Not measured (NaN) when connections failed, the listener
+        may have spent the rest of the run waiting for them.
+    server_fds_per_connection: file descriptors the listener holds per open connection.
+    failed: connections that weren't established before the timeout.
+
+    Listeners are looked up by name in LISTENERS, so new ways of accepting connections
+    can be added there and measured with --listener.
+
+    Run from the repository root:
+        python -m benchmarks.handshake --connections 2000 --concurrency 1,8 --json handshake.json
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+from argparse import ArgumentParser
+from time import perf_counter
+from QUIC import QUICSocket
+from .common import summarize, get_free_port, format_table, finish, add_output_arguments
+from .loopback import REPOSITORY, READY, LOCALHOST, get_cpu_seconds
+
+CONNECTIONS = 1000
+CONCURRENCY = (1, 8)
+TIMEOUT = 120.0 # seconds a run may take before the connections still missing count as failed.
+REGRESSION_METRICS = ["handshakes_per_sec", "connect_ms_p50", "connect_ms_p99", "accept_ms_p50", "accept_ms_p99", "server_cpu_ms_per_handshake"]
+
+
+def count_open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def raise_fd_limit() -> None:
+    # Every connection has its own UDP socket, so thousands of them need more than the usual 1024 fds.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ---- Listeners ----
+
+def listen_with_accept(port: int, connections: int, timeout: float) -> dict:
+    """
+        Accepts the connections with QUICSocket.accept and keeps them open until
+        all of them have been accepted or the timeout passes.
+    """
+    server = QUICSocket(LOCALHOST)
+    server.listen(port)
+    accepted = []
+    handshake_times = []
+    fds = count_open_fds()
+    cpu = get_cpu_seconds()
+    cpu_seconds = [0.0] # Up to the last accept, not the time spent waiting for connections that never came.
+
+    def accept_all():
+        for i in range(connections):
+            connection = server.accept()
+            cpu_seconds[0] = get_cpu_seconds() - cpu
+            handshake_times.append(connection.get_stats().handshake_duration)
+            accepted.append(connection)
+
+    thread = threading.Thread(target=accept_all, daemon=True)
+    print(READY, flush=True)
+    thread.start()
+    thread.join(timeout)
+    return {"accepted": len(accepted), "cpu_seconds": cpu_seconds[0], "fds": count_open_fds() - fds, "handshake_times": list(handshake_times)}
+
+
+LISTENERS = {"accept": listen_with_accept}
+
+
+# ---- Client ----
+
+def connect_all(port: int, connections: int, concurrency: int, timeout: float) -> dict:
+    """
+        Opens the connections from concurrency threads, each connecting one after the
+        other. The connections are kept open until the end of the run: the listener
+        keeps its side open, and a new connection from the port of a closed one would
+        reach the socket of the old connection on the listener instead of the listener.
+    """
+    clients = []
+    connect_times = []
+    lock = threading.Lock()
+    remaining = [connections]
+    finished = [0.0] # When the last connection was established, hung connections don't count towards the rate.
+
+    def connect_loop():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            client = QUICSocket(LOCALHOST)
+            start = perf_counter()
+            client.connect((LOCALHOST, port))
+            elapsed = perf_counter() - start
+            with lock:
+                connect_times.append(elapsed)
+                finished[0] = perf_counter()
+                clients.append(client)
+
+    threads = [threading.Thread(target=connect_loop, daemon=True) for i in range(concurrency)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    deadline = start + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - perf_counter()))
+    with lock:
+        result = {"connected": len(connect_times), "seconds": max(finished[0] - start, 1e-9), "connect_times": list(connect_times)}
+        for client in clients:
+            client.close()
+    return result
+
+
+# ---- Runner ----
+
+def run_handshakes(listener: str, connections: int, concurrency: int, timeout: float) -> dict:
+    port = get_free_port()
+    command = [sys.executable, "-m", "benchmarks.handshake", "--listener", listener, "--connections", str(connections),
+               "--port", str(port), "--timeout", str(timeout)]
+    server = subprocess.Popen(command + ["--role", "server"], cwd=REPOSITORY, stdout=subprocess.PIPE, text=True)
+    try:
+        if server.stdout.readline().strip() != READY:
+            raise RuntimeError(f"The {listener} listener did not start.")
+        client = subprocess.run(command + ["--role", "client", "--concurrency", str(concurrency)], cwd=REPOSITORY,
+                                stdout=subprocess.PIPE, text=True, timeout=timeout * 2, check=True)
+        server_output, _ = server.communicate(timeout=timeout * 2)
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+    client_result = json.loads(client.stdout.splitlines()[-1])
+    server_result = json.loads(server_output.splitlines()[-1])
+    accepted = max(1, server_result["accepted"])
+    result = {"benchmark": "handshake", "mode": listener, "case": f"concurrency={concurrency}", "connections": connections,
+              "handshakes_per_sec": client_result["connected"] / client_result["seconds"],
+              "failed": connections - client_result["connected"]}
+    result.update(summarize(client_result["connect_times"], "connect_ms", 1e3))
+    result.update(summarize(server_result["handshake_times"], "accept_ms", 1e3))
+    result["server_cpu_seconds"] = server_result["cpu_seconds"]
+    # NaN metrics aren't compared to the baseline.
+    result["server_cpu_ms_per_handshake"] = server_result["cpu_seconds"] * 1e3 / accepted if result["failed"] == 0 else float("nan")
+    result["server_fds_per_connection"] = server_result["fds"] / accepted
+    return result
+
+
+def main(argv: list[str] = None) -> int:
+    parser = ArgumentParser(description="Measure how fast connections are established on loopback.")
+    parser.add_argument("--listener", default=",".join(LISTENERS), help="Comma separated listeners to measure.")
+    parser.add_argument("--connections", type=int, default=CONNECTIONS, help="Connections opened per run.")
+    parser.add_argument("--concurrency", default=",".join(map(str, CONCURRENCY)), help="Comma separated numbers of client threads connecting at once.")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="Seconds a run may take.")
+    add_output_arguments(parser)
+    # Used by the runner to start the listener and client processes.
+    parser.add_argument("--role", choices=["server", "client"], help="Run one side of a run.")
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args(argv)
+
+    if args.role == "server":
+        raise_fd_limit()
+        result = LISTENERS[args.listener](args.port, args.connections, args.timeout)
+        print(json.dumps(result), flush=True)
+        os._exit(0) # Threads still waiting on connections that never came are abandoned.
+    if args.role == "client":
+        raise_fd_limit()
+        result = connect_all(args.port, args.connections, int(args.concurrency), args.timeout)
+        print(json.dumps(result), flush=True)
+        os._exit(0)
+
+    results = []
+    for listener in [listener for listener in args.listener.split(",") if listener]:
+        for concurrency in [int(concurrency) for concurrency in args.concurrency.split(",") if concurrency]:
+            results.append(run_handshakes(listener, args.connections, concurrency, args.timeout))
+    print(format_table(results, ["mode", "case", "handshakes_per_sec", "connect_ms_p50", "connect_ms_p99", "accept_ms_p50",
+                                 "accept_ms_p99", "server_cpu_ms_per_handshake", "server_fds_per_connection", "failed"]))
+    return finish(results, args, REGRESSION_METRICS)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,355 @@
+"""
+    A UDP proxy that emulates a WAN path on loopback. Clients send to the
+    proxy, which relays their datagrams to the server from a socket of its own
+    per client and relays the answers back. Each direction has an Impairment
+    that decides, for every datagram, whether it is dropped and when each copy
+    of it is sent on:
+
+    loss: drops datagrams at random, or in bursts with a Gilbert-Elliott model.
+    rate and queue_size: a bottleneck link of rate bits per second with a drop tail
+        queue of queue_size bytes in front of it.
+    delay and jitter: a fixed one way delay plus a uniformly distributed jitter,
+        a large jitter also reorders datagrams.
+    reorder: datagrams sent on straight away, ahead of the ones being delayed.
+    duplicate: datagrams sent twice.
+    drop: indexes of datagrams that are always dropped, e.g. [4] for the fifth one.
+
+    The proxy sends the datagrams from a timer driven loop in its own thread, so
+    tests can start it, point a QUICSocket at get_address() and change the
+    impairments while a transfer is running:
+
+        proxy = ImpairmentProxy(("127.0.0.1", 8000), Impairment(delay=0.02, rate=10e6, queue_size=64000))
+        proxy.start()
+        client.connect(proxy.get_address())
+        proxy.set_impairments(upstream=Impairment(loss=1.0)) # The path goes down.
+        proxy.stop()
+
+    Or run it on its own from the repository root, with the impairments given as specs:
+        python -m benchmarks.impairment 9000 127.0.0.1:8000 --impairment delay=0.02,jitter=0.002,loss=0.01,burst=4
+"""
+
+import heapq
+import sys
+from argparse import ArgumentParser
+from random import Random
+from selectors import DefaultSelector, EVENT_READ
+from socket import socket, socketpair, AF_INET, SOCK_DGRAM
+from threading import Thread, Lock
+from time import perf_counter, sleep
+
+MAX_DATAGRAM = 65535
+UPSTREAM = "upstream"       # From the clients to the server.
+DOWNSTREAM = "downstream"   # From the server to the clients.
+# Names accepted in impairment specs, and the Impairment arguments they set.
+SPEC_FIELDS = {"loss": "loss", "burst": "burst_length", "delay": "delay", "jitter": "jitter", "rate": "rate",
+               "queue": "queue_size", "reorder": "reorder", "duplicate": "duplicate"}
+
+
+class GilbertElliott:
+    """
+        Bursty loss. The path is either in the good or the bad state and moves from
+        good to bad with probability p and from bad to good with probability r before
+        every datagram. Datagrams are lost with probability loss_good in the good state
+        and loss_bad in the bad state.
+    """
+
+    def __init__(self, p: float, r: float, loss_good: float = 0.0, loss_bad: float = 1.0):
+        self.p = p
+        self.r = r
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+        self.bad = False
+
+    def is_lost(self, random: Random) -> bool:
+        if random.random() < (self.r if self.bad else self.p):
+            self.bad = not self.bad
+        return random.random() < (self.loss_bad if self.bad else self.loss_good)
+
+
+def create_burst_loss(loss: float, burst_length: float) -> GilbertElliott:
+    # Loses the fraction loss of all datagrams, in bursts of burst_length datagrams on average.
+    if burst_length < 1:
+        raise ValueError("The burst length must be at least 1 datagram.")
+    if loss <= 0:
+        return GilbertElliott(p=0.0, r=1.0)
+    if loss >= 1:
+        return GilbertElliott(p=1.0, r=0.0)
+    r = 1 / burst_length
+    return GilbertElliott(p=min(1.0, loss * r / (1 - loss)), r=r)
+
+
+class Impairment:
+    """
+        The conditions of one direction of the path. loss is the probability of a datagram
+        being lost, spread out at random, or in bursts of burst_length datagrams on average if
+        burst_length is given. delay and jitter are in seconds, rate is in bits per second
+        (None for no bottleneck) and queue_size in bytes (None for an unlimited queue).
+        reorder and duplicate are probabilities per datagram. seed makes the decisions repeatable.
+    """
+
+    def __init__(self, loss: float = 0.0, burst_length: float = None, delay: float = 0.0, jitter: float = 0.0,
+                 rate: float = None, queue_size: int = None, reorder: float = 0.0, duplicate: float = 0.0,
+                 drop: list[int] = (), seed: int = None):
+        self.loss = loss
+        self.burst_loss = create_burst_loss(loss, burst_length) if burst_length is not None else None
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.queue_size = queue_size
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.drop = set(drop)
+        self.random = Random(seed)
+        self.link_free_at = 0.0 # When the bottleneck has sent everything queued so far.
+
+        # ---- Stats ----
+        self.datagrams_received = 0
+        self.datagrams_sent = 0
+        self.datagrams_lost = 0
+        self.datagrams_dropped = 0    # Dropped because the queue was full.
+        self.datagrams_duplicated = 0
+        self.datagrams_reordered = 0
+        self.bytes_sent = 0
+
+    def is_lost(self, index: int) -> bool:
+        if index in self.drop:
+            return True
+        if self.burst_loss is not None:
+            return self.burst_loss.is_lost(self.random)
+        return self.loss > 0 and self.random.random() < self.loss
+
+    def get_send_times(self, now: float, size: int) -> list[float]:
+        """
+            Returns the times at which the copies of a datagram of size bytes received at now
+            are sent on, an empty list if it is dropped.
+        """
+        index = self.datagrams_received
+        self.datagrams_received += 1
+        if self.is_lost(index):
+            self.datagrams_lost += 1
+            return []
+        copies = 1
+        if self.duplicate > 0 and self.random.random() < self.duplicate:
+            copies = 2
+            self.datagrams_duplicated += 1
+        send_times = []
+        for i in range(copies):
+            departure = now
+            if self.rate is not None:
+                # The datagram waits for the ones queued before it, unless they already fill the queue.
+                backlog = max(0.0, self.link_free_at - now) * self.rate / 8
+                if self.queue_size is not None and backlog + size > self.queue_size:
+                    self.datagrams_dropped += 1
+                    continue
+                departure = max(now, self.link_free_at) + size * 8 / self.rate
+                self.link_free_at = departure
+            if self.reorder > 0 and self.random.random() < self.reorder:
+                self.datagrams_reordered += 1
+                send_times.append(departure)
+                continue
+            delay = self.delay
+            if self.jitter > 0:
+                delay = max(0.0, delay + self.random.uniform(-self.jitter, self.jitter))
+            send_times.append(departure + delay)
+        return send_times
+
+    def on_sent(self, size: int) -> None:
+        self.datagrams_sent += 1
+        self.bytes_sent += size
+
+    def get_stats(self) -> dict:
+        return {"datagrams_received": self.datagrams_received, "datagrams_sent": self.datagrams_sent,
+                "datagrams_lost": self.datagrams_lost, "datagrams_dropped": self.datagrams_dropped,
+                "datagrams_duplicated": self.datagrams_duplicated, "datagrams_reordered": self.datagrams_reordered,
+                "bytes_sent": self.bytes_sent}
+
+
+def parse_impairment(spec: str, seed: int = None) -> Impairment:
+    """
+        Creates an Impairment from a spec like "delay=0.02,jitter=0.002,loss=0.01,burst=4,rate=10e6,queue=64000".
+        The names are the keys of SPEC_FIELDS, an empty spec is a perfect path.
+    """
+    arguments = {}
+    for item in [item.strip() for item in spec.split(",") if item.strip()]:
+        name, separator, value = item.partition("=")
+        if not separator or name not in SPEC_FIELDS:
+            raise ValueError(f"Unknown impairment '{item}', expected one of {', '.join(SPEC_FIELDS)} with a value.")
+        arguments[SPEC_FIELDS[name]] = int(float(value)) if name == "queue" else float(value)
+    return Impairment(seed=seed, **arguments)
+
+
+class ImpairmentProxy:
+    """
+        Relays datagrams between the clients sending to port on local_ip and the server at
+        server_address, delaying and dropping them as the impairments of each direction decide.
+        Every client gets its own socket towards the server, the first one is bound to
+        upstream_port (any free port if 0), the others to free ports.
+    """
+
+    def __init__(self, server_address: tuple[str, int], upstream: Impairment = None, downstream: Impairment = None,
+                 local_ip: str = "127.0.0.1", port: int = 0, upstream_port: int = 0):
+        self.server_address = server_address
+        self.local_ip = local_ip
+        self.upstream_port = upstream_port
+        self._impairments = {UPSTREAM: upstream or Impairment(), DOWNSTREAM: downstream or Impairment()}
+        self._lock = Lock() # Guards the impairments, which tests may replace while the proxy runs.
+        self._socket = socket(AF_INET, SOCK_DGRAM)
+        self._socket.bind((local_ip, port))
+        self._socket.setblocking(False)
+        self._flows: dict[tuple[str, int], socket] = dict() # Key: client address | Value: socket towards the server.
+        self._clients: dict[int, tuple[str, int]] = dict()  # Key: fd of a socket towards the server | Value: client address.
+        self._queue: list[tuple[float, int, socket, bytes, tuple[str, int], Impairment]] = [] # (send time, sequence, socket, datagram, address, impairment)
+        self._sequence = 0 # Keeps datagrams with the same send time in the order they were scheduled.
+        self._selector = DefaultSelector()
+        self._selector.register(self._socket, EVENT_READ)
+        # Writing to the wakeup socket interrupts the select, so that new impairments apply straight away.
+        self._wakeup_receiver, self._wakeup_sender = socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup_receiver, EVENT_READ)
+        self._thread = Thread(target=self.run, name="ImpairmentProxy", daemon=True)
+        self._running = False
+
+    def get_address(self) -> tuple[str, int]:
+        # The address clients send to.
+        return self._socket.getsockname()
+
+    def start(self) -> None:
+        self._running = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+            Stops relaying and closes the sockets. Datagrams still being delayed are dropped.
+        """
+        self._running = False
+        self.wakeup()
+        self._thread.join()
+        self._selector.close()
+        for udp_socket in [self._socket] + list(self._flows.values()):
+            udp_socket.close()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+
+    def wakeup(self) -> None:
+        try:
+            self._wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass # A wakeup is already pending.
+
+    def set_impairments(self, upstream: Impairment = None, downstream: Impairment = None) -> None:
+        # Replaces the impairment of either direction. Datagrams already scheduled are still sent when they were due.
+        with self._lock:
+            if upstream is not None:
+                self._impairments[UPSTREAM] = upstream
+            if downstream is not None:
+                self._impairments[DOWNSTREAM] = downstream
+        self.wakeup()
+
+    def get_impairment(self, direction: str) -> Impairment:
+        with self._lock:
+            return self._impairments[direction]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {direction: impairment.get_stats() for direction, impairment in self._impairments.items()}
+
+    def get_flow(self, client_address: tuple[str, int]) -> socket:
+        # The socket that relays the datagrams of a client to the server.
+        flow = self._flows.get(client_address)
+        if flow is None:
+            flow = socket(AF_INET, SOCK_DGRAM)
+            flow.bind((self.local_ip, self.upstream_port if not self._flows else 0))
+            flow.setblocking(False)
+            self._flows[client_address] = flow
+            self._clients[flow.fileno()] = client_address
+            self._selector.register(flow, EVENT_READ)
+        return flow
+
+    def schedule(self, direction: str, datagram: bytes, udp_socket: socket, address: tuple[str, int], now: float) -> None:
+        with self._lock:
+            impairment = self._impairments[direction]
+            send_times = impairment.get_send_times(now, len(datagram))
+        for send_time in send_times:
+            heapq.heappush(self._queue, (send_time, self._sequence, udp_socket, datagram, address, impairment))
+            self._sequence += 1
+
+    def receive(self, udp_socket: socket) -> None:
+        # Reads every datagram waiting on the socket and schedules it in its direction.
+        while True:
+            try:
+                datagram, address = udp_socket.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            now = perf_counter()
+            if udp_socket is self._socket:
+                self.schedule(UPSTREAM, datagram, self.get_flow(address), self.server_address, now)
+            else:
+                self.schedule(DOWNSTREAM, datagram, self._socket, self._clients[udp_socket.fileno()], now)
+
+    def send_due(self, now: float) -> None:
+        while self._queue and self._queue[0][0] <= now:
+            send_time, sequence, udp_socket, datagram, address, impairment = heapq.heappop(self._queue)
+            # Counted under the lock along with the send, so the stats never lag behind what was received.
+            with self._lock:
+                try:
+                    udp_socket.sendto(datagram, address)
+                except OSError:
+                    continue # The receiver isn't there (yet), the datagram is lost like on a real path.
+                impairment.on_sent(len(datagram))
+
+    def get_timeout(self) -> float or None:
+        if not self._queue:
+            return None
+        return max(0.0, self._queue[0][0] - perf_counter())
+
+    def run(self) -> None:
+        while self._running:
+            for key, mask in self._selector.select(self.get_timeout()):
+                if key.fileobj is self._wakeup_receiver:
+                    try:
+                        while self._wakeup_receiver.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.receive(key.fileobj)
+            self.send_due(perf_counter())
+
+
+def parse_address(text: str) -> tuple[str, int]:
+    host, separator, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def main(argv: list[str] = None) -> int:
+    parser = ArgumentParser(description="Relay UDP datagrams to a server through an emulated WAN path.")
+    parser.add_argument("port", type=int, help="The port clients send to.")
+    parser.add_argument("server", help="The server address as host:port.")
+    parser.add_argument("--local-ip", default="127.0.0.1", help="The address the proxy listens on.")
+    parser.add_argument("--impairment", default="", help=f"Impairment of both directions, e.g. delay=0.02,loss=0.01. Names: {', '.join(SPEC_FIELDS)}.")
+    parser.add_argument("--upstream", help="Impairment from the clients to the server, instead of --impairment.")
+    parser.add_argument("--downstream", help="Impairment from the server to the clients, instead of --impairment.")
+    parser.add_argument("--seed", type=int, help="Seed for repeatable losses and delays.")
+    args = parser.parse_args(argv)
+
+    # The directions get different seeds, the same one would lose the same datagrams in both.
+    upstream = parse_impairment(args.upstream if args.upstream is not None else args.impairment, args.seed)
+    downstream = parse_impairment(args.downstream if args.downstream is not None else args.impairment,
+                                  args.seed + 1 if args.seed is not None else None)
+    proxy = ImpairmentProxy(parse_address(args.server), upstream, downstream, args.local_ip, args.port)
+    proxy.start()
+    print(f"Relaying {proxy.get_address()[0]}:{proxy.get_address()[1]} to {args.server}, press Ctrl+C to stop.")
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    proxy.stop()
+    for direction, stats in proxy.get_stats().items():
+        print(direction, " ".join(f"{name}={value}" for name, value in stats.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+    End to end benchmark of QUIC against TCP on loopback. For every protocol
+    the server and the client are started in their own processes, so that
+    each side has its own interpreter, and two tests are run:
+
+    goodput: the client sends size bytes on one stream and the server answers
+    with a single byte once it has received all of them. The time is taken
+    from the start of the send until the answer arrives, so it measures
+    delivery to the receiving application and not only local buffering.
+
+    latency: the client sends count requests of size bytes one after the
+    other and the server echoes each of them back. The round trip time of
+    every request is recorded, the first warmup requests are left out.
+
+    quic-unix runs QUIC over Unix datagram sockets (UnixTransport) instead of
+    UDP, which shows what same-host services gain by skipping the IP stack.
+
+    With --impairment the QUIC client reaches the server through an
+    ImpairmentProxy (see benchmarks/impairment.py) that emulates a WAN path,
+    e.g. --impairment delay=0.02,loss=0.01,rate=50e6,queue=100000. The proxy
+    only relays UDP, so TCP and quic-unix aren't run then.
+
+    Run from the repository root:
+        python -m benchmarks.loopback --json loopback.json --save-baseline baseline.json
+        python -m benchmarks.loopback --baseline baseline.json
+        python -m benchmarks.loopback --protocols quic --impairment delay=0.02,loss=0.01
+"""
+
+import json
+import resource
+import subprocess
+import sys
+from argparse import ArgumentParser
+from functools import partial
+from os.path import abspath, dirname, join
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, IPPROTO_TCP, TCP_NODELAY
+from tempfile import gettempdir
+from time import perf_counter
+from QUIC import QUICSocket, UnixTransport
+from .common import summarize, get_free_port, format_table, finish, add_output_arguments
+from .impairment import ImpairmentProxy, parse_impairment
+
+REPOSITORY = dirname(dirname(abspath(__file__)))
+PROTOCOLS = ("quic", "quic-unix", "tcp")
+GOODPUT_SIZES = (100_000, 1_000_000, 10_000_000)
+MESSAGE_SIZES = (64, 1024, 16384)
+REQUESTS = 200
+WARMUP_REQUESTS = 10
+REPEATS = 3                 # Goodput runs per size, the median is reported.
+PROCESS_TIMEOUT = 600       # seconds
+READY = "ready"             # Printed by a server once it accepts connections.
+ANSWER = b"\x01"
+REGRESSION_METRICS = ["goodput_mbps", "requests_per_sec", "latency_us_p50", "latency_us_p99"]
+LOCALHOST = "127.0.0.1"
+SEED = 1                    # The impaired path loses and delays the same datagrams in every run.
+
+
+def get_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+# ---- QUIC endpoints ----
+
+def get_unix_path(port: int) -> str:
+    # The Unix socket the quic-unix server listens on, named after the port the runner picked.
+    return join(gettempdir(), f"quic-loopback-{port}.sock")
+
+
+def serve_quic(port: int, test: str, size: int, count: int, unix: bool = False) -> None:
+    server = QUICSocket(LOCALHOST, UnixTransport() if unix else None)
+    server.listen(get_unix_path(port) if unix else port)
+    print(READY, flush=True)
+    connection = server.accept()
+    server.get_transport().close()
+    buffer = bytearray(size)
+    if test == "goodput":
+        connection.recv_exactly(1, buffer)
+        connection.send(1, ANSWER)
+    else:
+        for i in range(count):
+            connection.recv_exactly(1, buffer)
+            connection.send(1, buffer)
+    # Keep acknowledging until the client closes the connection.
+    connection.recv_exactly(1, bytearray(1))
+    connection.release()
+
+
+def run_quic_client(port: int, test: str, size: int, count: int, unix: bool = False) -> list[float]:
+    client = QUICSocket(LOCALHOST, UnixTransport() if unix else None)
+    client.connect(get_unix_path(port) if unix else (LOCALHOST, port))
+    samples = []
+    if test == "goodput":
+        data = bytes(size)
+        start = perf_counter()
+        client.send(1, data)
+        client.recv_exactly(1, bytearray(1))
+        samples.append(perf_counter() - start)
+    else:
+        request, response = bytes(size), bytearray(size)
+        for i in range(count):
+            start = perf_counter()
+            client.send(1, request)
+            client.recv_exactly(1, response)
+            samples.append(perf_counter() - start)
+    client.close()
+    return samples
+
+
+# ---- TCP endpoints ----
+
+def receive_exactly(connection: socket, buffer: bytearray) -> None:
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(view):
+        received = connection.recv_into(view[filled:])
+        if received == 0:
+            raise ConnectionError("The peer closed the connection.")
+        filled += received
+
+
+def serve_tcp(port: int, test: str, size: int, count: int) -> None:
+    server = socket(AF_INET, SOCK_STREAM)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server.bind((LOCALHOST, port))
+    server.listen()
+    print(READY, flush=True)
+    connection, address = server.accept()
+    connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    buffer = bytearray(size)
+    if test == "goodput":
+        receive_exactly(connection, buffer)
+        connection.sendall(ANSWER)
+    else:
+        for i in range(count):
+            receive_exactly(connection, buffer)
+            connection.sendall(buffer)
+    connection.recv(1)
+    connection.close()
+    server.close()
+
+
+def run_tcp_client(port: int, test: str, size: int, count: int) -> list[float]:
+    client = socket(AF_INET, SOCK_STREAM)
+    client.connect((LOCALHOST, port))
+    client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    samples = []
+    if test == "goodput":
+        data = bytes(size)
+        start = perf_counter()
+        client.sendall(data)
+        receive_exactly(client, bytearray(1))
+        samples.append(perf_counter() - start)
+    else:
+        request, response = bytes(size), bytearray(size)
+        for i in range(count):
+            start = perf_counter()
+            client.sendall(request)
+            receive_exactly(client, response)
+            samples.append(perf_counter() - start)
+    client.close()
+    return samples
+
+
+SERVERS = {"quic": serve_quic, "quic-unix": partial(serve_quic, unix=True), "tcp": serve_tcp}
+CLIENTS = {"quic": run_quic_client, "quic-unix": partial(run_quic_client, unix=True), "tcp": run_tcp_client}
+
+
+# ---- Runner ----
+
+def run_pair(protocol: str, test: str, size: int, count: int = 1, impairment: str = None) -> tuple[list[float], float, float]:
+    """
+        Runs the server and the client of one test in their own processes on loopback,
+        through an ImpairmentProxy in this process if an impairment spec is given.
+        Returns the client's samples and the CPU seconds used by the client and the server.
+    """
+    port = get_free_port()
+    command = [sys.executable, "-m", "benchmarks.loopback", "--protocol", protocol, "--test", test,
+               "--size", str(size), "--count", str(count)]
+    proxy = None
+    client_port = port
+    if impairment is not None:
+        proxy = ImpairmentProxy((LOCALHOST, port), parse_impairment(impairment, SEED), parse_impairment(impairment, SEED + 1))
+        proxy.start()
+        client_port = proxy.get_address()[1]
+    server = subprocess.Popen(command + ["--role", "server", "--port", str(port)], cwd=REPOSITORY, stdout=subprocess.PIPE, text=True)
+    try:
+        if server.stdout.readline().strip() != READY:
+            raise RuntimeError(f"The {protocol} server did not start.")
+        client = subprocess.run(command + ["--role", "client", "--port", str(client_port)], cwd=REPOSITORY, stdout=subprocess.PIPE,
+                                text=True, timeout=PROCESS_TIMEOUT, check=True)
+        server_output, _ = server.communicate(timeout=PROCESS_TIMEOUT)
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+        if proxy is not None:
+            proxy.stop()
+    client_result = json.loads(client.stdout.splitlines()[-1])
+    server_result = json.loads(server_output.splitlines()[-1])
+    return client_result["samples"], client_result["cpu_seconds"], server_result["cpu_seconds"]
+
+
+def run_goodput(protocol: str, size: int, repeats: int, impairment: str = None) -> dict:
+    runs = [run_pair(protocol, "goodput", size, impairment=impairment) for i in range(repeats)]
+    # The run with the median time is reported, along with its CPU usage.
+    runs.sort(key=lambda run: run[0][0])
+    samples, client_cpu, server_cpu = runs[len(runs) // 2]
+    seconds = samples[0]
+    result = {"benchmark": "loopback", "protocol": protocol, "test": "goodput", "size": size, "seconds": seconds,
+              "goodput_mbps": size * 8 / seconds / 1e6, "client_cpu_s": client_cpu, "server_cpu_s": server_cpu,
+              "repeats": repeats, "spread_s": runs[-1][0][0] - runs[0][0][0]}
+    if impairment is not None:
+        result["mode"] = impairment
+    return result
+
+
+def run_latency(protocol: str, size: int, count: int, warmup: int, impairment: str = None) -> dict:
+    samples, client_cpu, server_cpu = run_pair(protocol, "latency", size, count + warmup, impairment)
+    samples = samples[warmup:]
+    result = {"benchmark": "loopback", "protocol": protocol, "test": "latency", "size": size, "requests": len(samples),
+              "requests_per_sec": len(samples) / sum(samples)}
+    if impairment is not None:
+        result["mode"] = impairment
+    result.update(summarize(samples, "latency_us", 1e6))
+    result.update({"client_cpu_s": client_cpu, "server_cpu_s": server_cpu})
+    return result
+
+
+def add_tcp_comparison(results: list[dict]) -> None:
+    # QUIC's goodput and median latency as a multiple of TCP's, e.g. 0.5 is half the goodput or half the latency.
+    tcp = {(result["test"], result["size"]): result for result in results if result["protocol"] == "tcp"}
+    for result in results:
+        baseline = tcp.get((result["test"], result["size"]))
+        if result["protocol"] == "tcp" or baseline is None:
+            continue
+        metric = "goodput_mbps" if result["test"] == "goodput" else "latency_us_p50"
+        result["vs_tcp"] = result[metric] / baseline[metric]
+
+
+def run_suite(protocols, goodput_sizes, message_sizes, count: int, warmup: int, repeats: int, impairment: str = None) -> list[dict]:
+    results = []
+    for size in goodput_sizes:
+        for protocol in protocols:
+            results.append(run_goodput(protocol, size, repeats, impairment))
+    for size in message_sizes:
+        for protocol in protocols:
+            results.append(run_latency(protocol, size, count, warmup, impairment))
+    add_tcp_comparison(results)
+    return results
+
+
+def parse_sizes(text: str) -> list[int]:
+    return [int(size) for size in text.split(",") if size]
+
+
+def main(argv: list[str] = None) -> int:
+    parser = ArgumentParser(description="Compare QUIC to TCP on loopback.")
+    parser.add_argument("--protocols", default=",".join(PROTOCOLS), help="Comma separated protocols to run.")
+    parser.add_argument("--sizes", default=",".join(map(str, GOODPUT_SIZES)), help="Comma separated transfer sizes for the goodput test, empty to skip it.")
+    parser.add_argument("--message-sizes", default=",".join(map(str, MESSAGE_SIZES)), help="Comma separated message sizes for the latency test, empty to skip it.")
+    parser.add_argument("--requests", type=int, default=REQUESTS, help="Requests timed per message size.")
+    parser.add_argument("--warmup", type=int, default=WARMUP_REQUESTS, help="Requests sent before timing starts.")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="Goodput runs per size.")
+    parser.add_argument("--impairment", help="Run QUIC through an emulated WAN path, e.g. delay=0.02,loss=0.01,rate=50e6.")
+    add_output_arguments(parser)
+    # Used by the runner to start the server and client processes.
+    parser.add_argument("--role", choices=["server", "client"], help="Run one endpoint of a test.")
+    parser.add_argument("--protocol", choices=PROTOCOLS)
+    parser.add_argument("--test", choices=["goodput", "latency"])
+    parser.add_argument("--size", type=int)
+    parser.add_argument("--count", type=int)
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args(argv)
+
+    if args.role == "server":
+        SERVERS[args.protocol](args.port, args.test, args.size, args.count)
+        print(json.dumps({"cpu_seconds": get_cpu_seconds()}))
+        return 0
+    if args.role == "client":
+        samples = CLIENTS[args.protocol](args.port, args.test, args.size, args.count)
+        print(json.dumps({"samples": samples, "cpu_seconds": get_cpu_seconds()}))
+        return 0
+
+    protocols = [protocol for protocol in args.protocols.split(",") if protocol]
+    if args.impairment is not None and ("tcp" in protocols or "quic-unix" in protocols):
+        print("The impairment proxy only relays UDP, TCP and quic-unix are left out.")
+        protocols = [protocol for protocol in protocols if protocol not in ("tcp", "quic-unix")]
+    results = run_suite(protocols, parse_sizes(args.sizes), parse_sizes(args.message_sizes), args.requests, args.warmup,
+                        args.repeats, args.impairment)
+    print(format_table([result for result in results if result["test"] == "goodput"],
+                       ["protocol", "size", "seconds", "goodput_mbps", "client_cpu_s", "server_cpu_s", "vs_tcp"]))
+    print()
+    print(format_table([result for result in results if result["test"] == "latency"],
+                       ["protocol", "size", "requests_per_sec", "latency_us_p50", "latency_us_p90", "latency_us_p99", "latency_us_max", "vs_tcp"]))
+    return finish(results, args, REGRESSION_METRICS)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""
+    Micro-benchmarks of the hot paths that don't need a socket: parsing and
+    serializing packets, building ACK frames, processing ACKs, loss detection
+    and stream reassembly. Every case is run in the benchmark process itself.
+
+    A case is timed by running it in a loop. The number of runs per sample is
+    doubled until a sample takes at least --min-time seconds, then --repeat
+    samples are taken with the garbage collector disabled. Reported for every case:
+
+    ns_per_op: median time of one run over the samples, the metric compared to the baseline.
+    ns_per_op_min: fastest sample, the least disturbed by the rest of the machine.
+    iqr_pct: interquartile range of the samples as a percentage of the median, how noisy the case was.
+    ops_per_sec: runs per second at the median time.
+
+    Cases that change the state they run on (e.g. removing acknowledged packets) create
+    a fresh state before every run, outside of the timed part.
+
+    Run from the repository root:
+        python -m benchmarks.micro --save-baseline micro-baseline.json
+        python -m benchmarks.micro --baseline micro-baseline.json --filter parse
+"""
+
+import gc
+import sys
+from argparse import ArgumentParser
+from random import Random
+from statistics import median
+from time import perf_counter_ns, time
+from QUIC.QUICPacket import *
+from QUIC.QUICPacketParser import parse_packet_bytes
+from QUIC.QUICConnection import create_connection_id
+from QUIC.QUICNetworkController import QUICNetworkController, QUICSenderSideController, QUICPacketizer, PacketSentInfo, MAX_ACK_PACKET_NUMBERS
+from QUIC.QUICStream import ReceiveStream
+from .common import percentile, format_table, finish, add_output_arguments
+
+MIN_TIME = 0.05         # seconds a sample takes at least.
+REPEATS = 15            # samples per case.
+SEED = 1                # The reordered frames are the same in every run.
+PACKETS_IN_FLIGHT = 1000
+FRAME_SIZE = 1000       # bytes of stream data in a frame.
+REORDER_DISTANCE = 8    # Frames are moved up to this many places in the reordered case.
+REGRESSION_METRICS = ["ns_per_op"]
+
+
+class Case:
+    """
+        A named piece of code to time. run is called with the state returned by setup,
+        or with None if there is no setup. If fresh is True, setup is called before every
+        run, otherwise once per sample.
+    """
+
+    def __init__(self, name: str, run, setup=None, fresh: bool = False):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.fresh = fresh
+
+    def sample(self, runs: int) -> int:
+        # Returns the nanoseconds spent in run over the given number of runs.
+        run, setup = self.run, self.setup
+        if self.fresh:
+            total = 0
+            for i in range(runs):
+                state = setup()
+                start = perf_counter_ns()
+                run(state)
+                total += perf_counter_ns() - start
+            return total
+        state = setup() if setup is not None else None
+        start = perf_counter_ns()
+        for i in range(runs):
+            run(state)
+        return perf_counter_ns() - start
+
+
+def measure(case: Case, min_time: float, repeats: int) -> dict:
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # The calibration runs also warm up the caches and the interpreter.
+        runs = 1
+        while case.sample(runs) < min_time * 1e9:
+            runs *= 2
+        samples = [case.sample(runs) / runs for i in range(repeats)]
+    finally:
+        if enabled:
+            gc.enable()
+    ns_per_op = median(samples)
+    return {"benchmark": "micro", "case": case.name, "ns_per_op": ns_per_op, "ns_per_op_min": min(samples),
+            "iqr_pct": (percentile(samples, 75) - percentile(samples, 25)) / ns_per_op * 100,
+            "ops_per_sec": 1e9 / ns_per_op, "runs": runs, "repeats": repeats}
+
+
+# ---- Packets ----
+
+def create_ack_ranges(largest: int, count: int) -> AckFrame:
+    # An ACK frame with count ranges of 3 packets, each separated from the next one by a single missing packet.
+    ranges = [AckRange(gap=0, ack_range_length=3) for i in range(count)]
+    return AckFrame(largest_acknowledged=largest, ack_delay=0, ack_range_count=count, first_ack_range=2, ack_range=ranges)
+
+
+FRAMES = {
+    "stream": StreamFrame(stream_id=4, offset=1 << 20, length=FRAME_SIZE, data=bytes(FRAME_SIZE)),
+    "crypto": CryptoFrame(offset=0, length=32, data=bytes(32)),
+    "ack": create_ack_ranges(100_000, 32),
+    "max_data": MaxDataFrame(maximum_data=1 << 24),
+    "max_stream_data": MaxStreamDataFrame(stream_id=4, maximum_stream_data=1 << 22),
+    "data_blocked": DataBlockedFrame(maximum_data=1 << 24),
+    "stream_data_blocked": StreamDataBlockedFrame(stream_id=4, maximum_stream_data=1 << 22),
+    "max_streams": MaxStreamsFrame(maximum_streams=1 << 16),
+    "connection_close": ConnectionCloseFrame(error_code=0, reason_phrase_len=6, reason_phrase=b"closed"),
+}
+
+
+def create_packet(frame) -> Packet:
+    return Packet(header=ShortHeader(destination_connection_id=create_connection_id(), packet_number=1 << 20), frames=[frame])
+
+
+def get_packet_cases() -> list[Case]:
+    cases = []
+    for name, frame in FRAMES.items():
+        raw = create_packet(frame).raw()
+        cases.append(Case(f"parse_{name}", lambda state, raw=raw: parse_packet_bytes(raw)))
+    for name in ("stream", "ack"):
+        packet = create_packet(FRAMES[name])
+        cases.append(Case(f"raw_{name}", lambda state, packet=packet: packet.raw()))
+    return cases
+
+
+# ---- ACK frames and loss detection ----
+
+def get_gapped_packet_numbers(count: int) -> list[int]:
+    # count packet numbers with every fourth one missing.
+    return [pn for pn in range(count * 4 // 3 + 1) if pn % 4 != 3][:count]
+
+
+def create_ack_frame_case() -> Case:
+    packetizer = QUICPacketizer()
+    packet_numbers = get_gapped_packet_numbers(MAX_ACK_PACKET_NUMBERS)
+    return Case("create_ack_frame_gaps", lambda state: packetizer.create_ack_frame(packet_numbers))
+
+
+def create_controller_with_packets_in_flight(packet_numbers: list[int]) -> QUICNetworkController:
+    """
+        A controller that has sent a packet with FRAME_SIZE bytes of stream 0 for every
+        packet number, none of them acknowledged yet.
+    """
+    controller = QUICNetworkController()
+    controller.create_stream(0)
+    stream = controller.get_send_streams()[0]
+    stream.write(bytes(len(packet_numbers) * FRAME_SIZE))
+    sender = controller._sender_side_controller
+    now = time()
+    for i, pn in enumerate(packet_numbers):
+        info = PacketSentInfo(in_flight=True, sent_bytes=FRAME_SIZE + 30, time_sent=now, packet_number=pn, ack_eliciting=True)
+        info.stream_ranges.append((0, i * FRAME_SIZE, FRAME_SIZE, False))
+        sender.packets_sent[pn] = info
+        sender.bytes_in_flight += info.sent_bytes
+    sender.largest_sent_packet_number = packet_numbers[-1]
+    return controller
+
+
+def get_ack_cases() -> list[Case]:
+    contiguous = list(range(PACKETS_IN_FLIGHT))
+    contiguous_ack = AckFrame(largest_acknowledged=contiguous[-1], ack_delay=0, ack_range_count=0, first_ack_range=len(contiguous)-1, ack_range=[])
+    # The packet numbers missing from the ACK with ranges were never sent, so no packet is declared lost.
+    gapped = get_gapped_packet_numbers(PACKETS_IN_FLIGHT)
+    gapped_ack = QUICPacketizer().create_ack_frame(list(gapped))
+    return [
+        Case("on_ack_frame_received_contiguous",
+             lambda controller: controller.on_ack_frame_received(contiguous_ack, None),
+             lambda: create_controller_with_packets_in_flight(contiguous), fresh=True),
+        Case("on_ack_frame_received_ranges",
+             lambda controller: controller.on_ack_frame_received(gapped_ack, None),
+             lambda: create_controller_with_packets_in_flight(gapped), fresh=True),
+    ]
+
+
+def create_sender_with_packets_in_flight(time_sent: float, packet_threshold: int = None) -> QUICSenderSideController:
+    sender = QUICSenderSideController()
+    if packet_threshold is not None:
+        sender.packet_threshold = packet_threshold
+    sender.update_rtt(0.01)
+    for pn in range(PACKETS_IN_FLIGHT):
+        sender.packets_sent[pn] = PacketSentInfo(in_flight=True, sent_bytes=1200, time_sent=time_sent, packet_number=pn, ack_eliciting=True)
+        sender.bytes_in_flight += 1200
+    sender.largest_sent_packet_number = PACKETS_IN_FLIGHT
+    return sender
+
+
+def get_loss_detection_cases() -> list[Case]:
+    return [
+        # Every packet is below the largest acknowledged one but none of them is lost yet, so the
+        # whole list is checked against both thresholds and only the loss timer is set.
+        Case("detect_lost_packets_none",
+             lambda sender: sender.detect_and_remove_lost_packets(PACKETS_IN_FLIGHT - 1),
+             lambda: create_sender_with_packets_in_flight(time() + 3600, PACKETS_IN_FLIGHT)),
+        # The packet after all of them is acknowledged, so all but the last few are lost.
+        Case("detect_lost_packets_all",
+             lambda sender: sender.detect_and_remove_lost_packets(PACKETS_IN_FLIGHT),
+             lambda: create_sender_with_packets_in_flight(time()), fresh=True),
+    ]
+
+
+# ---- Stream reassembly ----
+
+def get_reassembly_cases() -> list[Case]:
+    random = Random(SEED)
+    frames = [(i * FRAME_SIZE, bytes(FRAME_SIZE)) for i in range(PACKETS_IN_FLIGHT)]
+    # Every frame is moved by up to REORDER_DISTANCE places, like a path that reorders a little.
+    reordered = sorted(frames, key=lambda frame: frame[0] // FRAME_SIZE + random.uniform(0, REORDER_DISTANCE))
+    shuffled = list(frames)
+    random.shuffle(shuffled)
+    # The last frame is received first, so everything else is buffered out of order until the first one arrives.
+    reversed_frames = frames[::-1]
+
+    def receive_all(frames):
+        stream = ReceiveStream(stream_id=0)
+        for offset, data in frames:
+            stream.receive(offset, data)
+
+    return [Case(f"receive_stream_{name}", lambda state, frames=frames: receive_all(frames))
+            for name, frames in (("in_order", frames), ("reordered", reordered), ("shuffled", shuffled), ("reversed", reversed_frames))]
+
+
+def get_cases() -> list[Case]:
+    return get_packet_cases() + [create_ack_frame_case()] + get_ack_cases() + get_loss_detection_cases() + get_reassembly_cases()
+
+
+def main(argv: list[str] = None) -> int:
+    parser = ArgumentParser(description="Time the packet, ACK, loss detection and reassembly code without sockets.")
+    parser.add_argument("--filter", default="", help="Only run the cases whose name contains this text.")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, help="Seconds a sample takes at least.")
+    parser.add_argument("--repeat", type=int, default=REPEATS, help="Samples taken per case.")
+    parser.add_argument("--list", action="store_true", help="List the cases and exit.")
+    add_output_arguments(parser)
+    args = parser.parse_args(argv)
+
+    cases = [case for case in get_cases() if args.filter in case.name]
+    if args.list:
+        for case in cases:
+            print(case.name)
+        return 0
+    results = []
+    for case in cases:
+        print(f"{case.name}...", file=sys.stderr, flush=True)
+        results.append(measure(case, args.min_time, args.repeat))
+    print(format_table(results, ["case", "ns_per_op", "ns_per_op_min", "iqr_pct", "ops_per_sec", "runs"]))
+    return finish(results, args, REGRESSION_METRICS)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+"""
+    Simulates a bulk transfer between two QUICNetworkControllers in memory, on a
+    virtual clock. The controllers are the real ones, only their transports and
+    their clock are replaced: datagrams go through an Impairment per direction
+    (see benchmarks/impairment.py) that decides when they arrive, and the clock
+    jumps straight to the next arrival or connection timer instead of waiting.
+
+    Nothing depends on the wall clock or on unseeded randomness, so a run is
+    reproducible: the same arguments send the same datagrams at the same virtual
+    times, which the digest in the results checks. This makes the loss recovery,
+    congestion control and ACK behaviour testable, e.g.:
+
+        simulation = Simulation(Impairment(rate=10e6, delay=0.02, queue_size=64000, loss=0.01, seed=1),
+                                Impairment(delay=0.02, seed=2))
+        simulation.client._sender_side_controller.packet_threshold = 5 # Try another reordering threshold.
+        result = simulation.run(duration=60.0)
+
+    The connections start out connected, the handshake isn't simulated: create_connection
+    and accept_connection loop until the peer has answered, so they can't be stepped by
+    the simulation. QueueTransport isn't used either, it delivers datagrams straight away
+    instead of at the times the impairments decide. The client always has data to send
+    on stream 1 and the server reads it as soon as it arrives.
+
+    A run takes as long as the controllers need to process its datagrams, 100 to 200
+    microseconds per datagram for both ends together. A transfer of a few Mbit/s simulates
+    many times faster than real time, one that fills a 10 Mbit/s path takes about as long
+    as the time it simulates. Running 60 seconds of such a transfer in well under a second
+    would need a packet codec and controllers that aren't written in Python, so that isn't
+    a goal of the simulation.
+
+    Run from the repository root:
+        python -m benchmarks.simulation --duration 60 --impairment rate=10e6,delay=0.02,queue=64000,loss=0.01
+"""
+
+import hashlib
+import heapq
+import sys
+from argparse import ArgumentParser
+from collections import deque
+from struct import pack
+from time import perf_counter
+from QUIC.QUICNetworkController import QUICNetworkController, CONNECTED, CLOSED, TIMER_GRANULARITY
+from QUIC.QUICTransport import DatagramTransport, RECEIVE_BATCH
+from .common import format_table, finish, add_output_arguments
+from .impairment import Impairment, parse_impairment
+
+START_TIME = 1.0                # A timestamp of 0 means "never" to the controllers, so the clock starts later.
+CLIENT_ADDRESS = ("10.0.0.1", 4433)
+SERVER_ADDRESS = ("10.0.0.2", 4433)
+CLIENT_CONNECTION_ID = 1
+SERVER_CONNECTION_ID = 2
+STREAM_ID = 1
+SEND_CHUNK = 64 * 1024          # bytes the client queues at once.
+SEND_BACKLOG = 256 * 1024       # The client queues more data whenever less than this is waiting to be sent.
+READ_SIZE = 256 * 1024
+SAMPLE_INTERVAL = 0.1           # virtual seconds between the samples of the client's congestion state.
+SEED = 1
+DIGEST_FORMAT = "!d?H"          # The time, direction and length of each datagram, hashed before its bytes.
+REGRESSION_METRICS = ["goodput_mbps"]
+
+
+class VirtualClock:
+    """
+        A clock that only moves when it is told to. Called like time.time.
+    """
+
+    def __init__(self, now: float = START_TIME):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, now: float) -> None:
+        self.now = max(self.now, now)
+
+
+class SimulatedTransport(DatagramTransport):
+    """
+        The transport of a controller in the simulation. Datagrams sent on it are handed to the
+        simulation, datagrams delivered to it wait in inbox until the controller receives them.
+    """
+
+    def __init__(self, simulation, address: tuple[str, int]):
+        self.simulation = simulation
+        self.address = address
+        self.inbox: deque[tuple[bytes, tuple[str, int]]] = deque()
+
+    def send(self, datagram: bytes, address: tuple[str, int]) -> None:
+        self.simulation.transmit(self.address, address, bytes(datagram))
+
+    def receive_batch(self, max_datagrams: int = RECEIVE_BATCH) -> list[tuple[bytes, tuple[str, int]]]:
+        return [self.inbox.popleft() for i in range(min(max_datagrams, len(self.inbox)))]
+
+    def wait_readable(self, timeout: float or None) -> bool:
+        # Nothing arrives while a controller waits, the simulation calls the controllers when there is something to do.
+        return bool(self.inbox)
+
+    def get_local_address(self) -> tuple[str, int]:
+        return self.address
+
+    def get_peer_address(self) -> tuple[str, int]:
+        return CLIENT_ADDRESS if self.address == SERVER_ADDRESS else SERVER_ADDRESS
+
+    def close(self) -> None:
+        self.inbox.clear()
+
+
+class Simulation:
+    """
+        A client controller sending to a server controller over a simulated path. upstream is
+        the Impairment of the path from the client to the server, downstream of the way back.
+        client and server are the controllers, they can be configured before run is called.
+    """
+
+    def __init__(self, upstream: Impairment, downstream: Impairment):
+        self.clock = VirtualClock()
+        self.links = {(CLIENT_ADDRESS, SERVER_ADDRESS): upstream, (SERVER_ADDRESS, CLIENT_ADDRESS): downstream}
+        self.client = self.create_controller(CLIENT_ADDRESS, SERVER_ADDRESS, CLIENT_CONNECTION_ID, SERVER_CONNECTION_ID, False)
+        self.server = self.create_controller(SERVER_ADDRESS, CLIENT_ADDRESS, SERVER_CONNECTION_ID, CLIENT_CONNECTION_ID, True)
+        self.transports = {CLIENT_ADDRESS: SimulatedTransport(self, CLIENT_ADDRESS), SERVER_ADDRESS: SimulatedTransport(self, SERVER_ADDRESS)}
+        self.controllers = {CLIENT_ADDRESS: self.client, SERVER_ADDRESS: self.server}
+        self.serviced_at = {CLIENT_ADDRESS: None, SERVER_ADDRESS: None}
+        self.queue: list[tuple[float, int, tuple[str, int], tuple[str, int], bytes]] = [] # (arrival, sequence, source, destination, datagram)
+        self.sequence = 0
+        self.digest = hashlib.sha256() # Of every datagram sent, with its time and direction.
+        self.datagrams_sent = 0
+        self.bytes_queued = 0
+        self.bytes_delivered = 0
+        self.samples: list[tuple[float, float, int, float]] = [] # (time, congestion window, bytes in flight, smoothed RTT) of the client.
+        self.read_buffer = bytearray(READ_SIZE)
+
+    def create_controller(self, address, peer_address, connection_id: int, peer_connection_id: int, is_server: bool) -> QUICNetworkController:
+        controller = QUICNetworkController()
+        controller.set_clock(self.clock)
+        controller.is_server = is_server
+        context = controller.get_connection_context()
+        context.set_local_address(address)
+        context.set_peer_address(peer_address)
+        context.set_local_connection_id(connection_id)
+        context.set_peer_connection_id(peer_connection_id)
+        context.set_connected(True)
+        controller.state = CONNECTED
+        controller.create_stream(STREAM_ID)
+        return controller
+
+    def transmit(self, source: tuple[str, int], destination: tuple[str, int], datagram: bytes) -> None:
+        now = self.clock()
+        self.datagrams_sent += 1
+        self.digest.update(pack(DIGEST_FORMAT, now, source == CLIENT_ADDRESS, len(datagram)))
+        self.digest.update(datagram)
+        for arrival in self.links[(source, destination)].get_send_times(now, len(datagram)):
+            heapq.heappush(self.queue, (arrival, self.sequence, source, destination, datagram))
+            self.sequence += 1
+
+    def get_deadline(self, address: tuple[str, int]) -> float or None:
+        deadline = self.controllers[address].get_service_deadline()
+        serviced_at = self.serviced_at[address]
+        if deadline is not None and serviced_at is not None and deadline <= serviced_at:
+            # Servicing didn't change anything that the deadline depends on (e.g. the stream is blocked
+            # by flow control), so the connection is looked at again one timer tick later like the reactor does.
+            deadline = serviced_at + TIMER_GRANULARITY
+        return deadline
+
+    def service(self, address: tuple[str, int]) -> None:
+        controller, transport = self.controllers[address], self.transports[address]
+        with controller.lock:
+            controller.service(transport)
+            if controller is self.client:
+                self.feed(controller, transport)
+            else:
+                # Every read polls the transport again, so only read again if the buffer was filled.
+                num_bytes = READ_SIZE
+                while num_bytes == READ_SIZE:
+                    num_bytes, finished = controller.read_stream_data_into(STREAM_ID, self.read_buffer, transport)
+                    self.bytes_delivered += num_bytes
+        self.serviced_at[address] = self.clock()
+
+    def feed(self, controller: QUICNetworkController, transport: SimulatedTransport) -> None:
+        # Keeps the client's stream backlogged, so the transfer is limited by the path and the controllers.
+        stream = controller.get_send_streams()[STREAM_ID]
+        while stream.pending_size < SEND_BACKLOG:
+            try:
+                controller.send_stream_data(STREAM_ID, bytes(SEND_CHUNK), transport, block=False)
+            except BlockingIOError:
+                return # The memory budget is used up.
+            self.bytes_queued += SEND_CHUNK
+
+    def sample(self) -> None:
+        sender = self.client._sender_side_controller
+        self.samples.append((self.clock() - START_TIME, sender.congestion_window, sender.bytes_in_flight, sender.smoothed_rtt))
+
+    def run(self, duration: float) -> dict:
+        """
+            Runs the transfer for duration virtual seconds and returns its results.
+        """
+        start = perf_counter()
+        end = self.clock() + duration
+        next_sample = self.clock()
+        events = 0
+        with self.client.lock:
+            self.feed(self.client, self.transports[CLIENT_ADDRESS])
+        while True:
+            times = [self.queue[0][0]] if self.queue else []
+            deadlines = {address: self.get_deadline(address) for address in self.controllers}
+            times += [deadline for deadline in deadlines.values() if deadline is not None]
+            if not times or min(times) > end:
+                break
+            self.clock.advance(min(times))
+            now = self.clock()
+            while next_sample <= now:
+                self.sample()
+                next_sample += SAMPLE_INTERVAL
+            ready = [address for address, deadline in deadlines.items() if deadline is not None and deadline <= now]
+            while self.queue and self.queue[0][0] <= now:
+                arrival, sequence, source, destination, datagram = heapq.heappop(self.queue)
+                self.transports[destination].inbox.append((datagram, source))
+                if destination not in ready:
+                    ready.append(destination)
+            for address in sorted(ready):
+                self.service(address)
+            events += 1
+        self.clock.advance(end)
+        return self.get_results(duration, events, perf_counter() - start)
+
+    def close(self) -> None:
+        # Gives the bytes the connections hold back to the memory budget.
+        for controller in self.controllers.values():
+            controller.state = CLOSED
+            controller.update_memory_usage()
+
+    def get_results(self, duration: float, events: int, wall_seconds: float) -> dict:
+        client = self.client.get_stats()
+        upstream = self.links[(CLIENT_ADDRESS, SERVER_ADDRESS)]
+        return {"duration": duration, "bytes_delivered": self.bytes_delivered, "goodput_mbps": self.bytes_delivered * 8 / duration / 1e6,
+                "packets_sent": client.packets_sent, "packets_lost": client.packets_lost, "packets_retransmitted": client.packets_retransmitted,
+                "spurious_losses": client.spurious_losses, "probes_sent": client.probes_sent,
+                "link_lost": upstream.datagrams_lost, "link_dropped": upstream.datagrams_dropped,
+                "congestion_window": client.congestion_window, "smoothed_rtt_ms": client.smoothed_rtt * 1e3,
+                "min_rtt_ms": client.min_rtt * 1e3, "events": events, "wall_seconds": wall_seconds,
+                "digest": self.digest.hexdigest()}
+
+
+def simulate(upstream: str, downstream: str, duration: float, seed: int = SEED) -> dict:
+    # Runs one simulation of the given impairment specs, the directions get different seeds.
+    simulation = Simulation(parse_impairment(upstream, seed), parse_impairment(downstream, seed + 1))
+    try:
+        return simulation.run(duration)
+    finally:
+        simulation.close()
+
+
+def main(argv: list[str] = None) -> int:
+    parser = ArgumentParser(description="Simulate a QUIC bulk transfer over an emulated path on a virtual clock.")
+    parser.add_argument("--duration", type=float, default=60.0, help="Virtual seconds to run each transfer for.")
+    parser.add_argument("--impairment", action="append", help="Impairment of both directions, e.g. rate=10e6,delay=0.02,queue=64000. "
+                                                                "Can be given several times to simulate several paths.")
+    parser.add_argument("--downstream", help="Impairment of the way back from the server, instead of --impairment.")
+    parser.add_argument("--seed", type=int, default=SEED, help="Seed of the losses and delays.")
+    add_output_arguments(parser)
+    args = parser.parse_args(argv)
+
+    results = []
+    for spec in args.impairment or ["rate=10e6,delay=0.02,queue=64000"]:
+        result = {"benchmark": "simulation", "case": spec}
+        result.update(simulate(spec, args.downstream if args.downstream is not None else spec, args.duration, args.seed))
+        results.append(result)
+    print(format_table(results, ["case", "goodput_mbps", "packets_sent", "packets_lost", "spurious_losses", "link_dropped",
+                                 "smoothed_rtt_ms", "events", "wall_seconds"]))
+    for result in results:
+        print(f"{result['case']}: {result['digest']}")
+    return finish(results, args, REGRESSION_METRICS)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
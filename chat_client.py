@@ -174,7 +174,7 @@ class ChatApplication:
                     if data:
                         self.write_message_to_console(data.decode("utf-8"))
                     self.lock.release()
-        self.poller.unregister(self.chat_client.socket._socket.fileno())
+        self.poller.unregister(self.chat_client.socket.get_transport().fileno())
         self.chat_client.disconnect()
         self.chat_client = ChatClient(self.ip)
         self.write_message_to_console("CLIENT: Disconnected from the server...")
@@ -253,7 +253,7 @@ class ChatApplication:
             self.write_message_to_console("SERVER: Signed in successfully.")
             self.signed_in = True
             self.poller = select.poll()
-            self.poller.register(self.chat_client.socket._socket.fileno(), select.POLLIN)
+            self.poller.register(self.chat_client.socket.get_transport().fileno(), select.POLLIN)
             self.receive_thread = Thread(target=self.receive_thread_handler)
             self.receive_thread.start()
             self.username = username
@@ -6,6 +6,11 @@ from ipaddress import ip_address
 import argparse
 
 
+# Messages for a client are buffered up to this many bytes, after that they are dropped
+# so that a slow client can't stall the broadcast to everyone else.
+CLIENT_SEND_BUFFER = 64 * 1024
+
+
 PARSER = argparse.ArgumentParser(prog="chat_server.py", description="A Chat Server which uses the QUIC protocol.")
 PARSER.add_argument("ip", help="The IPv4 address of this machine.")
 PARSER.add_argument("port", help="The port to run the application on.")
@@ -60,7 +65,10 @@ class ChatServer:
                         data = username.encode("utf-8") + b": " + data
                         for key in self.clients:
                             if key != fd:
-                                self.clients[key][0].send(1, data)
+                                try:
+                                    self.clients[key][0].send(1, data)
+                                except BlockingIOError:
+                                    print(f"Dropping message for slow client {self.clients[key][1]}...")
                     self.client_lock.release()
 
 
@@ -113,9 +121,10 @@ class ChatServer:
                 self.db_lock.release()
                 if result:
                     client.send(1, b"success")
+                    client.set_send_buffer(1, CLIENT_SEND_BUFFER)
                     self.client_lock.acquire()
-                    self.clients[client._socket.fileno()] = (client, username)
-                    self.poller.register(client._socket.fileno())
+                    self.clients[client.get_transport().fileno()] = (client, username)
+                    self.poller.register(client.get_transport().fileno())
                     self.client_lock.release()
                 else:
                     client.send(1, b"fail")
@@ -1,6 +1,12 @@
-from socket import socket, AF_INET, SOCK_DGRAM
+"""
+    Relays datagrams between the client and the server and drops the fifth
+    datagram sent by the client. benchmarks/impairment.py can emulate more
+    realistic paths, with random and bursty loss, delay, reordering and more.
+"""
+
 from argparse import ArgumentParser
-from select import poll, POLLIN
+from time import sleep
+from benchmarks.impairment import ImpairmentProxy, Impairment
 
 PARSER = ArgumentParser()
 PARSER.add_argument("middle_ip", help="The IPv4 address of this machine.")
@@ -12,41 +18,14 @@ PARSER.add_argument("server_port", help="The server port to forward packets to."
 ARGS = PARSER.parse_args()
 
 if __name__ == "__main__":
-    client_socket = socket(AF_INET, SOCK_DGRAM)
-    server_socket = socket(AF_INET, SOCK_DGRAM)
-    client_socket.setblocking(0)
-    server_socket.setblocking(0)
-    
-    client_address = None
     server_address = (ARGS.server_ip, int(ARGS.server_port))
-    middle_address_client = (ARGS.middle_ip, int(ARGS.middle_port_1))
-    middle_address_server = (ARGS.middle_ip, int(ARGS.middle_port_2))
-    client_socket.bind(middle_address_client)
-    server_socket.bind(middle_address_server)
-
-    poller = poll()
-    client_datagrams_received = 0
-
-    poller.register(server_socket)
-    poller.register(client_socket)
-
+    upstream = Impairment(drop=[4])
+    proxy = ImpairmentProxy(server_address, upstream=upstream, local_ip=ARGS.middle_ip,
+                            port=int(ARGS.middle_port_1), upstream_port=int(ARGS.middle_port_2))
+    proxy.start()
     try:
         while True:
-            events = poller.poll()
-            for fd, event in events:
-                if event & POLLIN:
-                    if fd == server_socket.fileno():
-                        print("SERVER --> CLIENT")
-                        datagram, address = server_socket.recvfrom(4096)
-                        client_socket.sendto(datagram, client_address)
-                    if fd == client_socket.fileno():
-                        print("CLIENT --> SERVER")
-                        datagram, client_address = client_socket.recvfrom(4096)
-                        if client_datagrams_received == 4:
-                            print("Dropping packet.")
-                        else:
-                            server_socket.sendto(datagram, server_address)
-                        client_datagrams_received += 1
+            sleep(1)
     except KeyboardInterrupt:
-        server_socket.close()
-        client_socket.close()
+        proxy.stop()
+        print(proxy.get_stats())
@@ -26,13 +26,9 @@ if __name__ == "__main__":
     print("--- Testing QUIC Socket ---")
     client = QUICSocket(local_ip=local_ip)
     client.connect(address=(server_ip, server_port))
-    data = b""
 
-    with open("data.txt", "rb") as f:
-        data = f.read()[0:num]
-    
     quic_start = perf_counter()
-    client.send(1, data)
+    client.send_file(1, "data.txt", 0, num)
     quic_end = perf_counter()
     client.close()
 
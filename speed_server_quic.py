@@ -24,11 +24,7 @@ if __name__ == "__main__":
     server.listen(port)
     print(f"Ready to read {num} bytes:")
     client = server.accept()
-    disconnected = False
-    data = b""
-
-    while len(data) < num:
-        received, disconnected = client.recv(1, 1024)
-        data += received
+    data = bytearray(num)
+    received, disconnected = client.recv_exactly(1, data)
     client.release()
     print("Done.")
@@ -1,7 +1,33 @@
 import unittest
 from QUIC import *
+from benchmarks.common import percentile, summarize, compare_to_baseline
+from benchmarks.micro import Case, measure, get_cases
+from benchmarks.impairment import Impairment, ImpairmentProxy, create_burst_loss, parse_impairment
+from benchmarks.simulation import Simulation, VirtualClock, START_TIME
 from database import Database
 from os import system, urandom
+from random import Random
+from time import time
+from tempfile import TemporaryFile, NamedTemporaryFile, TemporaryDirectory
+from threading import Thread
+from socket import socket, AF_INET, SOCK_DGRAM
+from select import select
+import os
+from mmap import ALLOCATIONGRANULARITY
+
+
+def create_connected_socket() -> tuple[QUICSocket, socket]:
+    # A QUICSocket on loopback that is connected to peer, a plain UDP socket, without a handshake. Stream 1 is open.
+    peer = socket(AF_INET, SOCK_DGRAM)
+    peer.bind(("127.0.0.1", 0))
+    peer.settimeout(5)
+    sock = QUICSocket("127.0.0.1")
+    sock.get_transport().bind(("127.0.0.1", 0))
+    nc: QUICNetworkController = sock._network_controller
+    nc.state = CONNECTED
+    nc._connection_context.set_peer_address(peer.getsockname())
+    nc.create_stream(1)
+    return sock, peer
 
 
 class TestSenderSideController(unittest.TestCase):
@@ -66,7 +92,20 @@ class TestSenderSideController(unittest.TestCase):
         sc.packets_sent = {}
         lost = sc.detect_and_remove_lost_packets(largest_acknowledged)
         self.assertEqual(0, len(lost))
-    
+
+
+    def test_expire_ack_only_packets(self):
+        sc = QUICSenderSideController()
+        sc.packets_sent = {pn: PacketSentInfo(in_flight=False, sent_bytes=10, time_sent=0.1, ack_eliciting=False, packet_number=pn,
+                                              packet=Packet(header=ShortHeader(destination_connection_id=1024, packet_number=pn))) for pn in range(4)}
+        # ACK-only packets are never declared lost, but they are forgotten once they would have been.
+        self.assertEqual([], sc.detect_and_remove_lost_packets(4))
+        self.assertEqual([2, 3], list(sc.packets_sent))
+        self.assertEqual(0, sc.bytes_in_flight)
+        self.assertEqual(0, sc.packets_declared_lost)
+        self.assertEqual([], sc.detect_and_remove_lost_packets(6))
+        self.assertEqual([], list(sc.packets_sent))
+
 
     def test_on_packet_loss(self):
         sc = QUICSenderSideController()
@@ -81,7 +120,140 @@ class TestSenderSideController(unittest.TestCase):
 
         sc.on_packet_loss()
         self.assertEqual(sc.slow_start_threshold, temp)
-    
+        self.assertEqual(1, sc.slow_start_exits_loss)
+        self.assertEqual(0, sc.slow_start_exits_delay)
+
+
+    def test_update_rtt(self):
+        sc = QUICSenderSideController()
+        sc.update_rtt(0.1)
+        self.assertEqual(0.1, sc.min_rtt)
+        self.assertEqual(0.1, sc.smoothed_rtt)
+        self.assertEqual(0.05, sc.rttvar)
+        sc.update_rtt(0.05)
+        self.assertEqual(0.05, sc.min_rtt)
+        self.assertAlmostEqual(0.09375, sc.smoothed_rtt)
+
+
+    def test_hystart_delay_exit(self):
+        hs = HyStart()
+        hs.on_round_end(10)
+        for i in range(0, HYSTART_N_RTT_SAMPLE):
+            hs.on_rtt_sample(0.020)
+        hs.on_round_end(20)
+        # The minimum RTT of this round is 10ms above the last round, which is above the 4ms threshold.
+        for i in range(0, HYSTART_N_RTT_SAMPLE):
+            hs.on_rtt_sample(0.030)
+        self.assertEqual(True, hs.in_css)
+        exited = False
+        for i in range(0, HYSTART_CSS_ROUNDS):
+            exited = hs.on_round_end(30 + i)
+            for j in range(0, HYSTART_N_RTT_SAMPLE):
+                hs.on_rtt_sample(0.030)
+        self.assertEqual(True, exited)
+        self.assertEqual(False, hs.in_css)
+
+
+    def test_hystart_spurious_css(self):
+        hs = HyStart()
+        hs.on_round_end(10)
+        for i in range(0, HYSTART_N_RTT_SAMPLE):
+            hs.on_rtt_sample(0.020)
+        hs.on_round_end(20)
+        for i in range(0, HYSTART_N_RTT_SAMPLE):
+            hs.on_rtt_sample(0.030)
+        self.assertEqual(True, hs.in_css)
+        hs.on_round_end(30)
+        for i in range(0, HYSTART_N_RTT_SAMPLE):
+            hs.on_rtt_sample(0.021)
+        self.assertEqual(False, hs.in_css)
+        self.assertEqual(1, hs.css_spurious_exits)
+
+
+    def test_pacer(self):
+        pacer = Pacer()
+        # No RTT estimate yet so nothing is paced.
+        self.assertEqual(True, pacer.can_send(MAX_DATAGRAM_SIZE))
+        self.assertEqual(0.0, pacer.time_until_send(MAX_DATAGRAM_SIZE))
+
+        pacer.set_rate(1000) # 1000 bytes per second.
+        while pacer.can_send(MAX_DATAGRAM_SIZE):
+            pacer.on_packet_sent(MAX_DATAGRAM_SIZE)
+        self.assertEqual(False, pacer.can_send(MAX_DATAGRAM_SIZE))
+        self.assertGreater(pacer.time_until_send(MAX_DATAGRAM_SIZE), 0.0)
+
+        pacer.enabled = False
+        self.assertEqual(True, pacer.can_send(MAX_DATAGRAM_SIZE))
+
+
+    def test_pacing_rate(self):
+        sc = QUICSenderSideController()
+        self.assertEqual(INFINITY, sc.get_pacing_rate())
+        sc.update_rtt(0.1)
+        self.assertEqual(PACING_GAIN * sc.congestion_window / 0.1, sc.get_pacing_rate())
+        sc.bytes_in_flight = sc.congestion_window
+        self.assertEqual(MAX_SEND_WAIT, sc.time_until_send(MAX_DATAGRAM_SIZE))
+
+
+    def test_spurious_loss_undo(self):
+        sc = QUICSenderSideController()
+        sc.packets_sent = {
+            0: PacketSentInfo(in_flight=True, sent_bytes=10, time_sent=0.1, ack_eliciting=True, packet_number=0, packet=Packet(header=ShortHeader(destination_connection_id=1024, packet_number=0))), 
+            1: PacketSentInfo(in_flight=True, sent_bytes=10, time_sent=0.1, ack_eliciting=True, packet_number=1, packet=Packet(header=ShortHeader(destination_connection_id=1024, packet_number=1))), 
+            6: PacketSentInfo(in_flight=True, sent_bytes=10, time_sent=0.1, ack_eliciting=True, packet_number=6, packet=Packet(header=ShortHeader(destination_connection_id=1024, packet_number=6)))}
+        sc.bytes_in_flight = 30
+        window = sc.congestion_window
+        sc.on_packet_numbers_acked([6])
+        lost = sc.detect_and_remove_lost_packets(6)
+        self.assertEqual(2, len(lost))
+        self.assertLess(sc.congestion_window, window)
+
+        # The first lost packet arrives, the second one could still be lost so nothing is undone.
+        sc.on_packet_numbers_acked([0])
+        self.assertEqual(1, sc.spurious_losses)
+        self.assertEqual(0, sc.congestion_undos)
+        self.assertEqual(7, sc.packet_threshold)
+
+        # Both packets arrived, the window reduction is undone.
+        sc.on_packet_numbers_acked([1])
+        self.assertEqual(2, sc.spurious_losses)
+        self.assertEqual(1, sc.congestion_undos)
+        self.assertEqual(INFINITY, sc.slow_start_threshold)
+        self.assertGreaterEqual(sc.congestion_window, window)
+
+
+    def test_on_loss_detection_timeout(self):
+        sc = QUICSenderSideController()
+        clock = VirtualClock()
+        sc.set_clock(clock)
+        self.assertEqual(([], []), sc.on_loss_detection_timeout())
+
+        sc.packets_sent = {
+            0: PacketSentInfo(in_flight=True, sent_bytes=10, time_sent=0.1, ack_eliciting=True, packet_number=0, packet=Packet(header=ShortHeader(destination_connection_id=1024, packet_number=0))),
+            1: PacketSentInfo(in_flight=True, sent_bytes=10, time_sent=0.1, ack_eliciting=True, packet_number=1, packet=Packet(header=ShortHeader(destination_connection_id=1024, packet_number=1))),
+            2: PacketSentInfo(in_flight=True, sent_bytes=10, time_sent=0.1, ack_eliciting=True, packet_number=2, packet=Packet(header=ShortHeader(destination_connection_id=1024, packet_number=2)))}
+        sc.bytes_in_flight = 30
+        sc.time_of_last_ack_eliciting_packet = 0.1
+
+        # Nothing has been acknowledged, so the probe timeout fires and the oldest packets are probed.
+        self.assertEqual(([], []), sc.on_loss_detection_timeout())
+        clock.advance(0.1 + sc.get_probe_timeout())
+        lost, probes = sc.on_loss_detection_timeout()
+        self.assertEqual(0, len(lost))
+        self.assertEqual(MAX_PROBE_PACKETS, len(probes))
+        self.assertEqual(1, sc.pto_count)
+        self.assertEqual(3, len(sc.packets_sent))
+
+        # Once there is an RTT estimate, packets older than the time threshold are lost.
+        sc.update_rtt(0.1)
+        sc.packets_sent[0].time_sent = sc.packets_sent[1].time_sent = clock() - 0.1
+        self.assertEqual(0, len(sc.detect_and_remove_lost_packets(2)))
+        self.assertAlmostEqual(clock() - 0.1 + TIME_THRESHOLD * 0.1, sc.loss_time)
+        clock.advance(sc.loss_time + TIMER_GRANULARITY)
+        lost, probes = sc.on_loss_detection_timeout()
+        self.assertEqual(2, len(lost))
+        self.assertEqual(0, len(probes))
+
 
 
 class TestNetworkController(unittest.TestCase):
@@ -91,13 +263,70 @@ class TestNetworkController(unittest.TestCase):
         context = ConnectionContext()
         i2 = [1, 2, 3, 6, 7, 8, 9, 13, 14, 15, 18, 19]
         pkt = packetizer.packetize_acknowledgement(connection_context=context, packet_numbers_received=i2)
-        
+        frame = pkt.frames[0]
+        self.assertEqual(19, frame.largest_acknowledged)
+        self.assertEqual(1, frame.first_ack_range)
+        self.assertEqual(3, frame.ack_range_count)
+        self.assertEqual([2, 3, 2], [r.gap for r in frame.ack_range])
+        self.assertEqual([3, 4, 3], [r.ack_range_length for r in frame.ack_range])
+
+        nc = QUICNetworkController()
+        self.assertEqual(sorted(i2), sorted(nc.get_packet_numbers_acknowledged(frame)))
+        self.assertEqual([5], nc.get_packet_numbers_acknowledged(packetizer.create_ack_frame([5])))
+        # The list given to the packetizer is left in its order.
+        self.assertEqual([1, 2, 3, 6, 7, 8, 9, 13, 14, 15, 18, 19], i2)
+
+
+    def test_acknowledge_duplicate_packets(self):
+        nc = QUICNetworkController()
+        packetizer = QUICPacketizer()
+        context = ConnectionContext()
+        # Packets arrive out of order and some of them twice, with acknowledgements built in between.
+        received = [[0, 1, 2], [3, 3, 1], [7, 5, 2, 5], [6, 4, 7, 0]]
+        acknowledged = set()
+        for packet_numbers in received:
+            for pkt_num in packet_numbers:
+                nc.update_received_packet_numbers(pkt_num)
+            acknowledged.update(packet_numbers)
+            self.assertEqual(sorted(acknowledged), nc.unacked_packet_numbers_received)
+            frame = packetizer.packetize_acknowledgement(context, nc.unacked_packet_numbers_received).frames[0]
+            self.assertEqual(sorted(acknowledged), sorted(nc.get_packet_numbers_acknowledged(frame)))
+            self.assertEqual(sorted(acknowledged), nc.unacked_packet_numbers_received)
+        # Once the peer has our acknowledgement the packets are forgotten, late duplicates are acknowledged again.
+        nc.forget_received_packet_numbers({0, 1, 2, 3, 4})
+        self.assertEqual([5, 6, 7], nc.unacked_packet_numbers_received)
+        for pkt_num in [9, 2, 9, 6]:
+            nc.update_received_packet_numbers(pkt_num)
+        self.assertEqual([2, 5, 6, 7, 9], nc.unacked_packet_numbers_received)
+        frame = packetizer.packetize_acknowledgement(context, nc.unacked_packet_numbers_received).frames[0]
+        self.assertEqual([2, 5, 6, 7, 9], sorted(nc.get_packet_numbers_acknowledged(frame)))
+
 
     def test_on_ack_frame_received(self):
         nc = QUICNetworkController()
         ack = AckFrame(largest_acknowledged=13, first_ack_range=5, ack_delay=0, ack_range_count=1, ack_range=[AckRange(gap=3, ack_range_length=2)])
     
 
+    def test_handshake_reordered(self):
+        peer = socket(AF_INET, SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        peer.settimeout(5)
+        client = QUICSocket("127.0.0.1")
+        thread = Thread(target=client.connect, args=(peer.getsockname(),), daemon=True)
+        thread.start()
+        initial, address = peer.recvfrom(4096)
+        self.assertEqual(HT_INITIAL, parse_packet_bytes(initial).header.type)
+        # The server's HANDSHAKE overtakes its INITIAL, the client must still answer it before it is connected.
+        packets = QUICPacketizer().packetize_connection_response_packets(ConnectionContext(), EncryptionContext())
+        for packet in reversed(packets):
+            peer.sendto(packet.raw(), address)
+        self.assertEqual(HT_HANDSHAKE, parse_packet_bytes(peer.recv(4096)).header.type)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        client.release()
+        peer.close()
+
+
     def test_is_ack_eliciting(self):
         nc = QUICNetworkController()
 
@@ -158,6 +387,251 @@ class TestNetworkController(unittest.TestCase):
 
 
 
+class TestStreams(unittest.TestCase):
+
+    def test_ranges(self):
+        ranges = []
+        add_range(ranges, 10, 20)
+        add_range(ranges, 30, 40)
+        add_range(ranges, 20, 25)
+        self.assertEqual([(10, 25), (30, 40)], ranges)
+        add_range(ranges, 0, 100)
+        self.assertEqual([(0, 100)], ranges)
+        remove_range(ranges, 40, 60)
+        self.assertEqual([(0, 40), (60, 100)], ranges)
+        remove_range(ranges, 0, 10)
+        remove_range(ranges, 90, 200)
+        self.assertEqual([(10, 40), (60, 90)], ranges)
+
+
+    def test_send_stream(self):
+        stream = SendStream(stream_id=1)
+        self.assertEqual(0, stream.write(b"0123456789"))
+        self.assertEqual(10, stream.write(b"abcdefghij"))
+        self.assertEqual(20, stream.get_offset())
+
+        # Acknowledging data out of order only trims the buffer once the front is acknowledged.
+        stream.on_range_acked(5, 10)
+        self.assertEqual(20, stream.get_buffered_bytes())
+        stream.on_range_acked(0, 5)
+        self.assertEqual(10, stream.get_buffered_bytes())
+        self.assertEqual(b"abcdefghij", stream.get_data(10, 20))
+
+        # Only the parts of a lost range that haven't been acknowledged are retransmitted.
+        stream.on_range_acked(12, 15)
+        stream.on_range_lost(5, 20)
+        self.assertEqual([(10, 12), (15, 20)], stream.lost_ranges)
+        self.assertEqual((10, b"ab"), stream.next_lost_range(100))
+        stream.on_range_acked(15, 20)
+        self.assertEqual(False, stream.has_lost_data())
+        pieces = stream.get_unacked_data(0, 20)
+        self.assertEqual([(10, b"ab")], pieces)
+        # The data is a copy, so the buffer can still be trimmed while a retransmission holds it.
+        stream.on_range_acked(10, 12)
+        self.assertEqual(0, stream.get_buffered_bytes())
+        self.assertEqual([(10, b"ab")], pieces)
+
+
+    def test_receive_stream(self):
+        stream = ReceiveStream(stream_id=1)
+        stream.receive(10, b"abcde")
+        stream.receive(12, b"cdefgh")   # Overlaps the previous frame.
+        stream.receive(10, b"abcde")    # Duplicate.
+        self.assertEqual(b"", stream.data)
+        self.assertEqual(8, stream.get_buffered_bytes())
+        self.assertEqual([(10, 18)], stream.segment_ranges)
+
+        stream.receive(0, b"0123456789a")
+        self.assertEqual(b"0123456789abcdefgh", stream.data)
+        self.assertEqual(18, stream.offset)
+        self.assertEqual([], stream.segment_ranges)
+        self.assertEqual(0, stream.segment_bytes)
+
+        self.assertEqual(b"01234", stream.read(5))
+        self.assertEqual(b"56789abcdefgh", stream.read(100))
+        self.assertEqual(b"", stream.read(100))
+        self.assertEqual(18, stream.read_offset)
+
+        # Data that has already been read is ignored.
+        stream.receive(0, b"0123")
+        self.assertEqual(0, stream.get_buffered_bytes())
+
+
+    def test_receive_stream_readinto(self):
+        stream = ReceiveStream(stream_id=1)
+        stream.receive(0, b"0123456789")
+        buffer = bytearray(4)
+        self.assertEqual(4, stream.readinto(buffer))
+        self.assertEqual(b"0123", buffer)
+        # Reads into the middle of a larger buffer through a memoryview.
+        buffer = bytearray(20)
+        view = memoryview(buffer)
+        self.assertEqual(6, stream.readinto(view[10:]))
+        self.assertEqual(b"456789", buffer[10:16])
+        self.assertEqual(0, stream.readinto(view))
+        self.assertEqual(10, stream.read_offset)
+
+
+    def test_receive_stream_sink(self):
+        stream = ReceiveStream(stream_id=1)
+        stream.receive(0, b"0123")
+        stream.receive(6, b"67")          # Buffered before the sink is attached.
+        self.assertEqual(b"01", stream.read(2))
+        with TemporaryFile() as f:
+            stream.attach_sink(f.fileno(), 10)
+            self.assertEqual(b"", stream.data)
+            stream.receive(8, b"89abcd")  # Crosses the end of the sink.
+            self.assertFalse(stream.is_sink_done())
+            stream.receive(4, b"45")
+            self.assertTrue(stream.is_sink_done())
+            self.assertEqual(10, stream.detach_sink())
+            f.seek(0)
+            self.assertEqual(b"23456789ab", f.read())
+        # Data past the end of the sink was buffered as usual.
+        self.assertEqual(b"cd", stream.read(100))
+        self.assertEqual(14, stream.read_offset)
+
+
+    def test_send_file(self):
+        with NamedTemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+            sock = QUICSocket("127.0.0.1")
+            sent = []
+            sock._network_controller.send_stream_data = lambda stream_id, data, transport, block=None: sent.append(bytes(data))
+            sock.send_file(1, f.name, 2, 5)
+            sock.send_file(1, f.fileno(), 8)
+            self.assertEqual([b"23456", b"89"], sent)
+            # Offsets past the allocation granularity only map the part of the file that is sent.
+            data = urandom(2 * ALLOCATIONGRANULARITY + 100)
+            f.seek(0)
+            f.write(data)
+            f.flush()
+            sock.send_file(1, f.name, ALLOCATIONGRANULARITY + 10, 50)
+            self.assertEqual(data[ALLOCATIONGRANULARITY+10:ALLOCATIONGRANULARITY+60], sent[-1])
+            sock.get_transport().close()
+
+
+    def test_send_file_peer_closed(self):
+        sock, peer = create_connected_socket()
+        address = sock.get_transport().get_local_address()
+        def close_connection():
+            # Close the connection once the sender is blocked by flow control with most of the file still pending.
+            peer.recv(4096)
+            close = ConnectionCloseFrame(error_code=1, reason_phrase_len=5, reason_phrase=b"close")
+            peer.sendto(Packet(header=ShortHeader(destination_connection_id=0, packet_number=0), frames=[close]).raw(), address)
+        thread = Thread(target=close_connection, daemon=True)
+        thread.start()
+        with NamedTemporaryFile() as f:
+            f.write(urandom(4 * INITIAL_MAX_DATA))
+            f.flush()
+            # The pending data is dropped before the mapping is closed, so closing it doesn't raise BufferError.
+            self.assertFalse(sock.send_file(1, f.name))
+        thread.join(5)
+        self.assertFalse(sock._network_controller._send_streams[1].has_pending_data())
+        sock.get_transport().close()
+        peer.close()
+
+
+    def test_packetize_scheduled_data(self):
+        packetizer = QUICPacketizer()
+        context = ConnectionContext()
+        streams = {1: SendStream(stream_id=1)}
+        scheduler = StreamScheduler()
+        credit = SendCredit(INITIAL_MAX_DATA)
+        data = urandom(5000)
+        streams[1].queue(data)
+        scheduler.schedule(1, DEFAULT_URGENCY, True)
+        # Nothing is packetized until the packets are asked for.
+        self.assertEqual(0, streams[1].get_offset())
+        first = packetizer.packetize_scheduled_data(scheduler, context, streams, credit)
+        self.assertIsInstance(first.frames[0].data, memoryview)
+        self.assertEqual(first.frames[0].length, streams[1].get_offset())
+        packets = [first]
+        while packet := packetizer.packetize_scheduled_data(scheduler, context, streams, credit):
+            packets.append(packet)
+        self.assertEqual(5000, streams[1].get_offset())
+        self.assertEqual(5000, credit.used)
+        self.assertEqual(False, scheduler.is_scheduled(1))
+        self.assertEqual(data, b"".join([bytes(p.frames[0].data) for p in packets]))
+        self.assertEqual([p.header.packet_number for p in packets], list(range(len(packets))))
+        # The raw packet still round trips.
+        self.assertEqual(bytes(first.frames[0].data), parse_packet_bytes(first.raw()).frames[0].data)
+        # Data queued by several sends goes in one frame per send, with contiguous offsets.
+        streams[1].queue(b"a" * 100)
+        streams[1].queue(b"b" * 300)
+        scheduler.schedule(1, DEFAULT_URGENCY, True)
+        packet = packetizer.packetize_scheduled_data(scheduler, context, streams, credit)
+        self.assertEqual([(5000, 100), (5100, 300)], [(frame.offset, frame.length) for frame in packet.frames])
+        self.assertEqual([100, 300], [len(frame.data) for frame in packet.frames])
+        self.assertEqual(5400, credit.used)
+
+
+    def test_scheduler_priority(self):
+        packetizer = QUICPacketizer()
+        context = ConnectionContext()
+        streams = {stream_id: SendStream(stream_id=stream_id) for stream_id in [0, 1, 4, 8]}
+        scheduler = StreamScheduler()
+        credit = SendCredit(INITIAL_MAX_DATA)
+        def send_order():
+            order = []
+            while packet := packetizer.packetize_scheduled_data(scheduler, context, streams, credit):
+                order += [frame.stream_id for frame in packet.frames]
+            return order
+        # A small message on a more urgent stream goes before the bulk data queued first.
+        streams[0].queue(urandom(2000))
+        streams[1].queue(b"hello")
+        streams[1].set_priority(0, False)
+        for stream in [streams[0], streams[1]]:
+            scheduler.schedule(stream.stream_id, stream.urgency, stream.incremental)
+        self.assertEqual([1, 0, 0, 0, 0, 0], send_order())
+        # Incremental streams of the same urgency take turns.
+        streams[4].queue(urandom(1000))
+        streams[8].queue(urandom(1000))
+        scheduler.schedule(4, DEFAULT_URGENCY, True)
+        scheduler.schedule(8, DEFAULT_URGENCY, True)
+        self.assertEqual([4, 8, 4, 8, 4, 8], send_order())
+        # Non incremental streams are sent one after the other in stream ID order.
+        streams[8].queue(urandom(1000))
+        streams[4].queue(urandom(1000))
+        scheduler.schedule(8, DEFAULT_URGENCY, False)
+        scheduler.schedule(4, DEFAULT_URGENCY, False)
+        self.assertEqual([4, 4, 4, 8, 8, 8], send_order())
+        # A stream blocked by flow control is unscheduled and the others carry on.
+        streams[4].queue(urandom(1000))
+        streams[8].queue(urandom(100))
+        streams[4].credit.max_data = streams[4].credit.used + 10
+        scheduler.schedule(4, DEFAULT_URGENCY, True)
+        scheduler.schedule(8, DEFAULT_URGENCY, True)
+        self.assertEqual([4, 8], send_order())
+        self.assertEqual(990, streams[4].pending_size)
+        self.assertRaises(StreamError, streams[4].set_priority, 8, True)
+
+
+    def test_packetize_stream_retransmission(self):
+        packetizer = QUICPacketizer()
+        context = ConnectionContext()
+        streams = {1: SendStream(stream_id=1), 3: SendStream(stream_id=3)}
+        streams[1].write(urandom(2000))
+        streams[3].write(urandom(100))
+        streams[1].on_range_lost(100, 200)
+        streams[1].on_range_lost(1000, 2000)
+        streams[3].on_range_lost(0, 100)
+
+        packets = []
+        packet = packetizer.packetize_stream_retransmission(context, streams)
+        while packet:
+            packets.append(packet)
+            packet = packetizer.packetize_stream_retransmission(context, streams)
+
+        # Every packet is filled up to the safe payload size except the last.
+        for packet in packets[:-1]:
+            self.assertEqual(SAFE_DATAGRAM_PAYLOAD_SIZE-LONG_HEADER_SIZE+SHORT_HEADER_SIZE, len(packet.raw()))
+        frames = [frame for packet in packets for frame in packet.frames]
+        self.assertEqual(1200, sum(frame.length for frame in frames))
+        self.assertEqual(streams[1].get_data(100, 200), frames[0].data)
+
+
 class TestQUICPacket(unittest.TestCase):
     
     def test_long_header(self):
@@ -229,7 +703,7 @@ class TestQUICPacket(unittest.TestCase):
         self.assertRaises(InvalidArgumentException, StreamFrame, stream_id=1, offset=10, length=-1, data=b"")
 
         # Trying too large integer values for integer parameters.
-        self.assertRaises(InvalidArgumentException, StreamFrame, stream_id=256, offset=10, length=10, data=b"")
+        self.assertRaises(InvalidArgumentException, StreamFrame, stream_id=MAX_VARINT+1, offset=10, length=10, data=b"")
         self.assertRaises(InvalidArgumentException, StreamFrame, stream_id=1, offset=10981029381093280918123123123, length=10, data=b"")
         self.assertRaises(InvalidArgumentException, StreamFrame, stream_id=1, offset=10, length=65536, data=b"")
 
@@ -381,7 +855,817 @@ class TestQUICPacket(unittest.TestCase):
         self.assertRaises(TypeError, ConnectionCloseFrame, error_code=1, reason_phrase_len={}, reason_phrase=b"")
         self.assertRaises(TypeError, ConnectionCloseFrame, error_code=1, reason_phrase_len=set(), reason_phrase=b"")
         self.assertRaises(TypeError, ConnectionCloseFrame, error_code=1, reason_phrase_len=123.123, reason_phrase=b"")
-        
+
+
+    def test_truncated_packet(self):
+        header = ShortHeader(destination_connection_id=1, packet_number=1)
+        frames = [StreamFrame(stream_id=1, offset=0, length=100, data=urandom(100)),
+                  AckFrame(largest_acknowledged=10, ack_delay=0, ack_range_count=0, first_ack_range=2, ack_range=[])]
+        raw = Packet(header=header, frames=frames).raw()
+        stream_end = SHORT_HEADER_SIZE + len(frames[0].raw())
+        self.assertEqual(2, len(parse_packet_bytes(raw).frames))
+        self.assertEqual(0, len(parse_packet_bytes(raw[:SHORT_HEADER_SIZE]).frames))
+        self.assertEqual(1, len(parse_packet_bytes(raw[:stream_end]).frames))
+        # Cut anywhere else, the datagram is rejected instead of raising from the middle of the parser.
+        for size in range(len(raw)):
+            if size not in (SHORT_HEADER_SIZE, stream_end):
+                self.assertRaises(PacketParserError, parse_packet_bytes, raw[:size])
+        # A stream frame can't be longer than what is left of the packet.
+        stream = StreamFrame(stream_id=1, offset=0, length=10, data=b"0123456789").raw()
+        self.assertRaises(PacketParserError, parse_packet_bytes, header.raw() + stream[:-1])
+        self.assertRaises(PacketParserError, parse_packet_bytes, header.raw() + stream[:10])
+        self.assertRaises(PacketParserError, parse_packet_bytes, header.raw() + stream[:12])
+
+
+class TestFlowControl(unittest.TestCase):
+
+    def test_send_credit(self):
+        credit = SendCredit(100)
+        credit.on_data_sent(60)
+        self.assertEqual(40, credit.get_available())
+        self.assertEqual(False, credit.should_send_blocked())
+        credit.on_data_sent(40)
+        self.assertEqual(True, credit.should_send_blocked())
+        # Only one blocked frame per limit.
+        self.assertEqual(False, credit.should_send_blocked())
+        credit.on_max_data(200)
+        credit.on_max_data(150) # Reordered update, the limit never shrinks.
+        self.assertEqual(100, credit.get_available())
+
+
+    def test_receive_window(self):
+        window = ReceiveWindow(100, 400)
+        window.on_data_received(100)
+        self.assertEqual(0, window.get_available())
+        window.on_data_consumed(40)
+        self.assertEqual(False, window.should_update())
+        window.on_data_consumed(20)
+        self.assertEqual(True, window.should_update())
+        self.assertEqual(160, window.update(now=10.0, rtt=0.1))
+        # The next window was used up within two RTTs, so the window is doubled.
+        window.on_data_consumed(60)
+        self.assertEqual(320, window.update(now=10.1, rtt=0.1))
+        self.assertEqual(200, window.window)
+        window.ensure_window(1000)
+        self.assertEqual(400, window.window)
+
+
+    def test_flow_control_enforced_on_receive(self):
+        nc = QUICNetworkController()
+        nc.create_stream(1)
+        stream = nc._receive_streams[1]
+        stream.window.max_data = 10
+        nc.on_stream_frame_received(StreamFrame(stream_id=1, offset=5, length=10, data=b"56789abcde"))
+        nc.on_stream_frame_received(StreamFrame(stream_id=1, offset=0, length=5, data=b"01234"))
+        # Data beyond the advertised limit is dropped.
+        self.assertEqual(b"0123456789", stream.data)
+        self.assertEqual(1, nc.flow_control_violations)
+        self.assertEqual(10, nc.receive_window.received)
+
+
+    def test_flow_control_frames(self):
+        frames = [MaxDataFrame(maximum_data=2**40), MaxStreamDataFrame(stream_id=1, maximum_stream_data=1024),
+                  DataBlockedFrame(maximum_data=2048), StreamDataBlockedFrame(stream_id=3, maximum_stream_data=4096)]
+        packet = Packet(header=ShortHeader(destination_connection_id=1024, packet_number=1), frames=frames)
+        parsed = parse_packet_bytes(packet.raw())
+        self.assertEqual([f.raw() for f in frames], [f.raw() for f in parsed.frames])
+        self.assertEqual(2**40, parsed.frames[0].maximum_data)
+        self.assertEqual(3, parsed.frames[3].stream_id)
+        self.assertRaises(TypeError, MaxDataFrame, maximum_data="")
+        self.assertRaises(InvalidArgumentException, MaxStreamDataFrame, stream_id=1, maximum_stream_data=-1)
+        # Unknown frame types can't be skipped, so the packet is rejected.
+        self.assertRaises(PacketParserError, parse_packet_bytes, packet.header.raw() + b"\x30")
+
+
+    def test_memory_budget(self):
+        peer = socket(AF_INET, SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        transport = UDPTransport()
+        transport.bind(("127.0.0.1", 0))
+        budget = MemoryBudget(10000)
+        nc = QUICNetworkController()
+        nc.memory_budget = budget
+        nc.state = CONNECTED
+        nc._connection_context.set_peer_address(peer.getsockname())
+        nc.create_stream(1)
+        frame = StreamFrame(stream_id=1, offset=0, length=800, data=urandom(800))
+        nc.process_packets([Packet(header=ShortHeader(destination_connection_id=0, packet_number=0), frames=[frame])], transport)
+        self.assertEqual(800, budget.used)
+        stats = nc.get_stats()
+        self.assertEqual(800, stats.memory_used)
+        self.assertEqual((0, 800), nc.get_stream_stats(1))
+        self.assertRaises(StreamError, nc.get_stream_stats, 5)
+        # Other connections use up the rest of the budget.
+        budget.charge(9200)
+        self.assertEqual(True, budget.is_exhausted())
+        # A packet opening a new stream is dropped without being acknowledged.
+        frame = StreamFrame(stream_id=5, offset=0, length=10, data=urandom(10))
+        nc.process_packets([Packet(header=ShortHeader(destination_connection_id=0, packet_number=1), frames=[frame])], transport)
+        self.assertNotIn(5, nc._receive_streams)
+        self.assertEqual([0], nc.unacked_packet_numbers_received)
+        nc.set_send_buffer(1, 64 * 1024)
+        self.assertEqual(False, nc.is_stream_writable(1))
+        self.assertRaises(BlockingIOError, nc.send_stream_data, 1, b"data", transport)
+        # Reading frees memory, but the budget is still under pressure so the windows shrink.
+        self.assertEqual(400, len(nc.read_stream_data(1, 400, transport)[0]))
+        self.assertEqual(9600, budget.used)
+        self.assertEqual(INITIAL_MAX_STREAM_DATA // 2, nc._receive_streams[1].window.window)
+        self.assertEqual(INITIAL_MAX_DATA // 2, nc.receive_window.window)
+        budget.charge(-9200)
+        nc.read_stream_data(1, 400, transport)
+        self.assertEqual(0, budget.used)
+        self.assertEqual(INITIAL_MAX_STREAM_DATA // 2, nc._receive_streams[1].window.window)
+        nc.send_stream_data(1, b"data", transport)
+        self.assertEqual(4, budget.used)
+        nc.on_closed()
+        self.assertEqual(0, budget.used)
+        # The packets kept for later and the packet numbers kept for ACKs are bounded.
+        nc = QUICNetworkController()
+        nc.buffer_packets([Packet(header=ShortHeader(destination_connection_id=0, packet_number=0), frames=[])] * (MAX_BUFFERED_PACKETS + 10))
+        self.assertEqual(MAX_BUFFERED_PACKETS, len(nc.buffered_packets))
+        self.assertEqual(10, nc.buffered_packets_dropped)
+        for packet_number in [*range(1, MAX_ACK_PACKET_NUMBERS + 5), 0, 7, MAX_ACK_PACKET_NUMBERS + 6, MAX_ACK_PACKET_NUMBERS + 5]:
+            nc.update_received_packet_numbers(packet_number)
+        self.assertEqual(list(range(7, MAX_ACK_PACKET_NUMBERS + 7)), nc.unacked_packet_numbers_received)
+        transport.close()
+        peer.close()
+
+
+class TestMultiStream(unittest.TestCase):
+
+    def test_varint(self):
+        for value in [0, 63, 64, 16383, 16384, 2**30-1, 2**30, MAX_VARINT]:
+            encoded = encode_varint(value)
+            self.assertEqual(get_varint_size(value), len(encoded))
+            self.assertEqual((value, len(encoded)), decode_varint(b"x" + encoded, 1))
+        frame = StreamFrame(stream_id=2**40+3, offset=7, length=3, data=b"abc", fin=True)
+        parsed = parse_packet_bytes(Packet(header=ShortHeader(destination_connection_id=1, packet_number=1), frames=[frame]).raw()).frames[0]
+        self.assertEqual((2**40+3, 7, b"abc", True), (parsed.stream_id, parsed.offset, parsed.data, parsed.fin))
+        self.assertEqual(get_stream_frame_size(frame.stream_id) + 3, len(frame.raw()))
+
+
+    def test_stream_ids(self):
+        client = QUICNetworkController()
+        server = QUICNetworkController()
+        server.is_server = True
+        server.create_stream(1) # Stream 1 is open on every connection.
+        self.assertEqual([0, 4, 8], [client.open_stream() for i in range(3)])
+        self.assertEqual([2, 6], [client.open_stream(unidirectional=True) for i in range(2)])
+        self.assertEqual(5, server.open_stream())
+        self.assertEqual(3, server.open_stream(unidirectional=True))
+        # Unidirectional streams only have a send side on the endpoint that opened them.
+        self.assertIn(2, client._send_streams)
+        self.assertNotIn(2, client._receive_streams)
+        client.local_stream_limits[False].max_streams = 3
+        self.assertRaises(StreamError, client.open_stream)
+        client.on_stream_frame_received(StreamFrame(stream_id=3, offset=0, length=2, data=b"hi"))
+        self.assertEqual(b"hi", client._receive_streams[3].data)
+        self.assertNotIn(3, client._send_streams)
+
+
+    def test_peer_streams(self):
+        nc = QUICNetworkController()
+        nc.is_server = True
+        nc.peer_stream_limits[False].max_streams = 2
+        nc.on_stream_frame_received(StreamFrame(stream_id=4, offset=0, length=1, data=b"a"))
+        nc.on_stream_frame_received(StreamFrame(stream_id=8, offset=0, length=1, data=b"b")) # Over the limit.
+        nc.on_stream_frame_received(StreamFrame(stream_id=5, offset=0, length=1, data=b"c")) # One of our own streams.
+        self.assertEqual(4, nc.accept_stream(UDPTransport()))
+        self.assertEqual([4], list(nc._receive_streams))
+        self.assertEqual(1, nc.stream_limit_violations)
+        # Stream 0 was opened implicitly and is created when its first frame arrives.
+        self.assertEqual(False, nc.is_stream_closed(0))
+        nc.on_stream_frame_received(StreamFrame(stream_id=0, offset=0, length=1, data=b"d"))
+        self.assertEqual(b"d", nc._receive_streams[0].data)
+
+
+    def test_stream_fin(self):
+        nc = QUICNetworkController()
+        nc.is_server = True
+        nc.on_stream_frame_received(StreamFrame(stream_id=2, offset=0, length=3, data=b"abc", fin=True))
+        stream = nc._receive_streams[2]
+        self.assertEqual(False, stream.is_finished())
+        self.assertEqual(False, nc.get_stream_status(2))
+        self.assertEqual(b"abc", stream.read(10))
+        self.assertEqual(True, nc.get_stream_status(2))
+        # The stream is forgotten once it has been read, and late frames for it are ignored.
+        nc.maybe_remove_stream(2, UDPTransport())
+        self.assertNotIn(2, nc._receive_streams)
+        self.assertEqual(True, nc.is_stream_closed(2))
+        nc.on_stream_frame_received(StreamFrame(stream_id=2, offset=0, length=3, data=b"abc"))
+        self.assertNotIn(2, nc._receive_streams)
+
+
+    def test_send_stream_fin(self):
+        stream = SendStream(stream_id=0)
+        stream.write(b"abc")
+        stream.close()
+        self.assertRaises(StreamError, stream.queue, b"d")
+        self.assertRaises(StreamError, stream.write, b"d")
+        self.assertEqual(False, stream.is_finished())
+        stream.on_range_acked(0, 3)
+        stream.fin_acked = True
+        self.assertEqual(True, stream.is_finished())
+
+
+    def test_send_buffer(self):
+        peer = socket(AF_INET, SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        nc = QUICNetworkController()
+        nc.state = CONNECTED
+        nc._connection_context.set_peer_address(peer.getsockname())
+        transport = UDPTransport()
+        stream_id = nc.open_stream()
+        writable = []
+        nc.set_send_buffer(stream_id, 3000, writable.append)
+        data = bytearray(urandom(2000))
+        self.assertEqual(True, nc.send_stream_data(stream_id, data, transport))
+        # The buffered data was copied, so the caller can reuse its buffer.
+        expected = bytes(data)
+        data[:] = bytes(2000)
+        self.assertEqual(True, nc.send_stream_data(stream_id, data, transport))
+        self.assertEqual(False, nc.is_stream_writable(stream_id))
+        self.assertRaises(BlockingIOError, nc.send_stream_data, stream_id, b"x", transport)
+        self.assertEqual(expected, nc._send_streams[stream_id].get_data(0, 2000))
+        # Acknowledging the data makes room again.
+        nc.on_stream_data_acked(list(nc._sender_side_controller.packets_sent.values()), transport)
+        self.assertEqual([stream_id], writable)
+        self.assertEqual(True, nc.is_stream_writable(stream_id))
+        transport.close()
+        peer.close()
+
+
+    def test_reactor(self):
+        reactor = QUICReactor()
+        reactor.start()
+        self.assertRaises(ReactorError, reactor.register, QUICSocket("127.0.0.1"))
+        sock, peer = create_connected_socket()
+        nc: QUICNetworkController = sock._network_controller
+        reactor.register(sock)
+        # The reactor processes and acknowledges the packet without the application calling recv.
+        frame = StreamFrame(stream_id=1, offset=0, length=5, data=b"hello")
+        peer.sendto(Packet(header=ShortHeader(destination_connection_id=0, packet_number=0), frames=[frame]).raw(), sock.get_transport().get_local_address())
+        ack = parse_packet_bytes(peer.recv(4096))
+        self.assertEqual(FT_ACK, ack.frames[0].type)
+        self.assertEqual(0, ack.frames[0].largest_acknowledged)
+        buffer = bytearray(5)
+        self.assertEqual((5, False), sock.recv_exactly(1, buffer))
+        self.assertEqual(b"hello", buffer)
+        sock.release()
+        self.assertIsNone(nc.reactor)
+        reactor.stop()
+        peer.close()
+
+
+    def test_close_with_pending_data(self):
+        packetizer = QUICPacketizer()
+        context = ConnectionContext()
+        streams = {0: SendStream(stream_id=0)}
+        scheduler = StreamScheduler()
+        credit = SendCredit(INITIAL_MAX_DATA)
+        streams[0].credit.max_data = 100
+        streams[0].queue(urandom(300))
+        scheduler.schedule(0, DEFAULT_URGENCY, True)
+        packets = [packetizer.packetize_scheduled_data(scheduler, context, streams, credit)]
+        streams[0].close()
+        self.assertEqual(300, streams[0].fin_offset)
+        # The FIN goes out with the last of the pending data once the stream is unblocked.
+        streams[0].credit.on_max_data(1000)
+        scheduler.schedule(0, DEFAULT_URGENCY, True)
+        packets.append(packetizer.packetize_scheduled_data(scheduler, context, streams, credit))
+        frames = [packet.frames[0] for packet in packets]
+        self.assertEqual([(0, 100, False), (100, 200, True)], [(frame.offset, frame.length, frame.fin) for frame in frames])
+
+
+    def test_stream_limit(self):
+        limit = StreamLimit(4)
+        limit.on_opened(3)
+        self.assertEqual(0, limit.get_available())
+        limit.on_closed(1)
+        self.assertEqual(False, limit.should_update())
+        limit.on_closed(0)
+        self.assertEqual((2, set()), (limit.closed_below, limit.closed))
+        self.assertEqual(True, limit.should_update())
+        self.assertEqual(6, limit.update())
+        frame = parse_packet_bytes(Packet(header=ShortHeader(destination_connection_id=1, packet_number=1), frames=[MaxStreamsFrame(maximum_streams=6, unidirectional=True)]).raw()).frames[0]
+        self.assertEqual((FT_MAXSTREAMSUNI, 6, True), (frame.type, frame.maximum_streams, frame.unidirectional))
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_schedule_and_cancel(self):
+        wheel = TimerWheel(1000.0)
+        wheel.schedule("a", 1000.010)
+        wheel.schedule("b", 1000.500)  # Level 1.
+        wheel.schedule("c", 1100.0)    # Level 2.
+        wheel.schedule("d", 999.0)     # Already due.
+        self.assertEqual(4, len(wheel))
+        self.assertAlmostEqual(1000.0, wheel.get_next_deadline())
+        self.assertEqual(["d"], wheel.expire(1000.0))
+        self.assertAlmostEqual(1000.010, wheel.get_next_deadline())
+        self.assertEqual([], wheel.expire(1000.009))
+        self.assertEqual(["a"], wheel.expire(1000.010))
+        # Re-arming replaces the old deadline and cancelled timers never expire.
+        wheel.schedule("b", 1000.020)
+        wheel.schedule("a", 1000.020)
+        wheel.cancel("a")
+        wheel.cancel("x")
+        self.assertEqual(["b"], wheel.expire(1000.600))
+        self.assertEqual(["c"], wheel.expire(1101.0))
+        self.assertEqual(0, len(wheel))
+        self.assertIsNone(wheel.get_next_deadline())
+        # Deadlines past the range of the wheel still expire on time.
+        wheel.schedule("far", 1101.0 + 6 * 3600)
+        self.assertEqual([], wheel.expire(1101.0 + 5 * 3600))
+        self.assertEqual(["far"], wheel.expire(1101.0 + 6 * 3600))
+
+
+    def test_matches_sorted_deadlines(self):
+        # Compares the wheel with the deadlines kept in a plain dictionary.
+        generator = Random(7)
+        now = 5000.0
+        wheel = TimerWheel(now)
+        deadlines = {}
+        for step in range(3000):
+            key = generator.randrange(200)
+            action = generator.random()
+            if action < 0.5:
+                deadlines[key] = now + generator.choice([0.001, 0.05, 1, 30, 300]) * generator.random()
+                wheel.schedule(key, deadlines[key])
+            elif action < 0.6:
+                deadlines.pop(key, None)
+                wheel.cancel(key)
+            else:
+                next_deadline = wheel.get_next_deadline()
+                if deadlines:
+                    # The next deadline can be early but never late.
+                    self.assertLessEqual(next_deadline, min(deadlines.values()) + 0.001)
+                now += generator.choice([0.0005, 0.01, 0.2, 5])
+                due = {key for key, deadline in deadlines.items() if deadline <= now - 0.001}
+                expired = set(wheel.expire(now))
+                self.assertTrue(due.issubset(expired))
+                for key in expired:
+                    self.assertLessEqual(deadlines.pop(key), now)
+                self.assertEqual(len(deadlines), len(wheel))
+
+
+class TestQLogTracer(unittest.TestCase):
+
+    def test_tracer(self):
+        import json
+        qlog = NamedTemporaryFile(suffix=".sqlog", delete=False)
+        qlog.close()
+        tracer = QLogTracer(qlog.name)
+        peer = socket(AF_INET, SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        transport = UDPTransport()
+        transport.bind(("127.0.0.1", 0))
+        nc = QUICNetworkController()
+        nc._connection_context.set_peer_address(peer.getsockname())
+        nc.set_tracer(tracer)
+        sc = nc._sender_side_controller
+        for i in range(5):
+            frame = StreamFrame(stream_id=1, offset=i*10, length=10, data=urandom(10))
+            sc.send_packet_cc(Packet(header=ShortHeader(destination_connection_id=0, packet_number=i), frames=[frame]), transport, nc._connection_context, None)
+        peer.sendto(nc._packetizer.packetize_acknowledgement(nc._connection_context, [4]).raw(), transport.get_local_address())
+        transport.wait_readable(5)
+        self.assertEqual(1, len(nc.receive_new_packets(transport, None)))
+        sc.on_packet_numbers_acked([4])
+        self.assertEqual(2, len(sc.detect_and_remove_lost_packets(4)))
+        tracer.close()
+        with open(qlog.name) as f:
+            records = [json.loads(record) for record in f.read().split("\x1e")[1:]]
+        os.remove(qlog.name)
+        transport.close()
+        peer.close()
+        self.assertEqual("client", records[0]["trace"]["vantage_point"]["type"])
+        events = records[1:]
+        names = [event["name"] for event in events]
+        self.assertEqual(5, names.count("transport:packet_sent"))
+        self.assertEqual({"frame_type": "stream", "stream_id": 1, "offset": 0, "length": 10, "fin": False}, events[0]["data"]["frames"][0])
+        received = events[names.index("transport:packet_received")]["data"]
+        self.assertEqual([[4, 4]], received["frames"][0]["acked_ranges"])
+        lost = [event["data"] for event in events if event["name"] == "recovery:packet_lost"]
+        self.assertEqual([(0, "reordering_threshold"), (1, "reordering_threshold")], [(data["header"]["packet_number"], data["trigger"]) for data in lost])
+        states = [event["data"]["new"] for event in events if event["name"] == "recovery:congestion_state_updated"]
+        self.assertEqual(["slow_start", "recovery"], states)
+        metrics = [event["data"] for event in events if event["name"] == "recovery:metrics_updated"]
+        # Infinite values are left out and later events only have the metrics that changed.
+        self.assertNotIn("ssthresh", metrics[0])
+        self.assertEqual(sc.slow_start_threshold, metrics[1]["ssthresh"])
+        self.assertNotIn("min_rtt", metrics[1])
+
+
+    def test_send_file(self):
+        # The traced frames are views of the mapped file, which is closed as soon as send_file returns.
+        qlog = NamedTemporaryFile(suffix=".sqlog", delete=False)
+        qlog.close()
+        network = QueueNetwork()
+        server = QUICSocket("", network.create_transport())
+        server.listen(8000)
+        accepted = []
+        thread = Thread(target=lambda: accepted.append(server.accept()), daemon=True)
+        thread.start()
+        client = QUICSocket("", network.create_transport())
+        client.connect((QUEUE_HOST, 8000))
+        thread.join(5)
+        connection = accepted[0]
+        tracer = QLogTracer(qlog.name)
+        client.set_tracer(tracer)
+        data = urandom(2 * 1024 * 1024)
+        buffer = bytearray(len(data))
+        thread = Thread(target=connection.recv_exactly, args=(1, buffer), daemon=True)
+        thread.start()
+        with NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            client.send_file(1, f.name)
+        thread.join(10)
+        self.assertEqual(data, buffer)
+        tracer.close()
+        with open(qlog.name) as f:
+            self.assertIn('"frame_type": "stream"', f.read())
+        os.remove(qlog.name)
+        for sock in (client, connection):
+            sock.release()
+        server.get_transport().close()
+
+
+    def test_sampling_and_dropping(self):
+        qlog = NamedTemporaryFile(suffix=".sqlog", delete=False)
+        qlog.close()
+        self.assertRaises(ValueError, QLogTracer, qlog.name, 0)
+        # Until the writer is started nothing leaves the queue, so it fills up.
+        tracer = QLogTracer(qlog.name, sample_rate=0.5, queue_size=100)
+        packet = Packet(header=ShortHeader(destination_connection_id=0, packet_number=0), frames=[PaddingFrame()])
+        for i in range(1000):
+            tracer.on_packet_sent(packet, 10)
+        self.assertGreater(tracer.dropped, 300)
+        self.assertLess(tracer.dropped, 500)
+        tracer.close()
+        os.remove(qlog.name)
+
+
+class TestConnectionStats(unittest.TestCase):
+
+    def test_get_stats(self):
+        sock, peer = create_connected_socket()
+        nc: QUICNetworkController = sock._network_controller
+        self.assertIn("Not Connected", repr(sock))
+        sock.set_send_buffer(1, 64 * 1024)
+        sock.send(1, urandom(3000))
+        stats = sock.get_stats()
+        sent = len(nc._sender_side_controller.packets_sent)
+        self.assertEqual(sent, stats.packets_sent)
+        self.assertEqual(sent, len([peer.recv(4096) for i in range(sent)]))
+        self.assertEqual(3000, stats.send_buffer_size)
+        self.assertEqual(stats.bytes_in_flight, stats.bytes_sent)
+        # The peer acknowledges everything and sends 100 bytes on the stream.
+        ack = nc._packetizer.create_ack_frame(list(range(sent)))
+        frame = StreamFrame(stream_id=1, offset=0, length=100, data=urandom(100))
+        peer.sendto(Packet(header=ShortHeader(destination_connection_id=0, packet_number=0), frames=[frame, ack]).raw(), sock.get_transport().get_local_address())
+        sock.get_transport().wait_readable(5)
+        self.assertEqual(40, len(sock.recv(1, 40)[0]))
+        stats = sock.get_stats()
+        self.assertEqual(1, stats.packets_received)
+        self.assertEqual(0, stats.send_buffer_size)
+        self.assertEqual(0, stats.bytes_in_flight)
+        self.assertEqual(60, stats.receive_buffer_size)
+        self.assertEqual(1, stats.ack_ranges)
+        self.assertGreater(stats.smoothed_rtt, 0)
+        self.assertEqual(0, stats.packets_lost)
+        sock.release()
+        peer.close()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_registry(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_events_total", "Events.")
+        gauge = registry.gauge("test_open", "Open things.")
+        histogram = registry.histogram("test_latency_seconds", "Latency.")
+        self.assertIs(counter, registry.counter("test_events_total", "Events."))
+        self.assertRaises(ValueError, registry.gauge, "test_events_total", "Events.")
+        # Every thread updates its own shard, reads add them up.
+        def work():
+            for i in range(1000):
+                counter.inc()
+                histogram.observe(0.001 * (i % 10 + 1))
+            gauge.inc(2)
+        threads = [Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gauge.dec()
+        self.assertEqual(4000, counter.get())
+        self.assertEqual(7, gauge.get())
+        self.assertEqual(4000, histogram.get_count())
+        # Percentiles are within a bucket (1/16th) of the recorded values.
+        self.assertAlmostEqual(0.005, histogram.get_percentile(50), delta=0.005/16)
+        self.assertAlmostEqual(0.010, histogram.get_percentile(100), delta=0.010/16)
+        self.assertIsNone(registry.histogram("test_empty_seconds", "Nothing.").get_percentile(50))
+        text = registry.render()
+        self.assertIn("# TYPE test_events_total counter\ntest_events_total 4000\n", text)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 4000\n', text)
+        self.assertIn("test_latency_seconds_count 4000\n", text)
+        buckets = [int(line.split()[-1]) for line in text.splitlines() if line.startswith("test_latency_seconds_bucket")]
+        self.assertEqual(sorted(buckets), buckets)
+
+
+    def test_exporter(self):
+        from urllib.request import urlopen
+        registry = MetricsRegistry()
+        registry.counter("test_scrapes_total", "Scrapes.").inc(3)
+        exporter = MetricsExporter(registry)
+        host, port = exporter.serve_http(("127.0.0.1", 0))
+        with urlopen(f"http://{host}:{port}/metrics", timeout=5) as response:
+            self.assertIn("test_scrapes_total 3", response.read().decode())
+        path = NamedTemporaryFile(suffix=".prom", delete=False).name
+        exporter.write_file(path, interval=60)
+        with open(path) as f:
+            self.assertEqual(registry.render(), f.read())
+        exporter.close()
+        os.remove(path)
+
+
+    def test_accept_queue_depth(self):
+        network = QueueNetwork()
+        server = QUICSocket("", network.create_transport())
+        server.listen(8000)
+        client = network.create_transport()
+        initial = Packet(header=LongHeader(type=HT_INITIAL, destination_connection_id=1, source_connection_id=2, packet_number=0), frames=[])
+        depth = ACCEPT_QUEUE_DEPTH.get()
+        # The client dies after its INITIAL and accept is interrupted while it waits for the handshake.
+        nc: QUICNetworkController = server._network_controller
+        receive = nc.receive_new_packets
+        def receive_then_fail(transport, encryption_context):
+            if nc.get_state() == LISTENING_HANDSHAKE:
+                self.assertEqual(depth + 1, ACCEPT_QUEUE_DEPTH.get())
+                raise InterruptedError
+            return receive(transport, encryption_context)
+        nc.receive_new_packets = receive_then_fail
+        client.send(initial.raw(), (QUEUE_HOST, 8000))
+        self.assertRaises(InterruptedError, server.accept)
+        self.assertEqual(depth, ACCEPT_QUEUE_DEPTH.get())
+        self.assertEqual(LISTENING_INITIAL, server._network_controller.get_state())
+        # A listener closed in the middle of a handshake gives it up as well.
+        client.send(initial.raw(), (QUEUE_HOST, 8000))
+        nc = server._network_controller
+        nc.process_packets(nc.receive_new_packets(server.get_transport(), None), server.get_transport())
+        self.assertEqual(depth + 1, ACCEPT_QUEUE_DEPTH.get())
+        server.release()
+        self.assertEqual(depth, ACCEPT_QUEUE_DEPTH.get())
+        client.close()
+
+
+class TestStageProfiler(unittest.TestCase):
+
+    def test_profiler(self):
+        profiler = StageProfiler()
+        profiler.enter("process")
+        profiler.enter("ack")
+        profiler.exit("ack")
+        profiler.enter("packetize")
+        profiler.enter("serialize") # Left without an exit, as if an exception was raised in it.
+        profiler.exit("packetize")
+        profiler.exit("process")
+        self.assertEqual([1, 1, 1], [profiler.stages[stage][0] for stage in ["process", "ack", "packetize"]])
+        self.assertNotIn("serialize", profiler.stages)
+        calls, total, self_time = profiler.stages["process"]
+        self.assertEqual(total - profiler.stages["ack"][1] - profiler.stages["packetize"][1], self_time)
+        self.assertEqual(["process", "process;ack", "process;packetize"], [line.split()[0] for line in profiler.get_collapsed_stacks().splitlines()])
+        self.assertEqual(4, len(profiler.get_table().splitlines()))
+        profiler.reset()
+        self.assertEqual("", profiler.get_collapsed_stacks())
+        # Threads sharing the profiler don't lose each other's calls.
+        def work():
+            for i in range(1000):
+                profiler.enter("process")
+                profiler.enter("ack")
+                profiler.exit("ack")
+                profiler.exit("process")
+        threads = [Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4000, profiler.stages["ack"][0])
+        self.assertEqual({"process", "process;ack"}, set(profiler.stacks))
+        profiler.reset()
+        # The stages of a connection are timed once a profiler is set.
+        sock, peer = create_connected_socket()
+        sock.set_profiler(profiler)
+        sock.send(1, urandom(3000))
+        frame = StreamFrame(stream_id=1, offset=0, length=100, data=urandom(100))
+        peer.sendto(Packet(header=ShortHeader(destination_connection_id=0, packet_number=0), frames=[frame]).raw(), sock.get_transport().get_local_address())
+        peer.sendto(b"\xff", sock.get_transport().get_local_address())
+        sock.get_transport().wait_readable(5)
+        sock.recv(1, 100)
+        for stage in ["recvfrom", "parse", "process", "ack", "packetize", "serialize", "sendto"]:
+            self.assertIn(stage, profiler.stages)
+        self.assertEqual(2, profiler.stages["parse"][0])
+        self.assertIn("process;ack", profiler.stacks)
+        sock.set_profiler(None)
+        sock.release()
+        peer.close()
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_compare_to_baseline(self):
+        self.assertEqual(2.5, percentile([4, 1, 3, 2], 50))
+        self.assertEqual(4, percentile([4, 1, 3, 2], 100))
+        summary = summarize([4, 1, 3, 2], "latency_ms", 1000)
+        self.assertEqual(["latency_ms_p50", "latency_ms_p90", "latency_ms_p99", "latency_ms_max"], list(summary))
+        self.assertAlmostEqual(3700, summary["latency_ms_p90"])
+        self.assertEqual(4000, summary["latency_ms_max"])
+        baseline = [{"protocol": "quic", "size": 64, "goodput_mbps": 100.0, "latency_us_p50": 400.0},
+                    {"protocol": "tcp", "size": 64, "goodput_mbps": 1000.0, "latency_us_p50": 20.0}]
+        results = [{"protocol": "quic", "size": 64, "goodput_mbps": 85.0, "latency_us_p50": 500.0},
+                   {"protocol": "tcp", "size": 64, "goodput_mbps": 700.0, "latency_us_p50": 10.0},
+                   {"protocol": "tcp", "size": 1024, "goodput_mbps": 1.0}] # Not in the baseline.
+        regressions = compare_to_baseline(results, baseline, tolerance=0.2)
+        # Lower goodput and higher latency are worse, only changes beyond the tolerance count.
+        self.assertEqual(2, len(regressions))
+        self.assertIn("protocol=quic size=64: latency_us_p50", regressions[0])
+        self.assertIn("protocol=tcp size=64: goodput_mbps", regressions[1])
+        self.assertEqual([], compare_to_baseline(results, baseline, tolerance=0.2, metrics=["requests_per_sec"]))
+
+    def test_micro_benchmarks(self):
+        setups = []
+        case = Case("append", lambda state: state.append(1), lambda: setups.append([]) or setups[-1], fresh=True)
+        result = measure(case, min_time=0.0, repeats=3)
+        self.assertEqual(("micro", "append", 3), (result["benchmark"], result["case"], result["repeats"]))
+        # Every run gets its own state.
+        self.assertEqual(1 + 3, len(setups))
+        self.assertTrue(all(state == [1] for state in setups))
+        self.assertGreater(result["ns_per_op"], 0)
+        self.assertGreaterEqual(result["ns_per_op"], result["ns_per_op_min"])
+        # None of the cases needs a socket.
+        for case in get_cases():
+            case.sample(2)
+
+
+class TestImpairment(unittest.TestCase):
+
+    def test_impairment(self):
+        # A 1000 bytes per second bottleneck with room for 2500 bytes in its queue.
+        impairment = Impairment(rate=8000, queue_size=2500, delay=0.5, drop=[1])
+        self.assertEqual([[1.5], [], [2.5], []], [impairment.get_send_times(0.0, 1000) for i in range(4)])
+        self.assertEqual([3.5], impairment.get_send_times(1.0, 1000))
+        self.assertEqual((5, 1, 1), (impairment.datagrams_received, impairment.datagrams_lost, impairment.datagrams_dropped))
+        impairment = Impairment(delay=0.1, jitter=0.05, duplicate=1.0, seed=1)
+        for i in range(100):
+            send_times = impairment.get_send_times(0.0, 100)
+            self.assertEqual(2, len(send_times))
+            self.assertTrue(all(0.05 <= send_time <= 0.15 for send_time in send_times))
+        impairment = Impairment(delay=0.1, reorder=1.0)
+        self.assertEqual([0.0], impairment.get_send_times(0.0, 100))
+        # Bursty loss keeps to the loss rate, but losses come in runs of burst_length on average.
+        impairment = Impairment(loss=0.1, burst_length=4, seed=1)
+        lost = [not impairment.get_send_times(0.0, 100) for i in range(100000)]
+        bursts = sum(1 for i in range(len(lost)) if lost[i] and (i == 0 or not lost[i-1]))
+        self.assertAlmostEqual(0.1, sum(lost) / len(lost), delta=0.01)
+        self.assertAlmostEqual(4, sum(lost) / bursts, delta=0.3)
+        self.assertEqual(1.0, create_burst_loss(1.0, 4).p)
+        impairment = parse_impairment("delay=0.02, loss=0.01,burst=2,rate=1e6,queue=64000")
+        self.assertEqual((0.02, 0.01, 1e6, 64000, 0.5), (impairment.delay, impairment.loss, impairment.rate, impairment.queue_size, impairment.burst_loss.r))
+        self.assertRaises(ValueError, parse_impairment, "latency=1")
+
+
+    def test_impairment_proxy(self):
+        server = socket(AF_INET, SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        client = socket(AF_INET, SOCK_DGRAM)
+        client.settimeout(5)
+        proxy = ImpairmentProxy(server.getsockname(), upstream=Impairment(drop=[1]), downstream=Impairment(delay=0.05))
+        proxy.start()
+        for i in range(3):
+            client.sendto(bytes([i]), proxy.get_address())
+        self.assertEqual(b"\x00", server.recvfrom(16)[0])
+        data, address = server.recvfrom(16)
+        self.assertEqual(b"\x02", data)
+        # Answers are delayed on the way back and come from the address the client sent to.
+        start = time()
+        server.sendto(b"answer", address)
+        self.assertEqual((b"answer", proxy.get_address()), client.recvfrom(16))
+        self.assertGreaterEqual(time() - start, 0.05)
+        # The path goes down.
+        proxy.set_impairments(downstream=Impairment(loss=1.0))
+        server.sendto(b"lost", address)
+        client.settimeout(0.2)
+        self.assertRaises(TimeoutError, client.recvfrom, 16)
+        stats = proxy.get_stats()
+        self.assertEqual((3, 2, 1), (stats["upstream"]["datagrams_received"], stats["upstream"]["datagrams_sent"], stats["upstream"]["datagrams_lost"]))
+        self.assertEqual(1, stats["downstream"]["datagrams_lost"])
+        proxy.stop()
+        server.close()
+        client.close()
+
+
+    def test_simulation(self):
+        def simulate(loss):
+            simulation = Simulation(Impairment(rate=2e6, delay=0.02, queue_size=20000, loss=loss, seed=1), Impairment(delay=0.02, seed=2))
+            result = simulation.run(duration=2.0)
+            simulation.close()
+            self.assertEqual(START_TIME + 2.0, simulation.clock())
+            # A path this slow simulates faster than real time, by about ten times.
+            self.assertLess(result["wall_seconds"], 2.0)
+            return result
+
+        result = simulate(0.0)
+        self.assertGreater(result["bytes_delivered"], 100_000)
+        self.assertLessEqual(result["goodput_mbps"], 2.0)
+        self.assertAlmostEqual(40, result["min_rtt_ms"], delta=10)
+        # The same losses on the same path send the same datagrams at the same times.
+        result = simulate(0.02)
+        self.assertEqual(result, {**simulate(0.02), "wall_seconds": result["wall_seconds"]})
+        self.assertGreater(result["link_lost"], 0)
+        self.assertGreater(result["packets_retransmitted"], 0)
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_queue_transport(self):
+        network = QueueNetwork()
+        server = network.create_transport()
+        server.listen(8000)
+        client = network.create_transport()
+        self.assertFalse(server.wait_readable(0))
+        client.send_batch([b"one", bytearray(b"two")], (QUEUE_HOST, 8000))
+        fd = server.fileno()
+        self.assertEqual([fd], select([fd], [], [], 5)[0])
+        self.assertTrue(server.wait_readable(0))
+        self.assertEqual([(b"one", client.get_local_address())], server.receive_batch(1))
+        self.assertEqual([(b"two", client.get_local_address())], server.receive_batch())
+        self.assertEqual([], select([fd], [], [], 0)[0])
+        # The accepted connection has an address of its own.
+        connection = server.accept(client.get_local_address())
+        connection.send(b"three", connection.get_peer_address())
+        self.assertEqual([(b"three", connection.get_local_address())], client.receive_batch())
+        self.assertRaises(OSError, network.create_transport().listen, 8000)
+        server.close()
+        client.send(b"lost", (QUEUE_HOST, 8000))
+        self.assertEqual(-1, server.fileno())
+        for transport in (client, connection):
+            transport.close()
+
+
+    def test_send_batch(self):
+        sock, peer = create_connected_socket()
+        transport = sock.get_transport()
+        batches = []
+        send_batch = transport.send_batch
+        transport.send_batch = lambda datagrams, address: (batches.append(len(datagrams)), send_batch(datagrams, address))
+        datagrams_sent, send_batches = DATAGRAMS_SENT.get(), SEND_BATCHES.get()
+        sock.send(1, urandom(8000))
+        # The packets a flush is allowed to send go to the transport together.
+        self.assertGreater(batches[0], 1)
+        self.assertEqual(sock.get_stats().packets_sent, sum(batches))
+        self.assertEqual(sum(batches), DATAGRAMS_SENT.get() - datagrams_sent)
+        self.assertEqual(len(batches), SEND_BATCHES.get() - send_batches)
+        for i in range(sum(batches)):
+            peer.recv(4096)
+        transport.close()
+        peer.close()
+
+
+    def test_connections(self):
+        def transfer(server_transport, client_transport, listen_address, address):
+            server = QUICSocket("", server_transport)
+            server.listen(listen_address)
+            accepted = []
+            thread = Thread(target=lambda: accepted.append(server.accept()), daemon=True)
+            thread.start()
+            client = QUICSocket("", client_transport)
+            client.connect(address)
+            thread.join(5)
+            connection = accepted[0]
+            # The client talks to the transport of the accepted connection.
+            self.assertEqual(connection.get_transport().get_local_address(), client.get_connection_state().get_peer_address())
+            reactor = QUICReactor()
+            reactor.start()
+            reactor.register(connection)
+            data = urandom(100_000)
+            client.send(1, data)
+            buffer = bytearray(len(data))
+            self.assertEqual(len(data), connection.recv_exactly(1, buffer)[0])
+            self.assertEqual(data, buffer)
+            reactor.stop()
+            for sock in (client, connection):
+                sock.release()
+            server.get_transport().close()
+
+        network = QueueNetwork()
+        transfer(network.create_transport(), network.create_transport(), 8000, (QUEUE_HOST, 8000))
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "server.sock")
+            transfer(UnixTransport(), UnixTransport(), path, path)
+            self.assertFalse(os.path.exists(path))
+
 
 class TestEncryptionContext(unittest.TestCase):
 